@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -48,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'home.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,12 +82,80 @@ WSGI_APPLICATION = 'ar.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=sqlite3 (default) oppure postgresql, configurato dalle variabili DB_*.
+# Le connessioni restano aperte tra le richieste (DB_CONN_MAX_AGE secondi); con
+# PostgreSQL e DB_POOL=1 si usa invece il pool di psycopg (DB_POOL_MAX_SIZE per
+# processo, almeno GUNICORN_THREADS).
+# PostgreSQL è opzionale e non è in requirements.txt: richiede
+# pip install "psycopg[binary,pool]" (l'extra pool serve solo con DB_POOL=1).
+DB_ENGINE = os.environ.get('DB_ENGINE', 'sqlite3')
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', '600'))
+
+if DB_ENGINE == 'sqlite3':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME') or BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': DB_CONN_MAX_AGE,
+            'OPTIONS': {
+                # WAL: le letture delle view camera non si bloccano durante le scritture di
+                # admin e scanner; IMMEDIATE prende il lock di scrittura a inizio transazione
+                # (niente "database is locked" a metà), timeout attende il lock invece di fallire
+                'timeout': 20,
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    'PRAGMA cache_size=-20000;'
+                    'PRAGMA mmap_size=134217728;'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+        }
+    }
+else:
+    DB_POOL = os.environ.get('DB_POOL', '0') == '1'
+    if DB_ENGINE == 'postgresql':
+        try:
+            import psycopg  # noqa: F401
+            if DB_POOL:
+                import psycopg_pool  # noqa: F401
+        except ImportError:
+            from django.core.exceptions import ImproperlyConfigured
+            raise ImproperlyConfigured(
+                'DB_ENGINE=postgresql richiede psycopg: pip install "psycopg[binary,pool]"'
+            )
+    DATABASES = {
+        'default': {
+            'ENGINE': f'django.db.backends.{DB_ENGINE}',
+            'NAME': os.environ.get('DB_NAME', 'ar'),
+            'USER': os.environ.get('DB_USER', ''),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ''),
+            'HOST': os.environ.get('DB_HOST', ''),
+            'PORT': os.environ.get('DB_PORT', ''),
+            # Il pool di psycopg non è compatibile con le connessioni persistenti
+            'CONN_MAX_AGE': 0 if DB_POOL else DB_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                'pool': {
+                    'min_size': int(os.environ.get('DB_POOL_MIN_SIZE', '2')),
+                    'max_size': int(os.environ.get('DB_POOL_MAX_SIZE', '8')),
+                },
+            } if DB_POOL else {},
+        }
     }
-}
+
+    # Replica in sola lettura per le letture del catalogo (vedi home/routers.py)
+    if os.environ.get('DB_REPLICA_HOST'):
+        DATABASES['replica'] = {
+            **DATABASES['default'],
+            'HOST': os.environ['DB_REPLICA_HOST'],
+            'PORT': os.environ.get('DB_REPLICA_PORT', DATABASES['default']['PORT']),
+            'TEST': {'MIRROR': 'default'},
+        }
+
+DATABASE_ROUTERS = ['home.routers.CatalogReplicaRouter']
+DATABASE_REPLICA_ALIAS = 'replica'
 
 
 # Password validation
@@ -131,14 +201,104 @@ STATICFILES_DIRS = [
 # Static files collection for production
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# collectstatic scrive file con hash nel nome (cache immutabile) e le versioni .gz/.br
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'home.storage.PrecompressedManifestStaticFilesStorage',
+    },
+}
+
+# opencv.js servito come static file (manage.py vendor_opencv_js), altrimenti dalla CDN
+OPENCV_JS_VERSION = '4.8.0'
+OPENCV_JS_CDN_URL = f'https://docs.opencv.org/{OPENCV_JS_VERSION}/opencv.js'
+
 # Media files (uploaded by users)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
 # File upload settings
+# Limite dei corpi letti in memoria (frame di /api/yolo-detect/ e /api/marker-match/,
+# JSON base64 dello scanner). Le immagini multipart dello scanner vanno comunque su
+# file temporaneo (home/uploads.py) con il limite MARKER_UPLOAD_MAX_BYTES
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 
+# Immagini marker caricate dallo scanner: rifiutate dall'header, prima del decode
+MARKER_UPLOAD_MAX_BYTES = 8 * 1024 * 1024
+MARKER_UPLOAD_MAX_DIMENSION = 4096
+
+# Catalogo personaggi: snapshot serializzati in cache finché CatalogVersion non cambia
+# (con più worker gunicorn conviene un backend CACHES condiviso)
+CATALOG_CACHE_TIMEOUT = 3600
+CATALOG_BUILD_WAIT_SECONDS = 2
+
+# Estrazione features dei marker in background (manage.py process_marker_jobs).
+# MARKER_FEATURES_BACKGROUND=0 la esegue subito dopo il salvataggio (sviluppo senza worker)
+MARKER_FEATURES_BACKGROUND = os.environ.get('MARKER_FEATURES_BACKGROUND', '1') == '1'
+MARKER_JOB_STALE_SECONDS = 600
+
+# /api/marker-match/: indice LSH in memoria sui descriptors ORB dei marker
+MARKER_INDEX_LSH_TABLES = 12
+MARKER_INDEX_LSH_BITS = 14
+MARKER_INDEX_REFRESH_SECONDS = 2
+MARKER_MATCH_MAX_HAMMING = 64
+MARKER_MATCH_FRAME_FEATURES = 1000  # nfeatures ORB quando il client invia il frame
+
+# YOLO inference
+# Frame di richieste concorrenti raccolti in un unico forward pass.
+# Serve un worker con più thread (gunicorn --worker-class gthread --threads N) o ASGI.
+YOLO_BATCH_MAX_SIZE = 8
+YOLO_BATCH_MAX_WAIT_MS = 10
+
+# Input del modello se la richiesta non indica image_size (CharConfiguration.yolo_image_size).
+# I JPEG molto più grandi vengono decodificati già ridotti (1/2, 1/4, 1/8)
+YOLO_IMAGE_SIZE = 640
+
+# Con un server ASGI (ar.asgi) /api/yolo-detect/ usa la view async: decode e
+# post-processing in un executor di YOLO_EXECUTOR_WORKERS thread, l'inferenza non occupa thread
+YOLO_ASYNC_DETECTION = False
+YOLO_EXECUTOR_WORKERS = 4
+
+# YOLO_PRELOAD=1: gunicorn.conf.py carica i pesi nel master e scalda il modello in ogni worker
+# (solo il server: runserver e i comandi manage.py caricano il modello alla prima detection)
+YOLO_PRELOAD = os.environ.get('YOLO_PRELOAD', '0') == '1'
+YOLO_WARMUP_RUNS = 3
+YOLO_WARMUP_IMAGE_SIZE = 640
+YOLO_LOAD_RETRY_SECONDS = 60
+
+# Modalità detect-then-track (parametro session di /api/yolo-detect/, vedi home/tracking.py):
+# YOLO ogni YOLO_TRACK_REDETECT_FRAMES frame, in mezzo optical flow sulla regione dell'oggetto
+YOLO_TRACK_REDETECT_FRAMES = 15
+YOLO_TRACK_MIN_CONFIDENCE = 0.5
+YOLO_TRACK_SESSION_TTL = 30
+YOLO_TRACK_MAX_SESSIONS = 1000
+
+# Cache dei risultati per frame quasi identici della stessa sessione (home/frame_cache.py):
+# distanza massima tra i perceptual hash a 64 bit, YOLO_FRAME_CACHE_TTL = 0 la disattiva
+YOLO_FRAME_CACHE_TTL = 2
+YOLO_FRAME_CACHE_MAX_DISTANCE = 4
+YOLO_FRAME_CACHE_ENTRIES = 4
+YOLO_FRAME_CACHE_MAX_SESSIONS = 1000
+
+# Backend: 'pytorch' (ultralytics), 'onnx' (ONNX Runtime) o 'openvino'.
+# I modelli onnx/openvino si creano con: python manage.py export_yolo_model --format onnx [--int8]
+YOLO_BACKEND = os.environ.get('YOLO_BACKEND', 'pytorch')
+YOLO_MODEL_PATH = os.environ.get('YOLO_MODEL_PATH') or None
+# Thread intra-op per processo (0 = default del runtime). Con N worker: core / N
+YOLO_INTRA_OP_THREADS = int(os.environ.get('YOLO_INTRA_OP_THREADS', '0'))
+
+# Metriche: header Server-Timing con i tempi per fase e /metrics in formato Prometheus.
+# METRICS_DIR è una directory scrivibile da tutti i worker (svuotata da gunicorn.conf.py
+# all'avvio) in cui si sommano le metriche dei processi; senza, /metrics riporta solo
+# il processo che risponde. Con METRICS_TOKEN /metrics richiede "Authorization: Bearer <token>"
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') == '1'
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_FLUSH_SECONDS = 1
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
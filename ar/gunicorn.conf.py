@@ -0,0 +1,56 @@
+"""
+Configurazione gunicorn per la produzione.
+
+Uso: gunicorn -c gunicorn.conf.py ar.wsgi:application
+
+Con preload_app l'app Django (e, con YOLO_PRELOAD=1, i pesi del modello YOLO)
+viene caricata una volta nel master prima del fork: i worker condividono i pesi
+copy-on-write invece di caricarne una copia ciascuno. Il warm-up gira in ogni
+worker dopo il fork (post_fork): il master non esegue inferenze.
+"""
+import os
+
+bind = os.environ.get('GUNICORN_BIND', 'unix:/var/www/ar_django/ar.sock')
+workers = int(os.environ.get('GUNICORN_WORKERS', '3'))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
+timeout = 60
+
+preload_app = True
+
+# Il master legge i settings Django dopo questo file; usato solo dagli hook qui sotto,
+# i comandi manage.py non caricano il modello
+os.environ.setdefault('YOLO_PRELOAD', '1')
+
+# Metriche dei worker sommate da /metrics (vedi home/metrics.py)
+os.environ.setdefault('METRICS_DIR', '/var/www/ar_django/metrics')
+
+
+def on_starting(server):
+    # Le metriche di un avvio precedente non vanno sommate a quelle nuove
+    metrics_dir = os.environ['METRICS_DIR']
+    if os.path.isdir(metrics_dir):
+        for name in os.listdir(metrics_dir):
+            if name.endswith(('.json', '.tmp')):
+                os.remove(os.path.join(metrics_dir, name))
+
+
+def when_ready(server):
+    # App già caricata nel master (preload_app): solo i pesi, nessun forward prima del fork
+    from django.conf import settings
+    if settings.YOLO_PRELOAD:
+        from home.inference import preload_yolo_model
+        preload_yolo_model()
+
+
+def child_exit(server, worker):
+    # Contatori del worker terminato in dead.json (vedi home.metrics.mark_process_dead)
+    from home.metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    from django.conf import settings
+    if settings.YOLO_PRELOAD:
+        from home.inference import warm_up_yolo_model
+        warm_up_yolo_model()
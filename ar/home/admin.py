@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import CharConfiguration
+from .models import CharConfiguration, ImageVariantJob, MarkerFeatureJob
 
 # Register your models here.
 @admin.register(CharConfiguration)
@@ -8,7 +8,7 @@ class CharacterConfigurationAdmin(admin.ModelAdmin):
         'name', 'target_latitude', 'target_longitude', 'activation_distance',
         'use_marker', 'use_yolo_detection', 'yolo_object_class'
     ]
-    readonly_fields = ['detection_marker_features', 'positioning_marker_features']
+    readonly_fields = ['detection_marker_features', 'positioning_marker_features', 'marker_features_status']
 
     fieldsets = (
         ('Informazioni Base', {
@@ -27,18 +27,34 @@ class CharacterConfigurationAdmin(admin.ModelAdmin):
                 'detection_marker_features',
                 'positioning_marker_image',
                 'positioning_marker_features',
+                'marker_features_status',
                 'marker_offset_x',
                 'marker_offset_y',
                 'marker_offset_z'
             ),
-            'description': 'Sistema basato su immagini marker. I campi "features" vengono calcolati automaticamente.'
+            'description': 'Sistema basato su immagini marker. I campi "features" vengono calcolati in background dopo il salvataggio.'
         }),
         ('YOLO Object Detection', {
             'fields': (
                 'use_yolo_detection',
                 'yolo_object_class',
-                'yolo_confidence_threshold'
+                'yolo_confidence_threshold',
+                'yolo_image_size'
             ),
             'description': 'Sistema basato su riconoscimento oggetti reali (bottiglia, sedia, laptop, ecc.)'
         }),
-    ) 
\ No newline at end of file
+    )
+
+
+@admin.register(MarkerFeatureJob)
+class MarkerFeatureJobAdmin(admin.ModelAdmin):
+    list_display = ['character', 'marker_type', 'status', 'attempts', 'updated_at']
+    list_filter = ['status', 'marker_type']
+    readonly_fields = ['character', 'marker_type', 'attempts', 'error', 'created_at', 'updated_at']
+
+
+@admin.register(ImageVariantJob)
+class ImageVariantJobAdmin(admin.ModelAdmin):
+    list_display = ['character', 'field_name', 'status', 'attempts', 'updated_at']
+    list_filter = ['status', 'field_name']
+    readonly_fields = ['character', 'field_name', 'attempts', 'error', 'created_at', 'updated_at']
@@ -0,0 +1,208 @@
+"""
+Backend di inferenza YOLO ottimizzati per CPU (ONNX Runtime / OpenVINO).
+
+I modelli vengono esportati con ``manage.py export_yolo_model`` e selezionati
+con YOLO_BACKEND in settings. Pre-processing (letterbox) e NMS sono fatti qui
+in numpy/OpenCV, così si controlla il numero di thread intra-op di ogni worker.
+I risultati espongono la stessa interfaccia di ultralytics usata da
+home/detection.py (``result.names``, ``result.boxes`` con ``cls``/``conf``/``xywh``).
+"""
+import abc
+import ast
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+DEFAULT_IOU = 0.7
+MAX_DETECTIONS = 300
+LETTERBOX_COLOR = 114
+
+
+class DetectionBoxes:
+    """Equivalente numpy di ultralytics Boxes (xywh in pixel del frame originale, center format)"""
+
+    def __init__(self, xywh, conf, cls):
+        self.xywh = xywh
+        self.conf = conf
+        self.cls = cls
+
+    def __len__(self):
+        return len(self.conf)
+
+    def __iter__(self):
+        for i in range(len(self.conf)):
+            yield DetectionBoxes(self.xywh[i:i + 1], self.conf[i:i + 1], self.cls[i:i + 1])
+
+
+class DetectionResult:
+    def __init__(self, names, boxes):
+        self.names = names
+        self.boxes = boxes
+
+
+def letterbox(image, size):
+    """Ridimensiona mantenendo le proporzioni e aggiunge padding (come ultralytics LetterBox)"""
+    height, width = image.shape[:2]
+    gain = min(size / height, size / width)
+    new_w, new_h = int(round(width * gain)), int(round(height * gain))
+    pad_x, pad_y = (size - new_w) / 2, (size - new_h) / 2
+
+    if (new_w, new_h) != (width, height):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(
+        image, top, bottom, left, right, cv2.BORDER_CONSTANT,
+        value=(LETTERBOX_COLOR, LETTERBOX_COLOR, LETTERBOX_COLOR)
+    )
+    return image, gain, (left, top)
+
+
+class ExportedYoloModel(abc.ABC):
+    """
+    Modello YOLOv8 esportato: output (batch, 4 + classi, ancore).
+    Le sottoclassi implementano solo _forward(batch NCHW float32).
+    """
+
+    def __init__(self, names, imgsz=640):
+        self.names = names
+        self.imgsz = imgsz
+
+    @abc.abstractmethod
+    def _forward(self, batch):
+        """Returns: output grezzo del modello (batch, 4 + classi, ancore)"""
+
+    def __call__(self, source, conf=0.25, iou=DEFAULT_IOU, classes=None, verbose=False, **kwargs):
+        images = source if isinstance(source, (list, tuple)) else [source]
+
+        batch = np.empty((len(images), 3, self.imgsz, self.imgsz), dtype=np.float32)
+        transforms = []
+        for i, image in enumerate(images):
+            padded, gain, pad = letterbox(image, self.imgsz)
+            # BGR HWC uint8 -> RGB CHW float32 [0, 1]
+            batch[i] = padded[:, :, ::-1].transpose(2, 0, 1) / 255.0
+            transforms.append((gain, pad, image.shape[:2]))
+
+        outputs = self._forward(batch)
+        return [
+            self._postprocess(output, conf, iou, classes, transform)
+            for output, transform in zip(outputs, transforms)
+        ]
+
+    def _postprocess(self, output, conf, iou, classes, transform):
+        gain, (pad_x, pad_y), (height, width) = transform
+
+        predictions = output.T  # (ancore, 4 + classi)
+        scores = predictions[:, 4:]
+        if classes is not None:
+            mask = np.full(scores.shape[1], -1.0, dtype=scores.dtype)
+            mask[list(classes)] = 0
+            scores = scores + mask
+
+        cls = scores.argmax(axis=1)
+        confidence = scores[np.arange(len(scores)), cls]
+        keep = confidence >= conf
+
+        boxes = predictions[keep, :4]
+        cls = cls[keep]
+        confidence = confidence[keep]
+
+        if len(confidence):
+            # NMS per classe (come ultralytics agnostic=False)
+            xywh_tl = np.column_stack([boxes[:, 0] - boxes[:, 2] / 2, boxes[:, 1] - boxes[:, 3] / 2, boxes[:, 2], boxes[:, 3]])
+            indices = cv2.dnn.NMSBoxesBatched(
+                xywh_tl.tolist(), confidence.tolist(), cls.tolist(), conf, iou, top_k=MAX_DETECTIONS
+            )
+            indices = np.array(indices, dtype=np.int64).reshape(-1)
+            boxes, cls, confidence = boxes[indices], cls[indices], confidence[indices]
+
+        # Da coordinate letterbox a coordinate del frame originale
+        x1 = np.clip((boxes[:, 0] - boxes[:, 2] / 2 - pad_x) / gain, 0, width)
+        y1 = np.clip((boxes[:, 1] - boxes[:, 3] / 2 - pad_y) / gain, 0, height)
+        x2 = np.clip((boxes[:, 0] + boxes[:, 2] / 2 - pad_x) / gain, 0, width)
+        y2 = np.clip((boxes[:, 1] + boxes[:, 3] / 2 - pad_y) / gain, 0, height)
+        xywh = np.column_stack([(x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1]).astype(np.float32)
+
+        return DetectionResult(
+            self.names,
+            DetectionBoxes(xywh, confidence.astype(np.float32), cls.astype(np.float32))
+        )
+
+
+def _parse_names(value):
+    names = ast.literal_eval(value) if isinstance(value, str) else value
+    return {int(k): v for k, v in names.items()}
+
+
+def _parse_imgsz(value):
+    imgsz = ast.literal_eval(value) if isinstance(value, str) else value
+    return int(imgsz[0] if isinstance(imgsz, (list, tuple)) else imgsz)
+
+
+class OnnxRuntimeYoloModel(ExportedYoloModel):
+    def __init__(self, path, threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        self.session = ort.InferenceSession(str(path), options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        super().__init__(_parse_names(metadata['names']), _parse_imgsz(metadata.get('imgsz', 640)))
+
+    def _forward(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+
+class OpenVinoYoloModel(ExportedYoloModel):
+    def __init__(self, path, threads=0):
+        import yaml
+        from openvino.runtime import Core
+
+        path = Path(path)
+        with open(path / 'metadata.yaml') as f:
+            metadata = yaml.safe_load(f)
+
+        config = {'PERFORMANCE_HINT': 'LATENCY'}
+        if threads:
+            config['INFERENCE_NUM_THREADS'] = str(threads)
+
+        core = Core()
+        model = core.read_model(next(path.glob('*.xml')))
+        self.compiled = core.compile_model(model, 'CPU', config)
+        self.output = self.compiled.output(0)
+
+        super().__init__(_parse_names(metadata['names']), _parse_imgsz(metadata.get('imgsz', 640)))
+
+    def _forward(self, batch):
+        return self.compiled([batch])[self.output]
+
+
+BACKENDS = {
+    'onnx': OnnxRuntimeYoloModel,
+    'openvino': OpenVinoYoloModel,
+}
+
+DEFAULT_MODEL_PATHS = {
+    'onnx': 'yolov8n.onnx',
+    'openvino': 'yolov8n_openvino_model',
+}
+
+
+def load_exported_model(backend, path=None, threads=0):
+    """Carica un modello esportato per il backend richiesto ('onnx' o 'openvino')"""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown YOLO backend: {backend}")
+
+    path = path or DEFAULT_MODEL_PATHS[backend]
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, run: python manage.py export_yolo_model --format {backend}")
+    return BACKENDS[backend](path, threads=threads)
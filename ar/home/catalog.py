@@ -0,0 +1,246 @@
+"""
+Snapshot serializzati del catalogo personaggi per le view camera e /api/characters/.
+
+Ogni profilo (full, simple, simple_gps, yolo) viene serializzato una volta per
+versione del catalogo (CatalogVersion, incrementata ad ogni save/delete di
+CharConfiguration) e riusato finché la versione non cambia. Lo snapshot è
+tenuto in memoria nel processo e nella cache Django (condivisa tra worker se
+il backend lo è); un lock evita che richieste concorrenti lo ricostruiscano
+tutte insieme.
+"""
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .derivatives import variant_urls
+from .geo import parse_nearby_params, filter_nearby
+from .metrics import stage
+from .models import CharConfiguration, CatalogVersion
+from .routers import catalog_reads
+
+
+def serialize_full(char):
+    return {
+        'id': char.id,
+        'name': char.name,
+        'target_latitude': char.target_latitude,
+        'target_longitude': char.target_longitude,
+        'activation_distance': char.activation_distance,
+        'character_image': char.character_image.url if char.character_image else None,
+        'character_image_variants': variant_urls(char, 'character_image'),
+        'altitude': char.altitude,
+        'height_offset': char.height_offset,
+        'base_size': char.base_size,
+        'facing_direction': char.facing_direction,
+        'display_mode': char.display_mode,
+        'use_marker': char.use_marker,
+        'marker_image': char.marker_image.url if char.marker_image else None,
+        'marker_image_variants': variant_urls(char, 'marker_image'),
+        'positioning_marker_image': char.positioning_marker_image.url if char.positioning_marker_image else None,
+        'positioning_marker_image_variants': variant_urls(char, 'positioning_marker_image'),
+        'marker_offset_x': char.marker_offset_x,
+        'marker_offset_y': char.marker_offset_y,
+        'marker_offset_z': char.marker_offset_z,
+        'detection_marker_features': char.detection_marker_features,
+        'positioning_marker_features': char.positioning_marker_features,
+    }
+
+
+def serialize_simple(char):
+    return {
+        'id': char.id,
+        'name': char.name,
+        'character_image': char.character_image.url if char.character_image else None,
+        'character_image_variants': variant_urls(char, 'character_image'),
+        'positioning_marker_image': char.positioning_marker_image.url,
+        'positioning_marker_image_variants': variant_urls(char, 'positioning_marker_image'),
+        'base_size': char.base_size,
+        'marker_offset_x': char.marker_offset_x,
+        'marker_offset_y': char.marker_offset_y,
+    }
+
+
+def serialize_simple_gps(char):
+    return {
+        'id': char.id,
+        'name': char.name,
+        'target_latitude': char.target_latitude,
+        'target_longitude': char.target_longitude,
+        'activation_distance': char.activation_distance,
+        'character_image': char.character_image.url if char.character_image else None,
+        'character_image_variants': variant_urls(char, 'character_image'),
+        'positioning_marker_image': char.positioning_marker_image.url,
+        'positioning_marker_image_variants': variant_urls(char, 'positioning_marker_image'),
+        'positioning_marker_features': char.positioning_marker_features,
+        'base_size': char.base_size,
+        'marker_offset_x': char.marker_offset_x,
+        'marker_offset_y': char.marker_offset_y,
+    }
+
+
+def serialize_yolo(char):
+    return {
+        'id': char.id,
+        'name': char.name,
+        'target_latitude': char.target_latitude,
+        'target_longitude': char.target_longitude,
+        'activation_distance': char.activation_distance,
+        'character_image': char.character_image.url if char.character_image else None,
+        'character_image_variants': variant_urls(char, 'character_image'),
+        'use_yolo_detection': char.use_yolo_detection,
+        'yolo_object_class': char.yolo_object_class,
+        'yolo_confidence_threshold': char.yolo_confidence_threshold,
+        'yolo_image_size': char.yolo_image_size,
+        'base_size': char.base_size,
+        'marker_offset_x': char.marker_offset_x,
+        'marker_offset_y': char.marker_offset_y,
+    }
+
+
+def _with_positioning_marker():
+    # Solo i personaggi con positioning_marker_image
+    return CharConfiguration.objects.filter(
+        positioning_marker_image__isnull=False
+    ).exclude(positioning_marker_image='')
+
+
+# profilo -> (queryset, serializer)
+PROFILES = {
+    'full': (CharConfiguration.objects.all, serialize_full),
+    'simple': (_with_positioning_marker, serialize_simple),
+    'simple_gps': (_with_positioning_marker, serialize_simple_gps),
+    'yolo': (
+        lambda: CharConfiguration.objects.filter(use_yolo_detection=True).exclude(yolo_object_class=''),
+        serialize_yolo
+    ),
+}
+
+
+class CatalogSnapshot:
+    def __init__(self, profile, version, items):
+        self.profile = profile
+        self.version = version
+        self.items = items
+        self.by_id = {item['id']: item for item in items}
+        self.json = json.dumps(items)
+
+    @property
+    def etag(self):
+        return f'"catalog-{self.profile}-{self.version}"'
+
+
+# Snapshot già deserializzati nel processo: profilo -> CatalogSnapshot
+_local_snapshots = {}
+_build_locks = {profile: threading.Lock() for profile in PROFILES}
+
+
+def _cache_key(profile, version):
+    return f'catalog:{profile}:{version}'
+
+
+def _build_snapshot(profile, version):
+    queryset, serializer = PROFILES[profile]
+    with stage('catalog_build'):
+        return CatalogSnapshot(profile, version, [serializer(char) for char in queryset()])
+
+
+def _wait_for_shared_snapshot(key):
+    # Un altro processo sta costruendo lo snapshot: aspetta che compaia in cache
+    deadline = time.monotonic() + getattr(settings, 'CATALOG_BUILD_WAIT_SECONDS', 2)
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        snapshot = cache.get(key)
+        if snapshot is not None:
+            return snapshot
+    return None
+
+
+def get_snapshot(profile):
+    """Snapshot del profilo per la versione corrente del catalogo"""
+    version = CatalogVersion.current()
+
+    snapshot = _local_snapshots.get(profile)
+    if snapshot is not None and snapshot.version == version:
+        return snapshot
+
+    with _build_locks[profile]:
+        snapshot = _local_snapshots.get(profile)
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+
+        key = _cache_key(profile, version)
+        timeout = getattr(settings, 'CATALOG_CACHE_TIMEOUT', 3600)
+        snapshot = cache.get(key)
+
+        if snapshot is None:
+            lock_key = key + ':building'
+            if cache.add(lock_key, 1, timeout=30):
+                try:
+                    snapshot = _build_snapshot(profile, version)
+                    cache.set(key, snapshot, timeout)
+                finally:
+                    cache.delete(lock_key)
+            else:
+                snapshot = _wait_for_shared_snapshot(key) or _build_snapshot(profile, version)
+
+        _local_snapshots[profile] = snapshot
+        return snapshot
+
+
+def yolo_characters(character_ids=None, nearby=None):
+    """
+    Configurazioni YOLO (dallo snapshot 'yolo') dei personaggi con gli id richiesti
+    e/o vicini a nearby = (lat, lon, radius)
+    """
+    with stage('catalog'), catalog_reads():
+        snapshot = get_snapshot('yolo')
+
+    items = snapshot.items
+    if character_ids is not None:
+        items = [snapshot.by_id[char_id] for char_id in character_ids if char_id in snapshot.by_id]
+    if nearby is not None:
+        queryset, _ = PROFILES['yolo']
+        candidates = queryset().only('id', 'target_latitude', 'target_longitude', 'activation_distance')
+        with stage('nearby'), catalog_reads():
+            nearby_ids = {char.id for char in filter_nearby(candidates, *nearby)}
+        items = [item for item in items if item['id'] in nearby_ids]
+    return items
+
+
+def catalog_for_request(request, profile, strict=False):
+    """
+    Personaggi del profilo per la richiesta, con il filtro ?lat=&lon=&radius= se presente.
+    Con strict=True i parametri non validi sollevano ValueError, altrimenti vengono ignorati.
+    Returns: (characters_json, count, etag)
+    """
+    with stage('catalog'), catalog_reads():
+        snapshot = get_snapshot(profile)
+
+    try:
+        nearby = parse_nearby_params(request.GET)
+    except ValueError:
+        if strict:
+            raise
+        nearby = None
+
+    if nearby is None:
+        return snapshot.json, len(snapshot.items), snapshot.etag
+
+    # Il filtro spaziale legge solo le colonne necessarie, i dati vengono dallo snapshot
+    queryset, _ = PROFILES[profile]
+    candidates = queryset().only('id', 'target_latitude', 'target_longitude', 'activation_distance')
+    with stage('nearby'), catalog_reads():
+        items = [
+            snapshot.by_id[char.id] for char in filter_nearby(candidates, *nearby)
+            if char.id in snapshot.by_id
+        ]
+
+    ids = ','.join(str(item['id']) for item in items)
+    digest = hashlib.md5(ids.encode(), usedforsecurity=False).hexdigest()[:16]
+    with stage('serialize'):
+        characters_json = json.dumps(items)
+    return characters_json, len(items), f'"catalog-{profile}-{snapshot.version}-{digest}"'
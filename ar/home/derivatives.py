@@ -0,0 +1,115 @@
+"""
+Varianti ridimensionate delle immagini di personaggi e marker.
+
+Dopo il salvataggio di un CharConfiguration un ImageVariantJob (home/jobs.py,
+eseguito da process_marker_jobs) genera versioni WebP/PNG più piccole
+dell'immagine personaggio e dei marker, più una versione grayscale a
+dimensione canonica dei marker (quella su cui il client esegue ORB se i
+features precalcolati non sono disponibili). I nomi dipendono dall'hash
+dell'immagine originale e dalla variante, quindi un'immagine già vista non
+viene rielaborata. I nomi generati sono salvati in CharConfiguration.image_variants
+e il catalogo serializzato espone gli URL (``<campo>_variants``).
+"""
+import hashlib
+import io
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+from .storage import content_hash_from_name
+
+# Lato massimo della variante grayscale dei marker
+MARKER_CANONICAL_SIZE = 640
+
+# variante -> (lato massimo, formato, modalità PIL o None per mantenere RGB/RGBA)
+CHARACTER_VARIANTS = {
+    'webp_256': (256, 'WEBP', None),
+    'webp_512': (512, 'WEBP', None),
+    'png_512': (512, 'PNG', None),
+}
+MARKER_VARIANTS = {
+    'webp_512': (512, 'WEBP', None),
+    'gray': (MARKER_CANONICAL_SIZE, 'PNG', 'L'),
+}
+
+IMAGE_VARIANTS = {
+    'character_image': CHARACTER_VARIANTS,
+    'marker_image': MARKER_VARIANTS,
+    'positioning_marker_image': MARKER_VARIANTS,
+}
+
+_EXTENSIONS = {'WEBP': 'webp', 'PNG': 'png'}
+
+
+def variant_name(content_hash, variant, size, image_format):
+    return f'variants/{content_hash[:2]}/{content_hash}-{variant}-{size}.{_EXTENSIONS[image_format]}'
+
+
+def _render_variant(image, size, image_format, mode):
+    if mode is not None:
+        image = image.convert(mode)
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.mode in ('LA', 'PA') or 'transparency' in image.info else 'RGB')
+
+    # Solo riduzioni: le immagini piccole restano alla dimensione originale
+    image = image.copy()
+    image.thumbnail((size, size), Image.LANCZOS)
+
+    output = io.BytesIO()
+    if image_format == 'WEBP':
+        image.save(output, 'WEBP', quality=80, method=4)
+    else:
+        image.save(output, 'PNG', optimize=True)
+    return output.getvalue()
+
+
+def generate_variants(image_field, variants):
+    """
+    Genera (se mancanti) le varianti di un ImageField.
+    Returns: dict variante -> nome del file nello storage
+    """
+    image_field.open('rb')
+    try:
+        image_data = image_field.read()
+    finally:
+        image_field.close()
+
+    content_hash = content_hash_from_name(image_field.name) or hashlib.sha256(image_data).hexdigest()
+
+    image = None
+    names = {}
+    for variant, (size, image_format, mode) in variants.items():
+        name = variant_name(content_hash, variant, size, image_format)
+        if not default_storage.exists(name):
+            if image is None:
+                image = Image.open(io.BytesIO(image_data))
+                # Le foto dello scanner possono avere l'orientamento solo nell'EXIF
+                image = ImageOps.exif_transpose(image)
+            name = default_storage.save(name, ContentFile(_render_variant(image, size, image_format, mode)))
+        names[variant] = name
+    return names
+
+
+def build_image_variants(character, field_names, current=None):
+    """
+    Aggiorna il dict image_variants per i campi indicati (campo vuoto = varianti rimosse).
+    Un errore su un'immagine lascia il campo senza varianti: il client usa l'originale
+    """
+    image_variants = dict(current or {})
+    for field_name in field_names:
+        image_field = getattr(character, field_name)
+        image_variants.pop(field_name, None)
+        if not image_field:
+            continue
+        try:
+            image_variants[field_name] = generate_variants(image_field, IMAGE_VARIANTS[field_name])
+        except Exception as e:
+            print(f"Error generating variants for {character} {field_name}: {e}")
+    return image_variants
+
+
+def variant_urls(char, field_name):
+    """URL delle varianti di un campo immagine per il catalogo serializzato"""
+    names = (char.image_variants or {}).get(field_name) or {}
+    return {variant: default_storage.url(name) for variant, name in names.items()}
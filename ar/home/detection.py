@@ -0,0 +1,618 @@
+"""
+Pipeline di /api/yolo-detect/: lettura della richiesta, decode del frame,
+inferenza e post-processing delle detections.
+
+Il frame può arrivare come:
+- corpo binario (Content-Type image/jpeg, image/png, application/octet-stream)
+  con i parametri in query string o negli header X-Object-Class / X-Confidence-Threshold
+- multipart/form-data con il file nel campo "image"
+- JSON con data URL base64 nel campo "image" (formato storico)
+
+Con il parametro session la richiesta usa la modalità detect-then-track
+(home/tracking.py): YOLO solo ogni YOLO_TRACK_REDETECT_FRAMES frame della sessione.
+
+I JPEG molto più grandi dell'input del modello (image_size) vengono decodificati
+già ridotti nel dominio DCT (IMREAD_REDUCED_*), e con roi=x,y,w,h (centro e
+dimensioni in pixel del frame, come i bbox delle detections) l'inferenza gira
+solo sul ritaglio. Le coordinate restituite sono sempre quelle del frame inviato.
+
+/api/yolo-detect/characters/ riceve id di personaggi (o una posizione) invece di
+classe e soglia: una sola inferenza sull'unione delle classi dei personaggi, poi
+ogni personaggio riceve le detections della propria classe sopra la propria soglia.
+"""
+import asyncio
+import base64
+import json
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .inference import get_yolo_model, get_inference_scheduler, get_inference_executor
+from .frame_cache import get_frame_cache
+from .geo import parse_nearby_params
+from .metrics import inc, stage
+from .tracking import ClassTracks, get_tracker_cache
+from .uploads import read_image_header
+
+DEFAULT_OBJECT_CLASS = 'bottle'
+DEFAULT_CONFIDENCE_THRESHOLD = 0.5
+
+RAW_IMAGE_CONTENT_TYPES = ('image/jpeg', 'image/png', 'image/webp', 'application/octet-stream')
+
+# Lati di input accettati per image_size (multipli di 32, lo stride di YOLOv8)
+MIN_IMAGE_SIZE = 128
+MAX_IMAGE_SIZE = 1280
+
+# Personaggi per richiesta di /api/yolo-detect/characters/
+MAX_BATCH_CHARACTERS = 50
+
+# Fattore di riduzione del decode JPEG -> flag OpenCV (dal più forte)
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+
+class DetectionRequestError(ValueError):
+    """Richiesta di detection non valida (risposta 400)"""
+
+
+def _header_name(name):
+    return 'X-' + name.replace('_', '-').title()
+
+
+def read_detection_request(request):
+    """
+    Estrae il buffer dell'immagine e i parametri dalla richiesta.
+    Returns: (image_buffer, params) dove params è un dict-like
+    Raises: DetectionRequestError
+    """
+    content_type = request.content_type or ''
+
+    if content_type in RAW_IMAGE_CONTENT_TYPES:
+        # Corpo binario: nessuna copia oltre a request.body
+        image_buffer = request.body
+        params = {}
+    elif content_type == 'multipart/form-data':
+        upload = request.FILES.get('image')
+        image_buffer = upload.read() if upload else None
+        params = request.POST
+    else:
+        try:
+            params = json.loads(request.body)
+        except ValueError:
+            raise DetectionRequestError('Invalid JSON body')
+        if not isinstance(params, dict):
+            raise DetectionRequestError('JSON body must be an object')
+
+        image_b64 = params.get('image')
+        image_buffer = None
+        if image_b64:
+            # Decodifica immagine base64
+            if ',' in image_b64:
+                image_b64 = image_b64.split(',')[1]
+            with stage('base64'):
+                image_buffer = base64.b64decode(image_b64)
+
+    if not image_buffer:
+        raise DetectionRequestError('Missing image data')
+
+    return image_buffer, params
+
+
+def get_detection_param(request, params, name, default=None):
+    """Parametro dal body (JSON/form), poi dalla query string, poi dall'header X-<Name>"""
+    value = params.get(name)
+    if value in (None, ''):
+        value = request.GET.get(name)
+    if value in (None, ''):
+        value = request.headers.get(_header_name(name))
+    return default if value in (None, '') else value
+
+
+def read_detection_params(request, params):
+    """
+    Returns: (object_class, confidence_threshold)
+    Raises: DetectionRequestError
+    """
+    object_class = get_detection_param(request, params, 'object_class', DEFAULT_OBJECT_CLASS)
+    try:
+        confidence_threshold = float(get_detection_param(
+            request, params, 'confidence_threshold', DEFAULT_CONFIDENCE_THRESHOLD
+        ))
+    except (TypeError, ValueError):
+        raise DetectionRequestError('Invalid confidence_threshold')
+    return object_class, confidence_threshold
+
+
+def read_tracking_session(request, params):
+    """
+    Returns: id di sessione per la modalità detect-then-track, None senza tracking
+    Raises: DetectionRequestError
+    """
+    session = get_detection_param(request, params, 'session')
+    if session is not None and len(session) > 64:
+        raise DetectionRequestError('Invalid session')
+    return session
+
+
+def read_image_size(request, params, default=None):
+    """
+    Lato dell'input del modello (image_size, di solito CharConfiguration.yolo_image_size)
+    Raises: DetectionRequestError
+    """
+    value = get_detection_param(request, params, 'image_size')
+    if value is None:
+        return default or getattr(settings, 'YOLO_IMAGE_SIZE', 640)
+    try:
+        image_size = int(value)
+    except (TypeError, ValueError):
+        raise DetectionRequestError('Invalid image_size')
+    if image_size % 32 or not MIN_IMAGE_SIZE <= image_size <= MAX_IMAGE_SIZE:
+        raise DetectionRequestError(f'image_size must be a multiple of 32 between {MIN_IMAGE_SIZE} and {MAX_IMAGE_SIZE}')
+    return image_size
+
+
+def read_character_ids(request, params):
+    """
+    Id dei personaggi: "1,2,3" o lista JSON
+    Returns: lista di id oppure None se il parametro manca
+    Raises: DetectionRequestError
+    """
+    value = get_detection_param(request, params, 'characters')
+    if value is None:
+        return None
+    try:
+        if isinstance(value, str):
+            value = [v for v in value.split(',') if v.strip()]
+        character_ids = list(dict.fromkeys(int(v) for v in value))
+    except (TypeError, ValueError):
+        raise DetectionRequestError('Invalid characters')
+    if not character_ids or len(character_ids) > MAX_BATCH_CHARACTERS:
+        raise DetectionRequestError(f'characters must list between 1 and {MAX_BATCH_CHARACTERS} ids')
+    return character_ids
+
+
+def read_character_selection(request, params):
+    """
+    Personaggi di /api/yolo-detect/characters/: id e/o posizione (lat/lon/radius in query string)
+    Returns: (character_ids, nearby)
+    Raises: DetectionRequestError
+    """
+    character_ids = read_character_ids(request, params)
+    try:
+        nearby = parse_nearby_params(request.GET)
+    except ValueError as e:
+        raise DetectionRequestError(str(e))
+    if character_ids is None and nearby is None:
+        raise DetectionRequestError('Missing characters or lat/lon')
+    return character_ids, nearby
+
+
+def batch_image_size(request, params, characters):
+    """image_size della richiesta, altrimenti il più grande tra quelli dei personaggi"""
+    default = max((char.get('yolo_image_size') or 0 for char in characters), default=0)
+    return read_image_size(request, params, default)
+
+
+def read_detection_roi(request, params):
+    """
+    Regione di interesse: "x,y,w,h", lista o dict come il bbox delle detections
+    Returns: (x, y, w, h) oppure None
+    Raises: DetectionRequestError
+    """
+    value = get_detection_param(request, params, 'roi')
+    if value is None:
+        return None
+    try:
+        if isinstance(value, dict):
+            value = [value['x'], value['y'], value['w'], value['h']]
+        elif isinstance(value, str):
+            value = value.split(',')
+        x, y, w, h = (float(v) for v in value)
+    except (KeyError, TypeError, ValueError):
+        raise DetectionRequestError('Invalid roi')
+    if not (w > 0 and h > 0):
+        raise DetectionRequestError('Invalid roi')
+    return x, y, w, h
+
+
+def _reduction_factor(image_buffer, region_size, target_size):
+    """Riduzione massima del decode JPEG che lascia la regione almeno target_size sul lato lungo"""
+    if not target_size or bytes(image_buffer[:3]) != b'\xff\xd8\xff':
+        return 1
+    try:
+        header = read_image_header(image_buffer)
+    except ValueError:
+        return 1
+    if header is None:
+        return 1
+
+    _, width, height = header
+    long_side = max(region_size) if region_size else max(width, height)
+    for factor, _ in REDUCED_DECODE_FLAGS:
+        if long_side / factor >= target_size:
+            return factor
+    return 1
+
+
+def frame_cache_for(request, session, key):
+    """
+    Cache dei frame quasi identici per la richiesta: (cache, sessione, chiave) oppure None.
+    La sessione è il parametro session o, in mancanza, il cookie di sessione Django
+    """
+    frame_cache = get_frame_cache()
+    scope = session or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if frame_cache is None or not scope:
+        return None
+    return frame_cache, scope, key
+
+
+def decode_frame(image_buffer, target_size=None, roi=None):
+    """
+    Decodifica JPEG/PNG direttamente dal buffer della richiesta.
+    Con target_size i JPEG vengono decodificati ridotti (1/2, 1/4, 1/8) finché la
+    regione resta almeno target_size; con roi restituisce solo il ritaglio.
+    Returns: (img, transform) con transform = (scala, offset x, offset y) da passare
+    a to_frame_coordinates
+    Raises: DetectionRequestError
+    """
+    factor = _reduction_factor(image_buffer, roi[2:] if roi else None, target_size)
+    flags = dict(REDUCED_DECODE_FLAGS).get(factor, cv2.IMREAD_COLOR)
+
+    nparr = np.frombuffer(image_buffer, np.uint8)
+    img = cv2.imdecode(nparr, flags)
+    if img is None:
+        raise DetectionRequestError('Failed to decode image')
+
+    if roi is None:
+        return img, (factor, 0, 0)
+
+    # Ritaglio nelle coordinate del frame decodificato (vista, nessuna copia)
+    x, y, w, h = (value / factor for value in roi)
+    height, width = img.shape[:2]
+    x0, y0 = max(int(x - w / 2), 0), max(int(y - h / 2), 0)
+    x1, y1 = min(int(np.ceil(x + w / 2)), width), min(int(np.ceil(y + h / 2)), height)
+    if x1 - x0 < 8 or y1 - y0 < 8:
+        raise DetectionRequestError('roi outside the frame')
+    return img[y0:y1, x0:x1], (factor, x0, y0)
+
+
+def to_frame_coordinates(detections, transform):
+    """Riporta i bbox dal frame decodificato (ridotto e/o ritagliato) al frame inviato"""
+    scale, offset_x, offset_y = transform
+    if scale == 1 and not offset_x and not offset_y:
+        return detections
+    return [
+        {
+            **detection,
+            'bbox': {
+                'x': (detection['bbox']['x'] + offset_x) * scale,
+                'y': (detection['bbox']['y'] + offset_y) * scale,
+                'w': detection['bbox']['w'] * scale,
+                'h': detection['bbox']['h'] * scale,
+            }
+        }
+        for detection in detections
+    ]
+
+
+# id(model) -> {nome classe: indice}, calcolato una volta per modello caricato
+_class_index = {}
+
+
+def resolve_class_ids(model, class_names):
+    """Converte nomi classe COCO negli indici del modello (ignora i nomi sconosciuti)"""
+    index = _class_index.get(id(model))
+    if index is None:
+        index = {name: cls_id for cls_id, name in model.names.items()}
+        _class_index[id(model)] = index
+    return sorted({index[name] for name in class_names if name in index})
+
+
+def _to_numpy(values):
+    # ultralytics restituisce tensori torch, i backend esportati array numpy
+    if hasattr(values, 'cpu'):
+        values = values.cpu().numpy()
+    return np.asarray(values)
+
+
+def extract_detections(result, class_ids, confidence_threshold):
+    """
+    Converte un Result nella lista di detections delle classi richieste,
+    con una sola conversione ad array invece di indicizzare box per box
+    """
+    if result is None or result.boxes is None or len(result.boxes) == 0:
+        return []
+
+    boxes = result.boxes
+    cls = _to_numpy(boxes.cls).astype(np.int64)
+    conf = _to_numpy(boxes.conf)
+    xywh = _to_numpy(boxes.xywh)  # center format
+
+    # Il batch usa soglia minima e unione delle classi: rifiltra con i nostri parametri
+    keep = np.isin(cls, class_ids) & (conf >= confidence_threshold)
+
+    names = result.names
+    return [
+        {
+            'class': names[cls_id],
+            'confidence': confidence,
+            'bbox': {'x': x, 'y': y, 'w': w, 'h': h}
+        }
+        for cls_id, confidence, (x, y, w, h) in zip(
+            cls[keep].tolist(), conf[keep].tolist(), xywh[keep].tolist()
+        )
+    ]
+
+
+def detect_objects(img, object_class, confidence_threshold, image_size=None):
+    """
+    Esegue YOLO sul frame e restituisce le detections della classe richiesta.
+    La NMS considera solo quella classe; una classe sconosciuta non esegue inferenza
+    """
+    class_ids = resolve_class_ids(get_yolo_model(), [object_class])
+    if not class_ids:
+        return []
+
+    # Esegui detection (batch condiviso con le richieste concorrenti)
+    with stage('inference'):
+        result = get_inference_scheduler().infer(img, confidence_threshold, classes=class_ids, imgsz=image_size)
+    with stage('postprocess'):
+        return extract_detections(result, class_ids, confidence_threshold)
+
+
+async def detect_objects_async(img, object_class, confidence_threshold, image_size=None):
+    """
+    Come detect_objects, ma attende il batch senza occupare un thread;
+    il post-processing gira nell'executor di inferenza
+    """
+    class_ids = resolve_class_ids(get_yolo_model(), [object_class])
+    if not class_ids:
+        return []
+
+    with stage('inference'):
+        future = get_inference_scheduler().submit(img, confidence_threshold, classes=class_ids, imgsz=image_size)
+        result = await asyncio.wrap_future(future)
+
+    loop = asyncio.get_running_loop()
+    with stage('postprocess'):
+        return await loop.run_in_executor(
+            get_inference_executor(), extract_detections, result, class_ids, confidence_threshold
+        )
+
+
+def _character_targets(model, characters):
+    # id personaggio -> (classe, indici della classe nel modello, soglia)
+    return {
+        char['id']: (
+            char['yolo_object_class'],
+            resolve_class_ids(model, [char['yolo_object_class']]),
+            char['yolo_confidence_threshold'] or DEFAULT_CONFIDENCE_THRESHOLD,
+        )
+        for char in characters
+    }
+
+
+def _split_detections(detections, targets):
+    return {
+        char_id: [d for d in detections if d['class'] == object_class and d['confidence'] >= threshold]
+        for char_id, (object_class, _, threshold) in targets.items()
+    }
+
+
+def _class_thresholds(targets):
+    # classe -> soglia più bassa tra i personaggi di quella classe (solo classi note al modello)
+    thresholds = {}
+    for object_class, class_ids, threshold in targets.values():
+        if class_ids:
+            thresholds[object_class] = min(threshold, thresholds.get(object_class, threshold))
+    return thresholds
+
+
+def _detect_union(img, targets, image_size=None):
+    """Detections dell'unione delle classi dei personaggi, con la soglia più bassa"""
+    class_ids = sorted(set().union(*(ids for _, ids, _ in targets.values())))
+    if not class_ids:
+        return []
+    min_threshold = min(_class_thresholds(targets).values())
+
+    with stage('inference'):
+        result = get_inference_scheduler().infer(img, min_threshold, classes=class_ids, imgsz=image_size)
+    with stage('postprocess'):
+        return extract_detections(result, class_ids, min_threshold)
+
+
+async def _detect_union_async(img, targets, image_size=None):
+    class_ids = sorted(set().union(*(ids for _, ids, _ in targets.values())))
+    if not class_ids:
+        return []
+    min_threshold = min(_class_thresholds(targets).values())
+
+    with stage('inference'):
+        future = get_inference_scheduler().submit(img, min_threshold, classes=class_ids, imgsz=image_size)
+        result = await asyncio.wrap_future(future)
+
+    loop = asyncio.get_running_loop()
+    with stage('postprocess'):
+        return await loop.run_in_executor(
+            get_inference_executor(), extract_detections, result, class_ids, min_threshold
+        )
+
+
+def detect_characters(img, characters, image_size=None):
+    """
+    Un solo forward pass per più personaggi (dict dello snapshot 'yolo'): NMS sull'unione
+    delle classi con la soglia più bassa, poi filtro per classe e soglia di ciascuno.
+    Returns: {id personaggio: detections}
+    """
+    targets = _character_targets(get_yolo_model(), characters)
+    return _split_detections(_detect_union(img, targets, image_size), targets)
+
+
+async def detect_characters_async(img, characters, image_size=None):
+    """Come detect_characters, con il post-processing nell'executor di inferenza"""
+    targets = _character_targets(get_yolo_model(), characters)
+    return _split_detections(await _detect_union_async(img, targets, image_size), targets)
+
+
+def cached_detect(img, object_class, confidence_threshold, image_size=None, cache=None):
+    """
+    detect_objects, ma un frame quasi identico a uno recente riceve il risultato in cache
+    cache: da frame_cache_for (None = sempre inferenza)
+    Returns: (detections, mode) con mode 'cache' o 'detect'
+    """
+    if cache is not None:
+        frame_cache, scope, key = cache
+        with stage('cache'):
+            img_hash, cached = frame_cache.lookup(scope, key, img)
+        if cached is not None:
+            return cached, 'cache'
+
+    detections = detect_objects(img, object_class, confidence_threshold, image_size)
+    if cache is not None:
+        frame_cache.store(scope, key, img_hash, detections)
+    return detections, 'detect'
+
+
+async def cached_detect_async(img, object_class, confidence_threshold, image_size=None, cache=None):
+    """Come cached_detect, con l'hash del frame nell'executor di inferenza"""
+    if cache is not None:
+        frame_cache, scope, key = cache
+        loop = asyncio.get_running_loop()
+        with stage('cache'):
+            img_hash, cached = await loop.run_in_executor(get_inference_executor(), frame_cache.lookup, scope, key, img)
+        if cached is not None:
+            return cached, 'cache'
+
+    detections = await detect_objects_async(img, object_class, confidence_threshold, image_size)
+    if cache is not None:
+        frame_cache.store(scope, key, img_hash, detections)
+    return detections, 'detect'
+
+
+def _tracker_key(session, object_class):
+    return f'{session}:{object_class}'
+
+
+def _track(img, object_class, session):
+    """Detections della classe seguite dai tracker della sessione, None se serve rieseguire YOLO"""
+    trackers = get_tracker_cache()
+    key = _tracker_key(session, object_class)
+    tracker = trackers.get(key)
+    if tracker is None:
+        return None
+    if tracker.frames >= getattr(settings, 'YOLO_TRACK_REDETECT_FRAMES', 15):
+        inc('ar_yolo_track_total', result='redetect')
+        return None
+
+    detections = tracker.update(img)
+    if detections is None:
+        trackers.pop(key)
+        inc('ar_yolo_track_total', result='lost')
+        return None
+    inc('ar_yolo_track_total', result='tracked')
+    return detections
+
+
+def _start_tracking(img, object_class, session, detections):
+    # Un tracker per ogni oggetto della classe: più personaggi possono ancorarsi alla stessa classe
+    trackers = get_tracker_cache()
+    key = _tracker_key(session, object_class)
+    if detections:
+        trackers.set(key, ClassTracks(img, detections))
+    else:
+        trackers.pop(key)
+
+
+def track_or_detect(img, object_class, confidence_threshold, session, image_size=None, cache=None):
+    """
+    Modalità detect-then-track: segue gli oggetti dell'ultima detection della sessione
+    e riesegue YOLO solo ogni YOLO_TRACK_REDETECT_FRAMES frame o se il tracking si perde.
+    La cache dei frame sostituisce solo YOLO: il tracker vede sempre ogni frame e riparte
+    dalla detection in cache sul frame corrente
+    Returns: (detections, mode) con mode 'track', 'cache' o 'detect'
+    """
+    with stage('track'):
+        tracked = _track(img, object_class, session)
+    if tracked is not None:
+        return tracked, 'track'
+
+    detections, mode = cached_detect(img, object_class, confidence_threshold, image_size, cache)
+    with stage('track'):
+        _start_tracking(img, object_class, session, detections)
+    return detections, mode
+
+
+async def track_or_detect_async(img, object_class, confidence_threshold, session, image_size=None, cache=None):
+    """Come track_or_detect, con il tracking nell'executor di inferenza"""
+    loop = asyncio.get_running_loop()
+    executor = get_inference_executor()
+    with stage('track'):
+        tracked = await loop.run_in_executor(executor, _track, img, object_class, session)
+    if tracked is not None:
+        return tracked, 'track'
+
+    detections, mode = await cached_detect_async(img, object_class, confidence_threshold, image_size, cache)
+    with stage('track'):
+        await loop.run_in_executor(executor, _start_tracking, img, object_class, session, detections)
+    return detections, mode
+
+
+def _track_characters(img, thresholds, session):
+    """Detections di tutte le classi seguite dai tracker, None se almeno una va rilevata di nuovo"""
+    detections = []
+    for object_class in thresholds:
+        tracked = _track(img, object_class, session)
+        if tracked is None:
+            return None
+        detections.extend(tracked)
+    return detections
+
+
+def _start_tracking_characters(img, thresholds, session, detections):
+    for object_class, threshold in thresholds.items():
+        _start_tracking(img, object_class, session, [
+            d for d in detections if d['class'] == object_class and d['confidence'] >= threshold
+        ])
+
+
+def track_or_detect_characters(img, characters, session, image_size=None):
+    """
+    detect-then-track per più personaggi in una richiesta: gli stessi tracker per classe
+    di track_or_detect; YOLO (un forward pass sull'unione delle classi) viene rieseguito
+    se una delle classi va rilevata di nuovo
+    Returns: ({id personaggio: detections}, mode) con mode 'track' o 'detect'
+    """
+    targets = _character_targets(get_yolo_model(), characters)
+    thresholds = _class_thresholds(targets)
+    if thresholds:
+        with stage('track'):
+            tracked = _track_characters(img, thresholds, session)
+        if tracked is not None:
+            return _split_detections(tracked, targets), 'track'
+
+    detections = _detect_union(img, targets, image_size)
+    with stage('track'):
+        _start_tracking_characters(img, thresholds, session, detections)
+    return _split_detections(detections, targets), 'detect'
+
+
+async def track_or_detect_characters_async(img, characters, session, image_size=None):
+    """Come track_or_detect_characters, con il tracking nell'executor di inferenza"""
+    loop = asyncio.get_running_loop()
+    executor = get_inference_executor()
+    targets = _character_targets(get_yolo_model(), characters)
+    thresholds = _class_thresholds(targets)
+    if thresholds:
+        with stage('track'):
+            tracked = await loop.run_in_executor(executor, _track_characters, img, thresholds, session)
+        if tracked is not None:
+            return _split_detections(tracked, targets), 'track'
+
+    detections = await _detect_union_async(img, targets, image_size)
+    with stage('track'):
+        await loop.run_in_executor(executor, _start_tracking_characters, img, thresholds, session, detections)
+    return _split_detections(detections, targets), 'detect'
@@ -0,0 +1,96 @@
+"""
+Estrazione e serializzazione dei features ORB dei marker.
+
+Formato binario (little-endian) servito da /api/marker-features/:
+
+    header   20 byte   magic 'ORB1', uint16 versione, uint16 byte per descriptor,
+                       uint32 numero keypoints N, uint32 larghezza, uint32 altezza
+    points   N*2 float32   coordinate (x, y) dei keypoints nell'immagine marker
+    desc     N*32 uint8    descriptors ORB
+
+L'header è lungo un multiplo di 4, quindi il client può leggere i punti con un
+Float32Array direttamente sul buffer scaricato.
+"""
+import io
+import struct
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from .metrics import stage, timed_operation
+
+MARKER_FEATURES_MAGIC = b'ORB1'
+MARKER_FEATURES_VERSION = 1
+ORB_DESCRIPTOR_SIZE = 32
+
+_HEADER = struct.Struct('<4sHHIII')
+
+
+def detect_orb_features(image_data, nfeatures=500):
+    """
+    Estrae keypoints e descriptors ORB dai byte di un'immagine
+    Returns: (points float32 Nx2, descriptors uint8 Nx32, width, height)
+    """
+    with timed_operation('feature_extraction'):
+        with stage('decode'):
+            pil_image = Image.open(io.BytesIO(image_data))
+            img_array = np.array(pil_image.convert('RGB'))
+            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+
+        with stage('orb'):
+            orb = cv2.ORB_create(nfeatures)
+            keypoints, descriptors = orb.detectAndCompute(gray, None)
+
+    height, width = gray.shape
+    if not keypoints or descriptors is None:
+        return (
+            np.empty((0, 2), dtype=np.float32),
+            np.empty((0, ORB_DESCRIPTOR_SIZE), dtype=np.uint8),
+            width,
+            height,
+        )
+
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32)
+    return points, descriptors.astype(np.uint8, copy=False), width, height
+
+
+def pack_orb_features(points, descriptors, width, height):
+    """Serializza keypoints e descriptors nel formato binario compatto"""
+    count = len(points)
+    header = _HEADER.pack(
+        MARKER_FEATURES_MAGIC, MARKER_FEATURES_VERSION, ORB_DESCRIPTOR_SIZE,
+        count, width, height
+    )
+    return b''.join([
+        header,
+        np.ascontiguousarray(points, dtype='<f4').tobytes(),
+        np.ascontiguousarray(descriptors, dtype=np.uint8).tobytes(),
+    ])
+
+
+def unpack_orb_features(blob):
+    """
+    Decodifica un blob prodotto da pack_orb_features
+    Returns: (points, descriptors, width, height) senza copiare i dati
+    Raises: ValueError se header o lunghezza non sono validi
+    """
+    blob = memoryview(blob)
+    if len(blob) < _HEADER.size:
+        raise ValueError('Truncated marker features blob')
+    magic, version, descriptor_size, count, width, height = _HEADER.unpack_from(blob)
+    if magic != MARKER_FEATURES_MAGIC or version != MARKER_FEATURES_VERSION:
+        raise ValueError('Unsupported marker features blob')
+    # Indice e matching lavorano su descriptors ORB da 256 bit
+    if descriptor_size != ORB_DESCRIPTOR_SIZE:
+        raise ValueError('Unsupported descriptor size')
+    if len(blob) != _HEADER.size + count * (2 * 4 + descriptor_size):
+        raise ValueError('Marker features blob length does not match the header')
+
+    offset = _HEADER.size
+    points = np.frombuffer(blob, dtype='<f4', count=count * 2, offset=offset).reshape(count, 2)
+    offset += points.nbytes
+    descriptors = np.frombuffer(
+        blob, dtype=np.uint8, count=count * descriptor_size, offset=offset
+    ).reshape(count, descriptor_size)
+    return points, descriptors, width, height
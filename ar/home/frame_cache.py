@@ -0,0 +1,110 @@
+"""
+Cache dei risultati di /api/yolo-detect/ per frame quasi identici.
+
+Con il telefono fermo davanti all'oggetto i frame consecutivi sono quasi uguali:
+invece di rieseguire l'inferenza si restituisce il risultato dell'ultimo frame
+simile della stessa sessione. La somiglianza è la distanza di Hamming tra i
+perceptual hash (dHash a 64 bit) dei frame decodificati; il risultato vale solo
+per gli stessi parametri (classe, soglia, image_size, roi) e scade dopo
+YOLO_FRAME_CACHE_TTL secondi, così un cambiamento lento della scena non resta
+nascosto a lungo.
+
+ar_yolo_frame_cache_total conta hit e miss, ar_yolo_frame_cache_distance la
+distanza dal frame in cache più vicino: servono per scegliere
+YOLO_FRAME_CACHE_MAX_DISTANCE.
+"""
+import threading
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .metrics import inc, observe
+from .session_cache import SessionCache
+
+HASH_SIZE = 8
+
+
+def frame_hash(img):
+    """dHash a 64 bit: gradiente orizzontale dei livelli di grigio su una griglia 9x8"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    height, width = gray.shape
+    if width >= 4 * (HASH_SIZE + 1) and height >= 4 * HASH_SIZE:
+        # Prima riduzione a fattore intero (percorso veloce di INTER_AREA)
+        gray = cv2.resize(gray, (width // 4, height // 4), interpolation=cv2.INTER_AREA)
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+class FrameResultCache:
+    """
+    Ultimi entries_per_session risultati di ogni sessione, con sessioni in una
+    SessionCache (LRU con scadenza)
+    """
+
+    def __init__(self, max_sessions=1000, ttl=2, max_distance=4, entries_per_session=4):
+        self.ttl = float(ttl)
+        self.max_distance = int(max_distance)
+        self.entries_per_session = max(1, int(entries_per_session))
+        self._sessions = SessionCache(max_entries=max_sessions, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def lookup(self, session, key, img):
+        """
+        Returns: (hash del frame, risultato in cache oppure None)
+        """
+        img_hash = frame_hash(img)
+        entries = self._sessions.get(session)
+
+        now = time.monotonic()
+        best_distance, best_result = None, None
+        if entries is not None:
+            with self._lock:
+                for expires, entry_hash, entry_key, result in entries:
+                    if entry_key != key or expires < now:
+                        continue
+                    distance = (entry_hash ^ img_hash).bit_count()
+                    if best_distance is None or distance < best_distance:
+                        best_distance, best_result = distance, result
+
+        if best_distance is not None:
+            observe('ar_yolo_frame_cache_distance', best_distance)
+        if best_distance is not None and best_distance <= self.max_distance:
+            inc('ar_yolo_frame_cache_total', result='hit')
+            return img_hash, best_result
+        inc('ar_yolo_frame_cache_total', result='miss')
+        return img_hash, None
+
+    def store(self, session, key, img_hash, result):
+        entries = self._sessions.get(session)
+        if entries is None:
+            entries = deque(maxlen=self.entries_per_session)
+            self._sessions.set(session, entries)
+        with self._lock:
+            entries.append((time.monotonic() + self.ttl, img_hash, key, result))
+
+
+_frame_cache = None
+_frame_cache_lock = threading.Lock()
+
+
+def get_frame_cache():
+    """
+    Cache del processo (YOLO_FRAME_CACHE_*), None se disattivata (YOLO_FRAME_CACHE_TTL = 0)
+    """
+    global _frame_cache
+    if not getattr(settings, 'YOLO_FRAME_CACHE_TTL', 2):
+        return None
+    if _frame_cache is None:
+        with _frame_cache_lock:
+            if _frame_cache is None:
+                _frame_cache = FrameResultCache(
+                    max_sessions=getattr(settings, 'YOLO_FRAME_CACHE_MAX_SESSIONS', 1000),
+                    ttl=getattr(settings, 'YOLO_FRAME_CACHE_TTL', 2),
+                    max_distance=getattr(settings, 'YOLO_FRAME_CACHE_MAX_DISTANCE', 4),
+                    entries_per_session=getattr(settings, 'YOLO_FRAME_CACHE_ENTRIES', 4),
+                )
+    return _frame_cache
@@ -0,0 +1,127 @@
+"""
+Indice spaziale a griglia per i CharConfiguration.
+
+Ogni personaggio salva la cella di una griglia regolare in gradi
+(``geo_cell``, indicizzata nel DB). Una query "vicini" calcola le celle che
+coprono il raggio di ricerca più la massima activation_distance e filtra con
+``geo_cell__in``, poi applica la distanza esatta solo ai pochi candidati.
+"""
+import math
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE = 111320
+
+# ~1.1 km di latitudine per cella
+GEO_CELL_SIZE_DEG = 0.01
+
+# Deve coincidere con il MaxValueValidator di activation_distance
+MAX_ACTIVATION_DISTANCE = 1000
+
+# Limiti del parametro radius per /api/characters/
+DEFAULT_NEARBY_RADIUS = 0
+MAX_NEARBY_RADIUS = 5000
+
+# Oltre questo numero di celle (vicino ai poli) si usa solo il bounding box
+MAX_QUERY_CELLS = 400
+
+_LON_CELLS = int(round(360 / GEO_CELL_SIZE_DEG))
+
+
+def _lat_index(lat):
+    return int(math.floor((lat + 90) / GEO_CELL_SIZE_DEG))
+
+
+def _lon_index(lon):
+    return int(math.floor((lon + 180) / GEO_CELL_SIZE_DEG)) % _LON_CELLS
+
+
+def geo_cell_for(lat, lon):
+    """Chiave della cella che contiene (lat, lon), es. '13489:1925'"""
+    return f"{_lat_index(lat)}:{_lon_index(lon)}"
+
+
+def haversine_distance(lat1, lon1, lat2, lon2):
+    """Distanza in metri tra due coordinate (stessa formula di calculateDistance lato client)"""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dlambda = math.radians(lon2 - lon1)
+
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return EARTH_RADIUS_M * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def bounding_box(lat, lon, distance_m):
+    """
+    Bounding box (min_lat, max_lat, dlon) che contiene il cerchio di raggio distance_m
+    """
+    dlat = distance_m / METERS_PER_DEGREE
+    cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+    dlon = min(distance_m / (METERS_PER_DEGREE * cos_lat), 180)
+    return max(lat - dlat, -90), min(lat + dlat, 90), dlon
+
+
+def cells_around(lat, lon, distance_m):
+    """
+    Celle della griglia che coprono il cerchio di raggio distance_m.
+    Returns: lista di chiavi, oppure None se le celle sarebbero troppe
+    """
+    min_lat, max_lat, dlon = bounding_box(lat, lon, distance_m)
+
+    lat_range = range(_lat_index(min_lat), _lat_index(max_lat) + 1)
+    lon_start = _lon_index(lon - dlon)
+    lon_count = int(math.floor((lon + dlon + 180) / GEO_CELL_SIZE_DEG)) - \
+        int(math.floor((lon - dlon + 180) / GEO_CELL_SIZE_DEG)) + 1
+    lon_count = min(lon_count, _LON_CELLS)
+
+    if len(lat_range) * lon_count > MAX_QUERY_CELLS:
+        return None
+
+    lon_indexes = [(lon_start + i) % _LON_CELLS for i in range(lon_count)]
+    return [f"{lat_i}:{lon_i}" for lat_i in lat_range for lon_i in lon_indexes]
+
+
+def parse_nearby_params(params):
+    """
+    Legge lat/lon/radius da un QueryDict.
+    Returns: (lat, lon, radius) oppure None se lat/lon non sono presenti
+    Raises: ValueError se i parametri non sono validi
+    """
+    lat = params.get('lat')
+    lon = params.get('lon')
+    if lat in (None, '') and lon in (None, ''):
+        return None
+    if lat in (None, '') or lon in (None, ''):
+        raise ValueError('Both lat and lon are required')
+
+    lat = float(lat)
+    lon = float(lon)
+    radius = float(params.get('radius') or DEFAULT_NEARBY_RADIUS)
+
+    if not (-90 <= lat <= 90) or not (-180 <= lon <= 180):
+        raise ValueError('lat/lon out of range')
+    if not math.isfinite(radius) or radius < 0:
+        raise ValueError('radius must be a positive number')
+
+    return lat, lon, min(radius, MAX_NEARBY_RADIUS)
+
+
+def filter_nearby(queryset, lat, lon, radius=DEFAULT_NEARBY_RADIUS):
+    """
+    Restituisce i personaggi la cui activation_distance (più radius) raggiunge l'utente.
+    La query usa l'indice su geo_cell; la distanza esatta viene calcolata solo sui candidati.
+    """
+    reach = radius + MAX_ACTIVATION_DISTANCE
+    cells = cells_around(lat, lon, reach)
+
+    if cells is not None:
+        candidates = queryset.filter(geo_cell__in=cells)
+    else:
+        min_lat, max_lat, _ = bounding_box(lat, lon, reach)
+        candidates = queryset.filter(target_latitude__range=(min_lat, max_lat))
+
+    return [
+        char for char in candidates
+        if haversine_distance(lat, lon, char.target_latitude, char.target_longitude)
+        <= char.activation_distance + radius
+    ]
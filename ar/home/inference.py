@@ -0,0 +1,323 @@
+"""
+Caricamento del modello YOLO e scheduler di inferenza a micro-batch.
+
+Le richieste concorrenti (thread di gunicorn gthread o ASGI) non chiamano il
+modello direttamente: accodano il frame e un unico thread per processo
+raccoglie fino a YOLO_BATCH_MAX_SIZE frame, aspettando al massimo
+YOLO_BATCH_MAX_WAIT_MS dal primo, ed esegue un solo forward pass batched
+per ogni dimensione di input (imgsz) presente nel batch.
+"""
+import gc
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+
+from .metrics import observe, register_collector
+
+# YOLO model - caricato una sola volta per processo (o nel master gunicorn con preload)
+_yolo_model = None
+_yolo_model_lock = threading.Lock()
+
+# Stato del modello esposto da /api/health/
+_model_state = {
+    'status': 'not_loaded',  # not_loaded | ready | failed
+    'error': None,
+    'loaded_at': None,
+    'load_seconds': None,
+    'failed_at': None,
+    'warmup_runs': 0,
+}
+
+
+def _retry_due():
+    retry_after = getattr(settings, 'YOLO_LOAD_RETRY_SECONDS', 60)
+    failed_at = _model_state.get('failed_at') or 0
+    return time.time() - failed_at >= retry_after
+
+
+def get_yolo_model():
+    """Lazy loading del modello YOLO (un caricamento fallito viene ritentato dopo YOLO_LOAD_RETRY_SECONDS)"""
+    global _yolo_model
+    if _yolo_model is None or (_yolo_model is False and _retry_due()):
+        with _yolo_model_lock:
+            if _yolo_model is None or (_yolo_model is False and _retry_due()):
+                _yolo_model = _load_yolo_model()
+    return _yolo_model if _yolo_model is not False else None
+
+
+def _load_yolo_model():
+    started = time.monotonic()
+    backend = getattr(settings, 'YOLO_BACKEND', 'pytorch')
+    threads = getattr(settings, 'YOLO_INTRA_OP_THREADS', 0)
+    try:
+        if backend == 'pytorch':
+            model = _load_pytorch_model(threads)
+        else:
+            from .backends import load_exported_model
+            model = load_exported_model(backend, getattr(settings, 'YOLO_MODEL_PATH', None), threads)
+
+        _model_state.update(
+            status='ready', error=None, loaded_at=time.time(),
+            load_seconds=round(time.monotonic() - started, 3),
+        )
+        print(f"YOLO model loaded successfully ({backend})")
+        return model
+    except Exception as e:
+        _model_state.update(status='failed', error=str(e), failed_at=time.time())
+        print(f"Error loading YOLO model: {e}")
+        return False  # Segna come fallito, ritenta dopo YOLO_LOAD_RETRY_SECONDS
+
+
+def _load_pytorch_model(threads=0, weights='yolov8n.pt'):
+    # Workaround for PyTorch 2.10+ weights_only default change
+    # ultralytics uses torch.load internally, we need to allow legacy loading
+    import torch
+    original_load = torch.load
+    torch.load = lambda *args, **kwargs: original_load(*args, **{**kwargs, 'weights_only': False})
+
+    try:
+        from ultralytics import YOLO
+        model = YOLO(weights)  # Default: YOLOv8 nano (più leggero)
+    finally:
+        # Restore original torch.load
+        torch.load = original_load
+
+    # Limita i thread intra-op per worker (evita oversubscription con più worker gunicorn)
+    if threads:
+        torch.set_num_threads(threads)
+    return model
+
+
+def warm_up_model(model, runs=3, size=640):
+    """
+    Esegue qualche inferenza su frame finti per inizializzare kernel e buffer,
+    così la prima richiesta reale non paga il costo di avvio
+    """
+    import numpy as np
+
+    dummy = np.zeros((size, size, 3), dtype=np.uint8)
+    for _ in range(runs):
+        model(dummy, verbose=False)
+    _model_state['warmup_runs'] += runs
+
+
+def preload_yolo_model():
+    """
+    Carica i pesi nel master gunicorn prima del fork (hook when_ready di gunicorn.conf.py):
+    i worker li ereditano copy-on-write. Nessuna inferenza qui: i thread pool OpenMP/intra-op
+    avviati dal primo forward non sopravvivono al fork e bloccherebbero i worker.
+    Returns: True se il modello è caricato
+    """
+    if getattr(settings, 'YOLO_BACKEND', 'pytorch') != 'pytorch':
+        # Le sessioni ONNX Runtime/OpenVINO avviano i loro thread già alla creazione:
+        # il modello viene caricato in ogni worker da warm_up_yolo_model
+        return False
+
+    model = get_yolo_model()
+    if model is None:
+        return False
+
+    # Sposta gli oggetti caricati fuori dal GC: evita che le scansioni del
+    # garbage collector tocchino (e quindi copino) le pagine condivise dopo il fork
+    gc.collect()
+    gc.freeze()
+    return True
+
+
+def warm_up_yolo_model():
+    """
+    Carica (se serve) e scalda il modello nel worker appena creato (hook post_fork),
+    così la prima richiesta reale non paga il costo di avvio
+    Returns: True se il modello è pronto
+    """
+    model = get_yolo_model()
+    if model is None:
+        return False
+
+    threads = getattr(settings, 'YOLO_INTRA_OP_THREADS', 0)
+    if threads and getattr(settings, 'YOLO_BACKEND', 'pytorch') == 'pytorch':
+        # Thread pool del worker dimensionato prima del primo forward
+        import torch
+        torch.set_num_threads(threads)
+
+    try:
+        warm_up_model(
+            model,
+            runs=getattr(settings, 'YOLO_WARMUP_RUNS', 3),
+            size=getattr(settings, 'YOLO_WARMUP_IMAGE_SIZE', 640),
+        )
+    except Exception as e:
+        print(f"YOLO warm-up error: {e}")
+    return True
+
+
+def model_status():
+    """Stato del modello per l'health check"""
+    return {
+        'status': _model_state['status'],
+        'error': _model_state['error'],
+        'loaded_at': _model_state['loaded_at'],
+        'load_seconds': _model_state['load_seconds'],
+        'warmup_runs': _model_state['warmup_runs'],
+    }
+
+
+class _InferenceRequest:
+    __slots__ = ('image', 'conf', 'classes', 'imgsz', 'future')
+
+    def __init__(self, image, conf, classes=None, imgsz=None):
+        self.image = image
+        self.conf = conf
+        self.classes = classes
+        self.imgsz = imgsz
+        self.future = Future()
+
+
+class BatchInferenceScheduler:
+    """
+    Raccoglie i frame delle richieste concorrenti e li passa al modello in un unico batch.
+    Ogni chiamante riceve il proprio ultralytics Result tramite un Future.
+    """
+
+    def __init__(self, model_getter, max_batch_size=8, max_wait=0.01):
+        self.model_getter = model_getter
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait))
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, image, conf, classes=None, imgsz=None):
+        """
+        Accoda un frame BGR (numpy) e restituisce un Future con il Result.
+        classes: indici delle classi da considerare (None = tutte), passati alla NMS
+        imgsz: lato dell'input del modello (None = default del modello; i backend
+        esportati hanno una dimensione fissa e lo ignorano)
+        """
+        self._ensure_started()
+        request = _InferenceRequest(image, conf, classes, imgsz)
+        self._queue.put(request)
+        return request.future
+
+    def infer(self, image, conf, classes=None, imgsz=None, timeout=None):
+        """Versione bloccante di submit()"""
+        return self.submit(image, conf, classes, imgsz).result(timeout=timeout)
+
+    def _ensure_started(self):
+        # Il thread va avviato nel processo worker (dopo il fork di gunicorn)
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='yolo-batch-scheduler', daemon=True
+                )
+                self._thread.start()
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            self._process(batch)
+
+    def _process(self, batch):
+        # Un forward pass per dimensione di input
+        groups = {}
+        for request in batch:
+            groups.setdefault(request.imgsz, []).append(request)
+        for imgsz, group in groups.items():
+            self._process_group(group, imgsz)
+
+    def _process_group(self, batch, imgsz):
+        try:
+            model = self.model_getter()
+            if model is None:
+                raise RuntimeError('YOLO model not available')
+
+            # Soglia più bassa e unione delle classi del batch: ogni chiamante rifiltra le proprie
+            conf = min(request.conf for request in batch)
+            classes = None
+            if all(request.classes is not None for request in batch):
+                classes = sorted(set().union(*(request.classes for request in batch)))
+            options = {'imgsz': imgsz} if imgsz else {}
+
+            started = time.monotonic()
+            results = model(
+                [request.image for request in batch], conf=conf, classes=classes, verbose=False, **options
+            )
+            observe('ar_yolo_batch_duration_seconds', time.monotonic() - started)
+            observe('ar_yolo_batch_size', len(batch))
+
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_inference_scheduler():
+    """Scheduler condiviso dal processo, configurato da YOLO_BATCH_MAX_SIZE / YOLO_BATCH_MAX_WAIT_MS"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = BatchInferenceScheduler(
+                    get_yolo_model,
+                    max_batch_size=getattr(settings, 'YOLO_BATCH_MAX_SIZE', 8),
+                    max_wait=getattr(settings, 'YOLO_BATCH_MAX_WAIT_MS', 10) / 1000,
+                )
+    return _scheduler
+
+
+_executor = None
+
+
+def get_inference_executor():
+    """
+    Executor limitato (YOLO_EXECUTOR_WORKERS thread) per decode e post-processing
+    richiamati dalle view async, così l'event loop ASGI non resta mai bloccato
+    """
+    global _executor
+    if _executor is None:
+        with _scheduler_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'YOLO_EXECUTOR_WORKERS', 4),
+                    thread_name_prefix='yolo-executor',
+                )
+    return _executor
+
+
+def _collect_metrics():
+    # Gauge per /metrics: stato del modello e frame in coda in questo processo
+    for state in ('not_loaded', 'ready', 'failed'):
+        yield 'ar_yolo_model_state', {'state': state}, int(_model_state['status'] == state)
+    yield 'ar_yolo_queue_depth', {}, _scheduler.queue_depth if _scheduler is not None else 0
+
+
+register_collector(_collect_metrics)
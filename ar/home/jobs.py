@@ -0,0 +1,276 @@
+"""
+Esecuzione dei MarkerFeatureJob (estrazione ORB dei marker in background)
+e degli ImageVariantJob (varianti ridimensionate delle immagini).
+
+Il processo worker (manage.py process_marker_jobs) reclama i job in pending,
+legge le immagini dallo storage e passa solo i byte a un pool di processi:
+i processi figli non toccano il database. Le varianti vengono generate nel
+processo worker stesso (PIL + storage).
+"""
+import hashlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .derivatives import IMAGE_VARIANTS, generate_variants
+from .features import detect_orb_features
+from .metrics import inc
+from .models import (
+    CharConfiguration, CatalogVersion, ImageVariantJob, MarkerFeatureJob, MARKER_TYPES,
+    copy_marker_features, find_cached_marker_features, read_image_field, store_marker_features,
+)
+from .storage import content_hash_from_name
+
+
+_DUPLICATE = object()
+
+
+def requeue_stale_jobs():
+    """Rimette in pending i job rimasti 'running' (worker terminato a metà)"""
+    stale_after = getattr(settings, 'MARKER_JOB_STALE_SECONDS', 600)
+    return sum(
+        model.objects.filter(
+            status='running',
+            updated_at__lt=timezone.now() - timedelta(seconds=stale_after)
+        ).update(status='pending')
+        for model in (MarkerFeatureJob, ImageVariantJob)
+    )
+
+
+def _claim(model, limit, character_id=None):
+    pending = model.objects.filter(status='pending')
+    if character_id is not None:
+        pending = pending.filter(character_id=character_id)
+
+    claimed = []
+    for job_id in pending.order_by('updated_at').values_list('id', flat=True)[:limit]:
+        if model.objects.filter(pk=job_id, status='pending').update(
+            status='running', attempts=F('attempts') + 1, updated_at=timezone.now()
+        ):
+            claimed.append(job_id)
+
+    return list(model.objects.filter(pk__in=claimed).select_related('character'))
+
+
+def claim_jobs(limit, character_id=None):
+    """
+    Reclama fino a limit job in pending (sicuro anche con più worker in parallelo)
+    """
+    return _claim(MarkerFeatureJob, limit, character_id)
+
+
+def claim_variant_jobs(limit, character_id=None):
+    """Come claim_jobs, per gli ImageVariantJob"""
+    return _claim(ImageVariantJob, limit, character_id)
+
+
+def _read_job_image(job):
+    return read_image_field(getattr(job.character, MARKER_TYPES[job.marker_type][0]))
+
+
+def _refresh_character_status(character_id):
+    jobs = MarkerFeatureJob.objects.filter(character_id=character_id)
+    if jobs.filter(status__in=['pending', 'running']).exists():
+        status = 'pending'
+    elif jobs.filter(status='failed').exists():
+        status = 'failed'
+    else:
+        status = 'done'
+    CharConfiguration.objects.filter(pk=character_id).update(marker_features_status=status)
+
+
+def _is_current(job):
+    """
+    Il marker del personaggio è ancora l'immagine letta dal job (job.character è
+    quello caricato da claim_jobs). Il nome contiene l'hash del contenuto
+    (home/storage.py), quindi un nuovo upload cambia sempre il nome
+    """
+    image_field_name = MARKER_TYPES[job.marker_type][0]
+    current = CharConfiguration.objects.select_for_update().filter(
+        pk=job.character_id
+    ).values_list(image_field_name, flat=True).first()
+    return current is not None and (current or '') == (getattr(job.character, image_field_name).name or '')
+
+
+def _finish_job(job, count):
+    count_field_name = MARKER_TYPES[job.marker_type][1]
+    # update() e non save(): non deve riattivare i signal di CharConfiguration
+    CharConfiguration.objects.filter(pk=job.character_id).update(**{count_field_name: count})
+    MarkerFeatureJob.objects.filter(pk=job.pk, status='running').update(
+        status='done', error='', updated_at=timezone.now()
+    )
+    _refresh_character_status(job.character_id)
+
+
+def complete_job(job, features, content_hash=''):
+    """
+    Salva i features estratti dal job.
+    Returns: False se il marker è stato ricaricato mentre il job girava: il risultato
+    viene scartato e il job, rimesso in pending dal nuovo upload, resta in coda
+    """
+    nfeatures = MARKER_TYPES[job.marker_type][2]
+    with transaction.atomic():
+        if not _is_current(job):
+            return False
+        store_marker_features(job.character, job.marker_type, features, nfeatures, content_hash)
+        _finish_job(job, len(features[0]) if features else 0)
+    return True
+
+
+def complete_job_from_cache(job, cached, content_hash):
+    """Come complete_job, con il blob di un'immagine già elaborata"""
+    nfeatures = MARKER_TYPES[job.marker_type][2]
+    with transaction.atomic():
+        if not _is_current(job):
+            return False
+        copy_marker_features(job.character, job.marker_type, cached, nfeatures, content_hash)
+        _finish_job(job, cached.keypoint_count)
+    return True
+
+
+def fail_job(job, error):
+    MarkerFeatureJob.objects.filter(pk=job.pk, status='running').update(
+        status='failed', error=str(error), updated_at=timezone.now()
+    )
+    _refresh_character_status(job.character_id)
+
+
+def run_jobs(jobs, executor=None):
+    """
+    Esegue i job reclamati, nel pool di processi se fornito, altrimenti inline.
+    Returns: (completati, falliti)
+    """
+    submitted = []
+    # (hash, nfeatures) già in elaborazione in questo ciclo: i duplicati riusano il risultato
+    in_batch = set()
+    done, failed = 0, 0
+    for job in jobs:
+        image_field_name, _, nfeatures = MARKER_TYPES[job.marker_type]
+
+        # Stessa immagine già elaborata (es. altro personaggio nel frattempo): nessuna lettura
+        content_hash = content_hash_from_name(getattr(job.character, image_field_name).name)
+        cached = find_cached_marker_features(content_hash, nfeatures)
+        if cached is not None:
+            if complete_job_from_cache(job, cached, content_hash):
+                inc('ar_marker_jobs_total', status='cached')
+                done += 1
+            else:
+                inc('ar_marker_jobs_total', status='stale')
+            continue
+        if content_hash and (content_hash, nfeatures) in in_batch:
+            submitted.append((job, _DUPLICATE, content_hash))
+            continue
+
+        try:
+            image_data = _read_job_image(job)
+        except Exception as e:
+            fail_job(job, e)
+            inc('ar_marker_jobs_total', status='failed')
+            failed += 1
+            continue
+
+        if image_data is None:
+            submitted.append((job, None, ''))
+            continue
+
+        content_hash = content_hash or hashlib.sha256(image_data).hexdigest()
+        if (content_hash, nfeatures) in in_batch:
+            submitted.append((job, _DUPLICATE, content_hash))
+        elif executor is not None:
+            in_batch.add((content_hash, nfeatures))
+            submitted.append((job, executor.submit(detect_orb_features, image_data, nfeatures), content_hash))
+        else:
+            in_batch.add((content_hash, nfeatures))
+            submitted.append((job, (image_data, nfeatures), content_hash))
+
+    results = {}
+    for job, pending, content_hash in submitted:
+        key = (content_hash, MARKER_TYPES[job.marker_type][2])
+        try:
+            if pending is None:
+                features = None
+            elif pending is _DUPLICATE:
+                if key not in results:
+                    raise ValueError('Estrazione fallita per la stessa immagine')
+                features = results[key]
+            elif executor is not None:
+                features = pending.result()
+            else:
+                features = detect_orb_features(*pending)
+            results[key] = features
+            if complete_job(job, features, content_hash):
+                inc('ar_marker_jobs_total', status='done')
+                done += 1
+            else:
+                inc('ar_marker_jobs_total', status='stale')
+        except Exception as e:
+            fail_job(job, e)
+            inc('ar_marker_jobs_total', status='failed')
+            failed += 1
+
+    if done:
+        # I conteggi features fanno parte del catalogo serializzato
+        CatalogVersion.bump()
+    return done, failed
+
+
+def _store_variants(job, source_name, variants):
+    with transaction.atomic():
+        row = CharConfiguration.objects.select_for_update().filter(pk=job.character_id).values(
+            job.field_name, 'image_variants'
+        ).first()
+        # Immagine ricaricata mentre il job girava: il job è di nuovo in pending, risultato scartato
+        if row is None or (row[job.field_name] or '') != source_name:
+            return False
+
+        image_variants = dict(row['image_variants'] or {})
+        image_variants.pop(job.field_name, None)
+        if variants:
+            image_variants[job.field_name] = variants
+        # update() e non save(): non deve riattivare i signal di CharConfiguration
+        CharConfiguration.objects.filter(pk=job.character_id).update(image_variants=image_variants)
+        ImageVariantJob.objects.filter(pk=job.pk, status='running').update(
+            status='done', error='', updated_at=timezone.now()
+        )
+    return True
+
+
+def run_variant_jobs(jobs):
+    """
+    Genera le varianti dei job reclamati.
+    Returns: (completati, falliti)
+    """
+    done, failed = 0, 0
+    for job in jobs:
+        image_field = getattr(job.character, job.field_name)
+        source_name = image_field.name or ''
+        try:
+            variants = generate_variants(image_field, IMAGE_VARIANTS[job.field_name]) if source_name else None
+        except Exception as e:
+            ImageVariantJob.objects.filter(pk=job.pk, status='running').update(
+                status='failed', error=str(e), updated_at=timezone.now()
+            )
+            inc('ar_image_variant_jobs_total', status='failed')
+            failed += 1
+            continue
+
+        if _store_variants(job, source_name, variants):
+            inc('ar_image_variant_jobs_total', status='done')
+            done += 1
+        else:
+            inc('ar_image_variant_jobs_total', status='stale')
+
+    if done:
+        # Gli URL delle varianti fanno parte del catalogo serializzato
+        CatalogVersion.bump()
+    return done, failed
+
+
+def process_character_jobs(character_id):
+    """Esegue subito i job di un personaggio (MARKER_FEATURES_BACKGROUND = False)"""
+    done, failed = run_jobs(claim_jobs(len(MARKER_TYPES), character_id=character_id))
+    variants_done, variants_failed = run_variant_jobs(claim_variant_jobs(len(IMAGE_VARIANTS), character_id))
+    return done + variants_done, failed + variants_failed
@@ -0,0 +1,384 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+
+import cv2
+import django
+import numpy as np
+import PIL
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings, setup_databases, teardown_databases
+from django.urls import reverse
+
+from home.detection import decode_frame
+from home.geo import MAX_NEARBY_RADIUS, geo_cell_for
+from home.inference import get_yolo_model, model_status
+from home.models import CatalogVersion, CharConfiguration, extract_orb_features
+
+SUITES = ('orb', 'yolo', 'catalog')
+
+# Centro dei personaggi sintetici (sparsi in ~±0.5°) e raggio della query "vicini"
+CATALOG_CENTER = (41.9, 12.5)
+CATALOG_SPREAD_DEG = 0.5
+NEARBY_RADIUS = MAX_NEARBY_RADIUS
+
+CATALOG_ENDPOINTS = [
+    ('api_characters', 'home:character_data', ''),
+    ('api_characters_nearby', 'home:character_data', f'?lat={CATALOG_CENTER[0]}&lon={CATALOG_CENTER[1]}&radius={NEARBY_RADIUS}'),
+    ('camera', 'home:camera', ''),
+    ('camera_simple', 'home:camera_simple', ''),
+    ('camera_simple_gps', 'home:camera_simple_gps', ''),
+    ('camera_yolo', 'home:camera_yolo', ''),
+]
+
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(',') if item.strip()]
+
+
+def parse_frame_sizes(value):
+    sizes = []
+    for item in value.split(','):
+        width, _, height = item.strip().partition('x')
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def summarize(samples):
+    """Statistiche in millisecondi di una lista di durate in secondi"""
+    values = np.array(samples) * 1000
+    return {
+        'n': len(samples),
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p95_ms': round(float(np.percentile(values, 95)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'min_ms': round(float(values.min()), 3),
+        'max_ms': round(float(values.max()), 3),
+    }
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+def synthetic_marker(rng, size):
+    """Marker PNG a blocchi casuali (texture ricca di angoli, come un marker stampato)"""
+    blocks = rng.integers(0, 256, (size // 16, size // 16), dtype=np.uint8)
+    image = cv2.resize(blocks, (size, size), interpolation=cv2.INTER_NEAREST)
+    return cv2.imencode('.png', image)[1].tobytes()
+
+
+def synthetic_frame(rng, width, height, quality=80):
+    """Frame JPEG con gradiente, rumore e rettangoli (comprime come una foto, non come rumore puro)"""
+    gradient = np.linspace(0, 255, width, dtype=np.float32)
+    frame = np.repeat(gradient[None, :, None], height, axis=0).repeat(3, axis=2)
+    frame += rng.normal(0, 12, frame.shape)
+    for _ in range(12):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        color = [int(c) for c in rng.integers(0, 256, 3)]
+        cv2.rectangle(frame, (x, y), (x + width // 8, y + height // 8), color, -1)
+    frame = np.clip(frame, 0, 255).astype(np.uint8)
+    return cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+
+
+def synthetic_characters(rng, start, count):
+    characters = []
+    for i in range(start, start + count):
+        lat = CATALOG_CENTER[0] + float(rng.uniform(-CATALOG_SPREAD_DEG, CATALOG_SPREAD_DEG))
+        lon = CATALOG_CENTER[1] + float(rng.uniform(-CATALOG_SPREAD_DEG, CATALOG_SPREAD_DEG))
+        has_marker = i % 2 == 0
+        use_yolo = i % 5 == 0
+        characters.append(CharConfiguration(
+            name=f'Bench {i}',
+            target_latitude=lat,
+            target_longitude=lon,
+            activation_distance=float(rng.uniform(10, 200)),
+            geo_cell=geo_cell_for(lat, lon),
+            character_image=f'characters/bench-{i % 50}.png',
+            use_marker=has_marker,
+            marker_image=f'markers/bench-{i}.png' if has_marker else '',
+            positioning_marker_image=f'positioning_markers/bench-{i}.png' if has_marker else '',
+            detection_marker_features=500 if has_marker else 0,
+            positioning_marker_features=1000 if has_marker else 0,
+            use_yolo_detection=use_yolo,
+            yolo_object_class='bottle' if use_yolo else '',
+        ))
+    return characters
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, timeout=5, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark riproducibile dei percorsi critici (estrazione ORB, /api/yolo-detect/, '
+        'catalogo e view camera) su un database di test con dati sintetici. Risultati in JSON'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--suite',
+            action='append',
+            choices=SUITES,
+            help='Suite da eseguire, ripetibile (default: tutte)'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=50,
+            help='Misure per ogni caso (default: 50)'
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=3,
+            help='Esecuzioni non misurate prima di ogni caso (default: 3)'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed dei dati sintetici (default: 0)'
+        )
+        parser.add_argument(
+            '--orb-markers',
+            type=int,
+            default=8,
+            help='Marker sintetici per la suite orb (default: 8)'
+        )
+        parser.add_argument(
+            '--orb-sizes',
+            default='512,1024',
+            help='Lato dei marker sintetici in pixel (default: 512,1024)'
+        )
+        parser.add_argument(
+            '--orb-nfeatures',
+            default='500,1000,2000',
+            help='Valori di nfeatures (default: 500,1000,2000)'
+        )
+        parser.add_argument(
+            '--frame-sizes',
+            default='320x240,640x480,1280x720,1920x1080',
+            help='Dimensioni dei frame JPEG per la suite yolo (default: 320x240,640x480,1280x720,1920x1080)'
+        )
+        parser.add_argument(
+            '--catalog-sizes',
+            default='10,1000,50000',
+            help='Numero di personaggi sintetici per la suite catalog (default: 10,1000,50000)'
+        )
+        parser.add_argument(
+            '--output',
+            help='File JSON di output (default: stdout)'
+        )
+
+    def log(self, message):
+        if self.verbosity >= 1:
+            self.stderr.write(message, style_func=lambda text: text)
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.iterations = max(1, options['iterations'])
+        self.warmup = max(0, options['warmup'])
+        suites = options['suite'] or list(SUITES)
+        try:
+            orb_sizes = parse_int_list(options['orb_sizes'])
+            orb_nfeatures = parse_int_list(options['orb_nfeatures'])
+            frame_sizes = parse_frame_sizes(options['frame_sizes'])
+            catalog_sizes = sorted(parse_int_list(options['catalog_sizes']))
+        except ValueError as e:
+            raise CommandError(f'Parametro non valido: {e}')
+
+        report = {
+            'meta': self.meta(options, suites),
+            'results': {},
+        }
+
+        # Database di test (migrato da zero) e cache privata: il DB reale non viene toccato.
+        # I print del codice misurato (es. caricamento del modello) vanno su stderr:
+        # stdout contiene solo il report JSON
+        with redirect_stdout(sys.stderr):
+            self.log('Creazione database di test...')
+            old_config = setup_databases(verbosity=0, interactive=False)
+            try:
+                with override_settings(
+                    ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'ar-bench'}},
+                ):
+                    if 'orb' in suites:
+                        report['results']['orb'] = self.bench_orb(options['seed'], options['orb_markers'], orb_sizes, orb_nfeatures)
+                    if 'yolo' in suites:
+                        report['results']['yolo'] = self.bench_yolo(options['seed'], frame_sizes)
+                    if 'catalog' in suites:
+                        report['results']['catalog'] = self.bench_catalog(options['seed'], catalog_sizes)
+            finally:
+                teardown_databases(old_config, verbosity=0)
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.log(f'Risultati salvati in {options["output"]}')
+        else:
+            self.stdout.write(output)
+
+    def meta(self, options, suites):
+        return {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': sys.version.split()[0],
+            'django': django.get_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'pillow': PIL.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'debug': settings.DEBUG,
+            'database': connections['default'].vendor,
+            'yolo_backend': getattr(settings, 'YOLO_BACKEND', 'pytorch'),
+            'suites': suites,
+            'iterations': self.iterations,
+            'warmup': self.warmup,
+            'seed': options['seed'],
+        }
+
+    def measure(self, func):
+        for _ in range(self.warmup):
+            func()
+        samples = []
+        for _ in range(self.iterations):
+            elapsed, _ = timed(func)
+            samples.append(elapsed)
+        return summarize(samples)
+
+    def bench_orb(self, seed, marker_count, sizes, nfeatures_values):
+        """extract_orb_features sui marker sintetici salvati in una MEDIA_ROOT temporanea"""
+        rng = np.random.default_rng(seed)
+        results = []
+
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            for size in sizes:
+                markers = []
+                for i in range(marker_count):
+                    character = CharConfiguration(name=f'Bench marker {i}')
+                    character.marker_image.save(f'bench-{size}-{i}.png', ContentFile(synthetic_marker(rng, size)), save=False)
+                    markers.append(character.marker_image)
+
+                for nfeatures in nfeatures_values:
+                    self.log(f'orb: {marker_count} marker {size}px, nfeatures={nfeatures}')
+                    for marker in markers[:self.warmup]:
+                        extract_orb_features(marker, nfeatures)
+
+                    samples = []
+                    keypoints = []
+                    rounds = max(1, self.iterations // marker_count)
+                    for _ in range(rounds):
+                        for marker in markers:
+                            elapsed, count = timed(extract_orb_features, marker, nfeatures)
+                            samples.append(elapsed)
+                            keypoints.append(count)
+
+                    results.append({
+                        'marker_size': size,
+                        'nfeatures': nfeatures,
+                        'markers_per_second': round(len(samples) / sum(samples), 2),
+                        'mean_keypoints': round(float(np.mean(keypoints)), 1),
+                        **summarize(samples),
+                    })
+        return results
+
+    def bench_yolo(self, seed, frame_sizes):
+        """Decode dei frame e /api/yolo-detect/ end-to-end (se il modello è disponibile)"""
+        rng = np.random.default_rng(seed)
+        frames = {(width, height): synthetic_frame(rng, width, height) for width, height in frame_sizes}
+
+        self.log('yolo: caricamento modello...')
+        load_seconds, model = timed(get_yolo_model)
+        status = model_status()
+        result = {
+            'model_available': model is not None,
+            'model_load_seconds': round(load_seconds, 3),
+            'model_status': status['status'],
+            'model_error': status.get('error'),
+            'frames': [],
+        }
+
+        client = Client()
+        url = reverse('home:yolo_detect')
+        for (width, height), jpeg in frames.items():
+            self.log(f'yolo: frame {width}x{height} ({len(jpeg)} byte)')
+            entry = {
+                'width': width,
+                'height': height,
+                'jpeg_bytes': len(jpeg),
+                'decode': self.measure(lambda: decode_frame(jpeg)),
+                'decode_reduced': self.measure(lambda: decode_frame(jpeg, settings.YOLO_IMAGE_SIZE)),
+            }
+
+            if model is not None:
+                statuses = set()
+
+                def request():
+                    response = client.post(url, data=jpeg, content_type='image/jpeg', HTTP_X_OBJECT_CLASS='bottle')
+                    statuses.add(response.status_code)
+
+                entry['request'] = self.measure(request)
+                entry['status_codes'] = sorted(statuses)
+            result['frames'].append(entry)
+        return result
+
+    def bench_catalog(self, seed, sizes):
+        """/api/characters/ e view camera con N personaggi sintetici (snapshot freddo e caldo)"""
+        rng = np.random.default_rng(seed)
+        client = Client()
+        results = []
+        created = 0
+
+        for size in sizes:
+            self.log(f'catalog: {size} personaggi')
+            # bulk_create non invia i segnali (niente estrazione features o varianti)
+            CharConfiguration.objects.bulk_create(synthetic_characters(rng, created, size - created), batch_size=1000)
+            created = size
+
+            entry = {'characters': size, 'endpoints': {}}
+            for name, url_name, query in CATALOG_ENDPOINTS:
+                url = reverse(url_name) + query
+
+                # Freddo: prima richiesta dopo una modifica del catalogo (snapshot da ricostruire)
+                CatalogVersion.bump()
+                cold_seconds, response = timed(client.get, url)
+                warm = self.measure(lambda: client.get(url))
+
+                entry['endpoints'][name] = {
+                    'status_code': response.status_code,
+                    'response_bytes': len(response.content),
+                    'cold_ms': round(cold_seconds * 1000, 3),
+                    **warm,
+                }
+
+            # Revalidazione con ETag (client con il catalogo già in cache)
+            etag = client.get(reverse('home:character_data'))['ETag']
+            entry['endpoints']['api_characters_not_modified'] = self.measure(
+                lambda: client.get(reverse('home:character_data'), HTTP_IF_NONE_MATCH=etag)
+            )
+            results.append(entry)
+        return results
@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from home.inference import _load_pytorch_model
+
+
+class Command(BaseCommand):
+    help = 'Esporta yolov8n.pt in ONNX o OpenVINO per i backend CPU (YOLO_BACKEND)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format',
+            choices=['onnx', 'openvino'],
+            default='onnx',
+            help='Formato di export (default: onnx)'
+        )
+        parser.add_argument(
+            '--int8',
+            action='store_true',
+            help='Quantizzazione INT8 (ONNX: dinamica sui pesi, OpenVINO: calibrazione NNCF di ultralytics)'
+        )
+        parser.add_argument(
+            '--imgsz',
+            type=int,
+            default=640,
+            help='Dimensione input del modello (default: 640)'
+        )
+        parser.add_argument(
+            '--weights',
+            default='yolov8n.pt',
+            help='Pesi PyTorch di partenza (default: yolov8n.pt)'
+        )
+
+    def handle(self, *args, **options):
+        # Stesso caricamento del runtime (workaround weights_only di torch.load)
+        try:
+            model = _load_pytorch_model(weights=options['weights'])
+        except ImportError:
+            raise CommandError('ultralytics/torch non installati')
+        export_format = options['format']
+
+        # dynamic=True: batch variabile, necessario per il micro-batching
+        if export_format == 'onnx':
+            path = model.export(format='onnx', imgsz=options['imgsz'], dynamic=True, simplify=True)
+            if options['int8']:
+                path = self.quantize_onnx(path)
+        else:
+            path = model.export(
+                format='openvino', imgsz=options['imgsz'], dynamic=True, int8=options['int8']
+            )
+
+        self.stdout.write(self.style.SUCCESS(f'OK Modello esportato: {path}'))
+        self.stdout.write(
+            f'Imposta YOLO_BACKEND={export_format} e YOLO_MODEL_PATH={path} per usarlo'
+        )
+
+    def quantize_onnx(self, path):
+        try:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+        except ImportError:
+            raise CommandError('onnxruntime non installato (pip install onnxruntime)')
+
+        quantized_path = str(path).replace('.onnx', '_int8.onnx')
+        quantize_dynamic(path, quantized_path, weight_type=QuantType.QUInt8)
+        return quantized_path
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from home.derivatives import IMAGE_VARIANTS, build_image_variants
+from home.models import CharConfiguration, CatalogVersion
+
+
+class Command(BaseCommand):
+    help = 'Genera le varianti ridimensionate (WebP/PNG, marker grayscale) per le immagini esistenti'
+
+    def handle(self, *args, **options):
+        characters = CharConfiguration.objects.only('id', 'name', 'image_variants', *IMAGE_VARIANTS)
+        updated = []
+
+        for char in characters.iterator(chunk_size=200):
+            image_variants = build_image_variants(char, list(IMAGE_VARIANTS), char.image_variants)
+            if image_variants != char.image_variants:
+                char.image_variants = image_variants
+                updated.append(char)
+                self.stdout.write(
+                    self.style.SUCCESS(f'OK {char.name}: {sum(len(v) for v in image_variants.values())} varianti')
+                )
+
+        if updated:
+            # bulk_update non invia i signal: nessun ricalcolo dei marker
+            CharConfiguration.objects.bulk_update(updated, ['image_variants'], batch_size=500)
+            CatalogVersion.bump()
+
+        self.stdout.write(self.style.SUCCESS(f'\nOK Completato! {len(updated)} characters aggiornati.'))
@@ -0,0 +1,64 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from home.jobs import claim_jobs, claim_variant_jobs, requeue_stale_jobs, run_jobs, run_variant_jobs
+
+
+class Command(BaseCommand):
+    help = 'Worker che esegue in background l\'estrazione features dei marker (MarkerFeatureJob) e le varianti delle immagini (ImageVariantJob)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Processi per l\'estrazione ORB (default: numero di CPU)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=0,
+            help='Job reclamati per ciclo (default: 4 x workers)'
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=2.0,
+            help='Secondi di attesa quando la coda è vuota (default: 2)'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Svuota la coda ed esci'
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        batch_size = options['batch_size'] or workers * 4
+
+        self.stdout.write(f'Marker job worker avviato ({workers} processi)')
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while True:
+                requeued = requeue_stale_jobs()
+                if requeued:
+                    self.stdout.write(self.style.WARNING(f'{requeued} job bloccati rimessi in coda'))
+
+                jobs = claim_jobs(batch_size)
+                variant_jobs = claim_variant_jobs(batch_size)
+                if not jobs and not variant_jobs:
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, failed = run_jobs(jobs, executor)
+                variants_done, variants_failed = run_variant_jobs(variant_jobs)
+                failed += variants_failed
+                self.stdout.write(
+                    self.style.SUCCESS(f'OK {done} marker e {variants_done} immagini elaborati')
+                    + (self.style.ERROR(f', ERR {failed} falliti') if failed else '')
+                )
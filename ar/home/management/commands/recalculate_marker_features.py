@@ -1,59 +1,205 @@
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 from django.core.management.base import BaseCommand
-from home.models import CharConfiguration, extract_orb_features
+from django.db import transaction
+
+from home.features import detect_orb_features
+from home.models import (
+    CharConfiguration, CatalogVersion, MarkerFeatures, MARKER_TYPES,
+    build_marker_features, copy_marker_features, find_cached_marker_features, read_image_field,
+)
+from home.storage import content_hash_from_name
+
+PROGRESS_EVERY = 100
 
 
 class Command(BaseCommand):
-    help = 'Ricalcola i features ORB per tutti i marker esistenti'
+    help = 'Ricalcola i features ORB (conteggi e descriptors salvati) per tutti i marker esistenti'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Processi per l\'estrazione ORB (default: numero di CPU, 1 = nel processo corrente)'
+        )
+        parser.add_argument(
+            '--changed-only',
+            action='store_true',
+            help='Salta i marker la cui immagine (hash SHA-256) e nfeatures non sono cambiati'
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=0,
+            help='Marker letti e scritti per blocco (default: 8 x workers)'
+        )
 
     def handle(self, *args, **options):
-        characters = CharConfiguration.objects.all()
-        updated_count = 0
+        workers = max(1, options['workers'])
+        chunk_size = options['chunk_size'] or workers * 8
+        self.verbosity = options['verbosity']
+        started = time.monotonic()
 
-        for char in characters:
-            updated = False
+        # (character_id, marker_type) -> (content_hash, nfeatures) dei blob già salvati
+        stored = {}
+        if options['changed_only']:
+            stored = {
+                (char_id, marker_type): (content_hash, nfeatures)
+                for char_id, marker_type, content_hash, nfeatures in MarkerFeatures.objects.values_list(
+                    'character_id', 'marker_type', 'content_hash', 'nfeatures'
+                )
+            }
 
-            # Calcola features detection marker
-            if char.marker_image:
-                try:
-                    features = extract_orb_features(char.marker_image, nfeatures=500)
-                    char.detection_marker_features = features
-                    updated = True
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f'OK {char.name}: Detection marker = {features} features'
-                        )
-                    )
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.ERROR(
-                            f'ERR {char.name}: Errore detection marker - {str(e)}'
-                        )
-                    )
-
-            # Calcola features positioning marker
-            if char.positioning_marker_image:
-                try:
-                    features = extract_orb_features(char.positioning_marker_image, nfeatures=2000)
-                    char.positioning_marker_features = features
-                    updated = True
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f'OK {char.name}: Positioning marker = {features} features'
-                        )
-                    )
-                except Exception as e:
-                    self.stdout.write(
-                        self.style.ERROR(
-                            f'ERR {char.name}: Errore positioning marker - {str(e)}'
-                        )
-                    )
+        self.stats = {'processed': 0, 'reused': 0, 'skipped': 0, 'failed': 0, 'keypoints': 0}
+        self.seen = set()
+        self.duplicates = []
+        # I conteggi vengono scritti tutti insieme alla fine con un solo bulk_update
+        self.updated_chars = {}
+        self.failed_chars = set()
+
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            chunk = []
+            for task in self.iter_tasks(stored, options['changed_only']):
+                chunk.append(task)
+                if len(chunk) >= chunk_size:
+                    self.process_chunk(chunk, executor)
+                    chunk = []
+            if chunk:
+                self.process_chunk(chunk, executor)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
-            if updated:
-                char.save()
-                updated_count += 1
+        self.copy_duplicates()
 
+        chars = list(self.updated_chars.values())
+        for char in chars:
+            char.marker_features_status = 'failed' if char.pk in self.failed_chars else 'done'
+
+        if chars:
+            # bulk_update non invia pre_save/post_save: nessun job o ricalcolo a catena
+            CharConfiguration.objects.bulk_update(
+                chars,
+                ['detection_marker_features', 'positioning_marker_features', 'marker_features_status'],
+                batch_size=500
+            )
+            CatalogVersion.bump()
+
+        elapsed = time.monotonic() - started
+        stats = self.stats
+        rate = stats['processed'] / elapsed if elapsed > 0 else 0
         self.stdout.write(
             self.style.SUCCESS(
-                f'\nOK Completato! {updated_count} characters aggiornati.'
+                f'\nOK Completato! {len(chars)} characters aggiornati: '
+                f'{stats["processed"]} marker elaborati, {stats["reused"]} duplicati riusati, '
+                f'{stats["skipped"]} invariati, '
+                f'{stats["failed"]} errori, {stats["keypoints"]} keypoints '
+                f'in {elapsed:.1f}s ({rate:.1f} marker/s, {workers} processi)'
             )
         )
+
+    def iter_tasks(self, stored, changed_only):
+        """
+        Legge le immagini nel processo principale: ai processi figli passano solo i byte.
+        Yields: (char, marker_type, image_data, content_hash, nfeatures)
+        """
+        # Anche i campi conteggio: bulk_update li legge tutti, evita query sui campi differiti
+        fields = ['id', 'name', 'marker_features_status']
+        for image_field_name, count_field_name, _ in MARKER_TYPES.values():
+            fields += [image_field_name, count_field_name]
+        characters = CharConfiguration.objects.only(*fields).order_by('id')
+
+        for char in characters.iterator(chunk_size=500):
+            for marker_type, (image_field_name, _, nfeatures) in MARKER_TYPES.items():
+                image_field = getattr(char, image_field_name)
+                if not image_field:
+                    continue
+
+                # Con i nomi content-addressed l'hash è noto senza leggere il file
+                content_hash = content_hash_from_name(image_field.name)
+                if changed_only and content_hash and stored.get((char.pk, marker_type)) == (content_hash, nfeatures):
+                    self.stats['skipped'] += 1
+                    continue
+
+                if content_hash and (content_hash, nfeatures) in self.seen:
+                    self.duplicates.append((char, marker_type, content_hash, nfeatures))
+                    continue
+
+                try:
+                    image_data = read_image_field(image_field)
+                except Exception as e:
+                    self.report_error(char, marker_type, e)
+                    continue
+
+                content_hash = content_hash or hashlib.sha256(image_data).hexdigest()
+                if changed_only and stored.get((char.pk, marker_type)) == (content_hash, nfeatures):
+                    self.stats['skipped'] += 1
+                    continue
+
+                if (content_hash, nfeatures) in self.seen:
+                    self.duplicates.append((char, marker_type, content_hash, nfeatures))
+                    continue
+                self.seen.add((content_hash, nfeatures))
+
+                yield char, marker_type, image_data, content_hash, nfeatures
+
+    def copy_duplicates(self):
+        """Marker con la stessa immagine di uno già elaborato: copia il blob appena salvato"""
+        for char, marker_type, content_hash, nfeatures in self.duplicates:
+            cached = find_cached_marker_features(content_hash, nfeatures)
+            if cached is None:
+                self.report_error(char, marker_type, 'estrazione fallita per la stessa immagine')
+                continue
+
+            copy_marker_features(char, marker_type, cached, nfeatures, content_hash)
+            setattr(char, MARKER_TYPES[marker_type][1], cached.keypoint_count)
+            self.updated_chars[char.pk] = char
+            self.stats['reused'] += 1
+
+    def process_chunk(self, chunk, executor):
+        if executor is not None:
+            pending = [executor.submit(detect_orb_features, data, nfeatures) for _, _, data, _, nfeatures in chunk]
+        else:
+            pending = [None] * len(chunk)
+
+        marker_features = []
+        for (char, marker_type, image_data, content_hash, nfeatures), future in zip(chunk, pending):
+            try:
+                features = future.result() if future is not None else detect_orb_features(image_data, nfeatures)
+            except Exception as e:
+                self.report_error(char, marker_type, e)
+                continue
+
+            marker_features.append(build_marker_features(char.pk, marker_type, features, nfeatures, content_hash))
+
+            count = len(features[0])
+            setattr(char, MARKER_TYPES[marker_type][1], count)
+            self.updated_chars[char.pk] = char
+            self.stats['processed'] += 1
+            self.stats['keypoints'] += count
+
+            if self.verbosity >= 2:
+                self.stdout.write(self.style.SUCCESS(f'OK {char.name}: {marker_type} marker = {count} features'))
+
+        if marker_features:
+            with transaction.atomic():
+                MarkerFeatures.objects.bulk_create(
+                    marker_features,
+                    update_conflicts=True,
+                    unique_fields=['character', 'marker_type'],
+                    update_fields=['nfeatures', 'keypoint_count', 'content_hash', 'data', 'updated_at'],
+                )
+
+        done = self.stats['processed'] + self.stats['failed']
+        if done and done // PROGRESS_EVERY != (done - len(chunk)) // PROGRESS_EVERY:
+            self.stdout.write(f'... {done} marker elaborati')
+
+    def report_error(self, char, marker_type, error):
+        self.stats['failed'] += 1
+        self.failed_chars.add(char.pk)
+        self.stdout.write(self.style.ERROR(f'ERR {char.name}: Errore {marker_type} marker - {error}'))
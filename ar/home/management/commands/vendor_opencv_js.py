@@ -0,0 +1,53 @@
+import hashlib
+import shutil
+import urllib.request
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from home.templatetags.home_assets import opencv_js_static_path
+
+
+class Command(BaseCommand):
+    help = 'Scarica opencv.js nei static file dell\'app (servito poi con hash e compressione da collectstatic)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            default=settings.OPENCV_JS_CDN_URL,
+            help='URL o file locale da cui copiare opencv.js (default: OPENCV_JS_CDN_URL)'
+        )
+        parser.add_argument(
+            '--sha256',
+            default='',
+            help='Hash atteso del file (verifica l\'integrità del download)'
+        )
+
+    def handle(self, *args, **options):
+        source = options['source']
+        destination = Path(__file__).resolve().parents[2] / 'static' / opencv_js_static_path()
+        destination.parent.mkdir(parents=True, exist_ok=True)
+
+        self.stdout.write(f'Download {source}...')
+        try:
+            if '://' in source:
+                with urllib.request.urlopen(source, timeout=120) as response:
+                    content = response.read()
+            else:
+                content = Path(source).read_bytes()
+        except Exception as e:
+            raise CommandError(f'Impossibile leggere {source}: {e}')
+
+        digest = hashlib.sha256(content).hexdigest()
+        if options['sha256'] and digest != options['sha256'].lower():
+            raise CommandError(f'SHA-256 non corrispondente: {digest}')
+
+        tmp = destination.with_suffix('.tmp')
+        tmp.write_bytes(content)
+        shutil.move(tmp, destination)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'OK {destination} ({len(content) / 1e6:.1f} MB, sha256 {digest})\n'
+            'Esegui collectstatic per generare la versione con hash e i file .gz/.br'
+        ))
@@ -0,0 +1,367 @@
+"""
+Indice ANN in memoria sui descriptors ORB dei marker, usato da /api/marker-match/.
+
+I descriptors binari (256 bit) sono indicizzati con LSH a campionamento di bit:
+MARKER_INDEX_LSH_TABLES tabelle, ognuna usa MARKER_INDEX_LSH_BITS bit a caso
+del descriptor come chiave. Per ogni descriptor del frame si confrontano
+(distanza di Hamming) solo i descriptors che condividono almeno una chiave, il
+migliore vota per il suo marker; i marker più votati vengono verificati con
+ratio test + homography RANSAC come sul client.
+
+L'indice è fatto di segmenti immutabili (array numpy ordinati per chiave): un
+marker aggiunto o aggiornato finisce in un nuovo segmento piccolo, quello
+vecchio viene solo marcato come non più valido; quando i segmenti o le righe
+obsolete sono troppi l'indice viene compattato in un unico segmento.
+Ogni marker ha un uid progressivo: personaggio, tipo e validità stanno in array
+indicizzati per uid, così filtrare i candidati di una ricerca costa quanto i
+candidati stessi e non quanto il numero di marker indicizzati.
+Le modifiche vengono lette dal database (MarkerFeatures) quando cambia
+CatalogVersion, quindi anche quelle fatte da altri processi.
+"""
+import threading
+import time
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .features import ORB_DESCRIPTOR_SIZE, unpack_orb_features
+from .models import CatalogVersion, MarkerFeatures, MARKER_TYPES
+from .routers import catalog_reads
+
+DEFAULT_LSH_TABLES = 12
+DEFAULT_LSH_BITS = 14
+DEFAULT_MAX_HAMMING = 64
+# Bucket più affollati di così (zone uniformi, descriptors degeneri) non vengono scanditi
+MAX_BUCKET_SIZE = 512
+MAX_SEGMENTS = 8
+MAX_DEAD_FRACTION = 0.25
+RATIO_THRESHOLD = 0.85
+RANSAC_THRESHOLD = 5.0
+MIN_HOMOGRAPHY_MATCHES = 10
+
+# Bit a 1 di ogni byte, per la distanza di Hamming vettoriale
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+# marker_type -> codice nell'array dei tipi
+_TYPE_CODES = {marker_type: code for code, marker_type in enumerate(MARKER_TYPES)}
+
+
+class MarkerEntry:
+    __slots__ = ('uid', 'key', 'features_id', 'updated_at', 'points', 'descriptors', 'width', 'height')
+
+    def __init__(self, uid, key, features_id, updated_at, points, descriptors, width, height):
+        self.uid = uid
+        self.key = key  # (character_id, marker_type)
+        self.features_id = features_id
+        self.updated_at = updated_at
+        self.points = points
+        self.descriptors = descriptors
+        self.width = width
+        self.height = height
+
+
+class _Segment:
+    """Descriptors di un gruppo di marker, ordinati per chiave in ogni tabella LSH"""
+
+    def __init__(self, entries, bit_positions):
+        self.descriptors = np.concatenate([entry.descriptors for entry in entries])
+        self.uids = np.concatenate([
+            np.full(len(entry.descriptors), entry.uid, dtype=np.int64) for entry in entries
+        ])
+
+        keys = lsh_keys(self.descriptors, bit_positions)  # (n, tabelle)
+        self.order = np.argsort(keys, axis=0, kind='stable').T  # (tabelle, n)
+        self.sorted_keys = np.take_along_axis(keys.T, self.order, axis=1)
+
+    def __len__(self):
+        return len(self.uids)
+
+    def candidates(self, query_keys):
+        """
+        Coppie (indice query, indice descriptor) che condividono una chiave in almeno una tabella
+        """
+        query_index, descriptor_index = [], []
+        for table, sorted_keys in enumerate(self.sorted_keys):
+            lo = np.searchsorted(sorted_keys, query_keys[:, table], side='left')
+            hi = np.searchsorted(sorted_keys, query_keys[:, table], side='right')
+            counts = hi - lo
+            counts[counts > MAX_BUCKET_SIZE] = 0
+            total = int(counts.sum())
+            if not total:
+                continue
+
+            # Espande gli intervalli [lo, hi) senza loop Python
+            starts = np.repeat(lo - np.cumsum(counts) + counts, counts)
+            query_index.append(np.repeat(np.arange(len(counts)), counts))
+            descriptor_index.append(self.order[table][starts + np.arange(total)])
+
+        if not query_index:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(query_index), np.concatenate(descriptor_index)
+
+
+def lsh_keys(descriptors, bit_positions):
+    """Chiavi LSH (n, tabelle) uint32 a partire dai descriptors (n, 32) uint8"""
+    tables, bits = bit_positions.shape
+    weights = (1 << np.arange(bits, dtype=np.uint32))
+    keys = np.empty((len(descriptors), tables), dtype=np.uint32)
+
+    # A blocchi: unpackbits espande ogni riga a 256 byte
+    for start in range(0, len(descriptors), 65536):
+        unpacked = np.unpackbits(descriptors[start:start + 65536], axis=1)
+        keys[start:start + 65536] = unpacked[:, bit_positions] @ weights
+    return keys
+
+
+def hamming_distances(a, b):
+    """Distanze di Hamming riga per riga tra due array (n, 32) uint8"""
+    return _POPCOUNT[np.bitwise_xor(a, b)].sum(axis=1)
+
+
+class MarkerIndex:
+    def __init__(self, tables=DEFAULT_LSH_TABLES, bits=DEFAULT_LSH_BITS, max_hamming=DEFAULT_MAX_HAMMING, seed=0):
+        rng = np.random.default_rng(seed)
+        self.bit_positions = np.stack([
+            rng.choice(ORB_DESCRIPTOR_SIZE * 8, size=bits, replace=False) for _ in range(tables)
+        ])
+        self.max_hamming = max_hamming
+        self.entries = {}  # (character_id, marker_type) -> MarkerEntry
+        self.segments = []
+        # Per uid: MarkerEntry (anche obsoleti fino alla compattazione), validità, personaggio, tipo.
+        # Gli array vengono sostituiti e mai modificati: una ricerca in corso usa i suoi
+        self._uid_entries = []
+        self._live = np.zeros(0, dtype=bool)
+        self._character_ids = np.zeros(0, dtype=np.int64)
+        self._type_codes = np.zeros(0, dtype=np.int8)
+        self._dead_rows = 0
+        self._lock = threading.RLock()
+        self.version = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entries):
+        """Aggiunge o sostituisce marker (lista di MarkerEntry senza uid) in un nuovo segmento"""
+        with self._lock:
+            dead = [self._drop(entry.key) for entry in entries]
+            live = [entry for entry in entries if len(entry.descriptors)]
+            for entry in live:
+                entry.uid = len(self._uid_entries)
+                self.entries[entry.key] = entry
+                self._uid_entries.append(entry)
+
+            if live:
+                self.segments.append(_Segment(live, self.bit_positions))
+            self._update_uids(dead, live)
+            self._maybe_compact()
+
+    def remove(self, keys):
+        with self._lock:
+            self._update_uids([self._drop(key) for key in keys], [])
+            self._maybe_compact()
+
+    def _drop(self, key):
+        """Returns: uid del marker rimosso oppure None"""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return None
+        self._dead_rows += len(entry.descriptors)
+        return entry.uid
+
+    def _update_uids(self, dead, live):
+        """Nuovi array per uid: i marker live aggiunti in coda, i dead invalidati"""
+        live_mask = np.concatenate([self._live, np.ones(len(live), dtype=bool)])
+        live_mask[[uid for uid in dead if uid is not None]] = False
+        self._character_ids = np.concatenate([
+            self._character_ids, np.array([entry.key[0] for entry in live], dtype=np.int64)
+        ])
+        self._type_codes = np.concatenate([
+            self._type_codes, np.array([_TYPE_CODES[entry.key[1]] for entry in live], dtype=np.int8)
+        ])
+        self._live = live_mask
+
+    def _maybe_compact(self):
+        total_rows = sum(len(segment) for segment in self.segments)
+        if len(self.segments) <= MAX_SEGMENTS and self._dead_rows <= total_rows * MAX_DEAD_FRACTION:
+            return
+
+        # Un solo segmento e uid rinumerati da zero: gli array per uid perdono le righe obsolete
+        entries = list(self.entries.values())
+        for uid, entry in enumerate(entries):
+            entry.uid = uid
+        self._uid_entries = entries
+        self._live = np.zeros(0, dtype=bool)
+        self._character_ids = np.zeros(0, dtype=np.int64)
+        self._type_codes = np.zeros(0, dtype=np.int8)
+        self._update_uids([], entries)
+        self.segments = [_Segment(entries, self.bit_positions)] if entries else []
+        self._dead_rows = 0
+
+    def search(self, descriptors, marker_type=None, character_ids=None, limit=5):
+        """
+        Vota i marker con i descriptors del frame.
+        marker_type, character_ids: restringono i marker (tipo, personaggi vicini)
+        Returns: lista di (MarkerEntry, voti) in ordine di voti decrescente
+        """
+        with self._lock:
+            segments = list(self.segments)
+            uid_entries, live = self._uid_entries, self._live
+            character_id_of, type_code_of = self._character_ids, self._type_codes
+
+        if not len(descriptors) or not segments or (character_ids is not None and not character_ids):
+            return []
+        type_code = _TYPE_CODES.get(marker_type, -1) if marker_type is not None else None
+        if character_ids is not None:
+            character_ids = np.fromiter(character_ids, dtype=np.int64)
+
+        query_keys = lsh_keys(descriptors, self.bit_positions)
+        best_distance = np.full(len(descriptors), self.max_hamming + 1, dtype=np.int64)
+        best_uid = np.full(len(descriptors), -1, dtype=np.int64)
+
+        for segment in segments:
+            query_index, descriptor_index = segment.candidates(query_keys)
+            if not len(query_index):
+                continue
+
+            # Marker ammessi e ancora validi: i descriptors obsoleti dei segmenti vecchi non votano
+            uids = segment.uids[descriptor_index]
+            keep = live[uids]
+            if type_code is not None:
+                keep &= type_code_of[uids] == type_code
+            if character_ids is not None:
+                keep &= np.isin(character_id_of[uids], character_ids)
+            query_index, descriptor_index, uids = query_index[keep], descriptor_index[keep], uids[keep]
+            distances = hamming_distances(descriptors[query_index], segment.descriptors[descriptor_index])
+
+            # Miglior candidato per descriptor del frame (minimo per gruppo)
+            order = np.lexsort((distances, query_index))
+            query_index, distances, uids = query_index[order], distances[order], uids[order]
+            first = np.ones(len(query_index), dtype=bool)
+            first[1:] = query_index[1:] != query_index[:-1]
+
+            query_index, distances, uids = query_index[first], distances[first], uids[first]
+            better = distances < best_distance[query_index]
+            best_distance[query_index[better]] = distances[better]
+            best_uid[query_index[better]] = uids[better]
+
+        matched = best_uid[best_uid >= 0]
+        if not len(matched):
+            return []
+
+        uids, votes = np.unique(matched, return_counts=True)
+        ranked = sorted(zip(uids.tolist(), votes.tolist()), key=lambda item: -item[1])[:limit]
+        return [(uid_entries[uid], count) for uid, count in ranked]
+
+    def refresh(self):
+        """Allinea l'indice a MarkerFeatures se CatalogVersion è cambiata"""
+        version = CatalogVersion.current()
+        if version == self.version:
+            return False
+
+        with self._lock:
+            if version == self.version:
+                return False
+
+            rows = MarkerFeatures.objects.values_list('id', 'character_id', 'marker_type', 'updated_at')
+            current = {(char_id, marker_type): (features_id, updated_at) for features_id, char_id, marker_type, updated_at in rows}
+
+            removed = [key for key in self.entries if key not in current]
+            changed_ids = [
+                features_id for key, (features_id, updated_at) in current.items()
+                if key not in self.entries
+                or self.entries[key].features_id != features_id
+                or self.entries[key].updated_at != updated_at
+            ]
+
+            entries = []
+            # Solo i blob nuovi o modificati, a blocchi
+            for start in range(0, len(changed_ids), 500):
+                for features in MarkerFeatures.objects.filter(pk__in=changed_ids[start:start + 500]):
+                    points, descriptors, width, height = unpack_orb_features(bytes(features.data))
+                    entries.append(MarkerEntry(
+                        None, (features.character_id, features.marker_type), features.pk,
+                        features.updated_at, points, descriptors, width, height
+                    ))
+
+            self.remove(removed)
+            self.add(entries)
+            self.version = version
+            return True
+
+
+def verify_candidate(entry, frame_points, frame_descriptors, max_hamming=DEFAULT_MAX_HAMMING):
+    """
+    Ratio test + homography RANSAC tra frame e marker candidato.
+    Returns: (inliers, homography 3x3 marker -> frame oppure None, good_matches)
+    """
+    matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+    matches = matcher.knnMatch(frame_descriptors, entry.descriptors, k=2)
+
+    good = [
+        pair[0] for pair in matches
+        if pair and pair[0].distance <= max_hamming
+        and (len(pair) < 2 or pair[0].distance < RATIO_THRESHOLD * pair[1].distance)
+    ]
+    if len(good) < MIN_HOMOGRAPHY_MATCHES:
+        return 0, None, len(good)
+
+    marker_points = entry.points[[m.trainIdx for m in good]]
+    matched_frame_points = frame_points[[m.queryIdx for m in good]]
+    homography, mask = cv2.findHomography(marker_points, matched_frame_points, cv2.RANSAC, RANSAC_THRESHOLD)
+    if homography is None:
+        return 0, None, len(good)
+    return int(mask.sum()), homography, len(good)
+
+
+_index = None
+_index_lock = threading.Lock()
+_last_refresh = 0.0
+
+
+def get_marker_index():
+    """
+    Indice condiviso dal processo, riallineato al database al massimo ogni
+    MARKER_INDEX_REFRESH_SECONDS (solo se CatalogVersion è cambiata)
+    """
+    global _index, _last_refresh
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = MarkerIndex(
+                    tables=getattr(settings, 'MARKER_INDEX_LSH_TABLES', DEFAULT_LSH_TABLES),
+                    bits=getattr(settings, 'MARKER_INDEX_LSH_BITS', DEFAULT_LSH_BITS),
+                    max_hamming=getattr(settings, 'MARKER_MATCH_MAX_HAMMING', DEFAULT_MAX_HAMMING),
+                )
+
+    now = time.monotonic()
+    if now - _last_refresh >= getattr(settings, 'MARKER_INDEX_REFRESH_SECONDS', 2):
+        _last_refresh = now
+        with catalog_reads():
+            _index.refresh()
+    return _index
+
+
+def match_frame(frame_points, frame_descriptors, marker_type=None, character_ids=None, limit=3):
+    """
+    Marker più simili al frame, verificati geometricamente
+    Returns: lista di dict (character_id, marker_type, votes, matches, inliers, homography)
+    """
+    index = get_marker_index()
+    candidates = []
+    for entry, votes in index.search(frame_descriptors, marker_type, character_ids, limit=limit):
+        inliers, homography, good_matches = verify_candidate(
+            entry, frame_points, frame_descriptors, index.max_hamming
+        )
+        candidates.append({
+            'character_id': entry.key[0],
+            'marker_type': entry.key[1],
+            'votes': votes,
+            'matches': good_matches,
+            'inliers': inliers,
+            'homography': homography.tolist() if homography is not None else None,
+            'marker_size': {'width': entry.width, 'height': entry.height},
+        })
+
+    candidates.sort(key=lambda candidate: (candidate['inliers'], candidate['votes']), reverse=True)
+    return candidates
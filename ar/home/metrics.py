@@ -0,0 +1,417 @@
+"""
+Tempi per fase delle richieste (header Server-Timing) e metriche in formato
+Prometheus servite da /metrics.
+
+Le fasi si misurano con:
+
+    with stage('decode'):
+        ...
+
+e finiscono nell'header Server-Timing della richiesta in corso (MetricsMiddleware)
+e nell'istogramma ar_stage_duration_seconds.
+
+Ogni processo tiene contatori, gauge e istogrammi in memoria. Con METRICS_DIR
+(directory condivisa da tutti i worker gunicorn) ogni processo scrive i propri
+valori in <pid>.json al massimo ogni METRICS_FLUSH_SECONDS, da un thread e mai
+durante la richiesta, e /metrics somma i file: contatori e istogrammi dei
+processi terminati restano nel totale, i gauge contano solo i processi vivi.
+Il master gunicorn (hook child_exit) somma il file di un worker terminato in
+dead.json e lo rimuove, così la directory non cresce con i riavvii dei worker.
+Senza METRICS_DIR /metrics riporta solo il processo che risponde.
+"""
+import atexit
+import contextvars
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Contatori e istogrammi dei processi terminati, in METRICS_DIR
+DEAD_PROCESSES_FILE = 'dead.json'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# nome -> (tipo, descrizione, buckets)
+METRICS = {
+    'ar_http_requests_total': (
+        'counter', 'Richieste HTTP per view e status', None),
+    'ar_http_failures_total': (
+        'counter', 'Richieste fallite (status 5xx) per view e tipo di errore', None),
+    'ar_http_request_duration_seconds': (
+        'histogram', 'Durata delle richieste HTTP per view', DEFAULT_BUCKETS),
+    'ar_stage_duration_seconds': (
+        'histogram', 'Durata delle fasi (Server-Timing) per view o operazione', DEFAULT_BUCKETS),
+    'ar_yolo_model_state': (
+        'gauge', 'Processi per stato del modello YOLO', None),
+    'ar_yolo_queue_depth': (
+        'gauge', 'Frame in coda allo scheduler di inferenza YOLO', None),
+    'ar_yolo_batch_size': (
+        'histogram', 'Frame per forward pass YOLO', (1, 2, 4, 8, 16, 32)),
+    'ar_yolo_batch_duration_seconds': (
+        'histogram', 'Durata del forward pass YOLO batched', DEFAULT_BUCKETS),
+    'ar_yolo_track_total': (
+        'counter', 'Frame in modalità detect-then-track per esito (tracked, lost, redetect)', None),
+    'ar_yolo_frame_cache_total': (
+        'counter', 'Frame di /api/yolo-detect/ serviti dalla cache dei frame quasi identici (hit, miss)', None),
+    'ar_yolo_frame_cache_distance': (
+        'histogram', 'Distanza di Hamming (bit su 64) dal frame in cache più simile', (0, 1, 2, 3, 4, 6, 8, 12, 16, 32)),
+    'ar_marker_jobs_total': (
+        'counter', 'Job di estrazione features marker per esito', None),
+    'ar_image_variant_jobs_total': (
+        'counter', 'Job di generazione varianti immagine per esito', None),
+}
+
+_lock = threading.Lock()
+_counters = {}    # (nome, labels) -> valore
+_histograms = {}  # (nome, labels) -> [conteggi per bucket (+Inf in coda), somma]
+_collectors = []  # funzioni che restituiscono [(nome, labels, valore)] dei gauge, lette a ogni flush
+
+_flush_lock = threading.Lock()
+_write_lock = threading.Lock()
+_flush_state = {'last': 0.0, 'timer': None}
+
+
+def _key(name, labels):
+    return name, tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def inc(name, amount=1, **labels):
+    """Incrementa un contatore"""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+    _schedule_flush()
+
+
+def observe(name, value, **labels):
+    """Aggiunge un valore (in secondi per le durate) a un istogramma"""
+    buckets = METRICS[name][2]
+    key = _key(name, labels)
+    with _lock:
+        entry = _histograms.get(key)
+        if entry is None:
+            entry = _histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+        entry[0][bisect_left(buckets, value)] += 1
+        entry[1] += value
+    _schedule_flush()
+
+
+def register_collector(collector):
+    """Registra una funzione che restituisce i gauge calcolati al momento (es. profondità della coda)"""
+    _collectors.append(collector)
+
+
+class StageTimer:
+    """Durate delle fasi di una richiesta o di un'operazione, in secondi"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        parts = [f'{name};dur={seconds * 1000:.1f}' for name, seconds in self.stages.items()]
+        parts.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(parts)
+
+    def observe(self, scope):
+        for name, seconds in self.stages.items():
+            observe('ar_stage_duration_seconds', seconds, scope=scope, stage=name)
+
+
+_current_timer = contextvars.ContextVar('ar_stage_timer', default=None)
+
+
+def start_timer():
+    """Attiva un nuovo StageTimer nel contesto corrente. Returns: (timer, token per reset_timer)"""
+    timer = StageTimer()
+    return timer, _current_timer.set(timer)
+
+
+def reset_timer(token):
+    _current_timer.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Misura una fase della richiesta o dell'operazione in corso (senza timer attivo non fa nulla)"""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+@contextmanager
+def timed_operation(scope):
+    """
+    Timer per un'operazione che può girare anche fuori da una richiesta (es. estrazione
+    features nel worker dei job): le fasi vanno in ar_stage_duration_seconds con scope,
+    la durata totale diventa una fase della richiesta in corso, se c'è
+    """
+    parent = _current_timer.get()
+    timer, token = start_timer()
+    try:
+        yield timer
+    finally:
+        reset_timer(token)
+        elapsed = timer.elapsed()
+        timer.observe(scope)
+        observe('ar_stage_duration_seconds', elapsed, scope=scope, stage='total')
+        if parent is not None:
+            parent.add(scope, elapsed)
+
+
+def mark_failure(request, error):
+    """Causa di una risposta 5xx (label error di ar_http_failures_total): eccezione o stringa"""
+    request.metrics_error = error if isinstance(error, str) else type(error).__name__
+
+
+def _metrics_dir():
+    return getattr(settings, 'METRICS_DIR', None)
+
+
+def _snapshot():
+    gauges = {}
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                gauges[_key(name, labels)] = value
+        except Exception as e:
+            print(f"Metrics collector error: {e}")
+
+    with _lock:
+        return {
+            'pid': os.getpid(),
+            'counters': [[name, labels, value] for (name, labels), value in _counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in gauges.items()],
+            'histograms': [
+                [name, labels, counts[:], total]
+                for (name, labels), (counts, total) in _histograms.items()
+            ],
+        }
+
+
+def flush():
+    """Scrive le metriche del processo in METRICS_DIR/<pid>.json"""
+    directory = _metrics_dir()
+    if not directory:
+        return
+
+    with _flush_lock:
+        _flush_state['timer'] = None
+        _flush_state['last'] = time.monotonic()
+
+    path = os.path.join(directory, f'{os.getpid()}.json')
+    with _write_lock:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with open(path + '.tmp', 'w') as f:
+                json.dump(_snapshot(), f)
+            os.replace(path + '.tmp', path)
+        except OSError as e:
+            print(f"Metrics flush error: {e}")
+
+
+def _schedule_flush():
+    if not _metrics_dir():
+        return
+
+    with _flush_lock:
+        if _flush_state['timer'] is not None:
+            return
+        interval = getattr(settings, 'METRICS_FLUSH_SECONDS', 1)
+        delay = max(0.0, _flush_state['last'] + interval - time.monotonic())
+        timer = threading.Timer(delay, flush)
+        timer.daemon = True
+        _flush_state['timer'] = timer
+        timer.start()
+
+
+def _reset_after_fork():
+    # Il worker riparte da zero: i valori del master sono nel file del master
+    global _lock, _flush_lock, _write_lock
+    _lock = threading.Lock()
+    _flush_lock = threading.Lock()
+    _write_lock = threading.Lock()
+    _flush_state.update(last=0.0, timer=None)
+    _counters.clear()
+    _histograms.clear()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(flush)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _collect_snapshots():
+    """Snapshot del processo corrente e, con METRICS_DIR, degli altri processi: [(snapshot, vivo)]"""
+    own = _snapshot()
+    snapshots = [(own, True)]
+
+    directory = _metrics_dir()
+    if not directory:
+        return snapshots
+
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return snapshots
+
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        pid = data.get('pid')
+        if pid == own['pid']:
+            continue
+        snapshots.append((data, pid is not None and _pid_alive(pid)))
+    return snapshots
+
+
+def _series_key(name, labels):
+    return name, tuple(map(tuple, labels))
+
+
+def _aggregate(snapshots):
+    """Somma le snapshot [(snapshot, vivo)]. Returns: (counters, gauges, histograms) per chiave"""
+    counters, gauges, histograms = {}, {}, {}
+    for data, alive in snapshots:
+        for name, labels, value in data['counters']:
+            key = _series_key(name, labels)
+            counters[key] = counters.get(key, 0) + value
+        if alive:
+            for name, labels, value in data['gauges']:
+                key = _series_key(name, labels)
+                gauges[key] = gauges.get(key, 0) + value
+        for name, labels, counts, total in data['histograms']:
+            key = _series_key(name, labels)
+            entry = histograms.setdefault(key, [[0] * len(counts), 0.0])
+            if len(entry[0]) != len(counts):
+                continue  # bucket cambiati tra versioni del codice
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+    return counters, gauges, histograms
+
+
+def mark_process_dead(pid):
+    """
+    Somma contatori e istogrammi del processo terminato in METRICS_DIR/dead.json e ne
+    rimuove il file. Va chiamata da un solo processo (master gunicorn, hook child_exit)
+    """
+    directory = _metrics_dir()
+    if not directory:
+        return
+
+    path = os.path.join(directory, f'{pid}.json')
+    dead_path = os.path.join(directory, DEAD_PROCESSES_FILE)
+    try:
+        with open(path) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print(f"Metrics file error ({path}): {e}")
+        data = None
+
+    if data is not None:
+        try:
+            with open(dead_path) as f:
+                dead = json.load(f)
+        except (OSError, ValueError):
+            dead = {'counters': [], 'histograms': []}
+        counters, _, histograms = _aggregate([
+            ({**dead, 'gauges': []}, False), ({**data, 'gauges': []}, False)
+        ])
+        merged = {
+            'pid': None,
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'gauges': [],
+            'histograms': [[name, labels, counts, total] for (name, labels), (counts, total) in histograms.items()],
+        }
+        try:
+            with open(dead_path + '.tmp', 'w') as f:
+                json.dump(merged, f)
+            os.replace(dead_path + '.tmp', dead_path)
+        except OSError as e:
+            print(f"Metrics flush error: {e}")
+            return
+
+    for name in (path, path + '.tmp'):
+        try:
+            os.remove(name)
+        except FileNotFoundError:
+            pass
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _format_labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+    escaped = (
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_metrics():
+    """Metriche di tutti i processi nel formato testo di Prometheus"""
+    counters, gauges, histograms = _aggregate(_collect_snapshots())
+
+    series_by_kind = {'counter': counters, 'gauge': gauges, 'histogram': histograms}
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        series = series_by_kind[kind]
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key in sorted(key for key in series if key[0] == name):
+            labels = key[1]
+            if kind != 'histogram':
+                lines.append(f'{name}{_format_labels(labels)} {_format_value(series[key])}')
+                continue
+
+            counts, total = series[key]
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], counts):
+                cumulative += count
+                le = bound if bound == '+Inf' else _format_value(float(bound))
+                lines.append(f'{name}_bucket{_format_labels(labels, le=le)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+            lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,58 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import inc, observe, reset_timer, start_timer
+
+
+class MetricsMiddleware:
+    """
+    Misura ogni richiesta: header Server-Timing con le fasi registrate da
+    home.metrics.stage() e metriche per view (richieste, errori, latenza).
+    Va messo per primo in MIDDLEWARE, così il totale comprende gli altri middleware
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+
+        timer, token = start_timer()
+        try:
+            response = self.get_response(request)
+        finally:
+            reset_timer(token)
+        return self.finish(request, response, timer)
+
+    async def __acall__(self, request):
+        timer, token = start_timer()
+        try:
+            response = await self.get_response(request)
+        finally:
+            reset_timer(token)
+        return self.finish(request, response, timer)
+
+    def process_exception(self, request, exception):
+        # Eccezioni non gestite dalla view (Django risponde 500)
+        request.metrics_error = type(exception).__name__
+
+    def finish(self, request, response, timer):
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        status = response.status_code
+
+        timer.observe(view)
+        observe('ar_http_request_duration_seconds', timer.elapsed(), view=view)
+        inc('ar_http_requests_total', view=view, status=status)
+        if status >= 500:
+            inc('ar_http_failures_total', view=view, error=getattr(request, 'metrics_error', f'http_{status}'))
+
+        if getattr(settings, 'SERVER_TIMING', True):
+            response['Server-Timing'] = timer.server_timing()
+        return response
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+from home.geo import geo_cell_for
+
+
+def populate_geo_cell(apps, schema_editor):
+    CharConfiguration = apps.get_model('home', 'CharConfiguration')
+    characters = list(CharConfiguration.objects.only('id', 'target_latitude', 'target_longitude'))
+    for char in characters:
+        char.geo_cell = geo_cell_for(char.target_latitude, char.target_longitude)
+    CharConfiguration.objects.bulk_update(characters, ['geo_cell'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0007_update_yolo_help_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charconfiguration',
+            name='geo_cell',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='Cella della griglia spaziale (calcolata automaticamente)', max_length=32),
+        ),
+        migrations.RunPython(populate_geo_cell, migrations.RunPython.noop),
+    ]
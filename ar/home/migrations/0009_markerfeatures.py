@@ -0,0 +1,29 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0008_charconfiguration_geo_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarkerFeatures',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('marker_type', models.CharField(choices=[('detection', 'Detection marker'), ('positioning', 'Positioning marker')], max_length=20)),
+                ('nfeatures', models.IntegerField(help_text="Parametro nfeatures usato per l'estrazione ORB")),
+                ('keypoint_count', models.IntegerField(default=0)),
+                ('data', models.BinaryField(help_text='Header + keypoints float32 + descriptors uint8')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='marker_features', to='home.charconfiguration')),
+            ],
+            options={
+                'unique_together': {('character', 'marker_type')},
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0010_catalogversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charconfiguration',
+            name='marker_features_status',
+            field=models.CharField(choices=[('pending', 'In attesa'), ('done', 'Completato'), ('failed', 'Fallito')], default='done', editable=False, help_text="Stato dell'estrazione features dei marker (eseguita in background da process_marker_jobs)", max_length=10),
+        ),
+        migrations.CreateModel(
+            name='MarkerFeatureJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('marker_type', models.CharField(choices=[('detection', 'Detection marker'), ('positioning', 'Positioning marker')], max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'In attesa'), ('running', 'In esecuzione'), ('done', 'Completato'), ('failed', 'Fallito')], db_index=True, default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='marker_jobs', to='home.charconfiguration')),
+            ],
+            options={
+                'unique_together': {('character', 'marker_type')},
+            },
+        ),
+    ]
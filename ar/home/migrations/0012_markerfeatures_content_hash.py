@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0011_marker_feature_jobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='markerfeatures',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', help_text="SHA-256 dell'immagine marker da cui sono stati estratti i features", max_length=64),
+        ),
+    ]
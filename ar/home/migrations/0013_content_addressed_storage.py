@@ -0,0 +1,33 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:26
+
+import home.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0012_markerfeatures_content_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='charconfiguration',
+            name='character_image',
+            field=models.ImageField(blank=True, help_text='Immagine del personaggio (PNG)', null=True, storage=home.storage.ContentAddressedStorage(), upload_to='characters/'),
+        ),
+        migrations.AlterField(
+            model_name='charconfiguration',
+            name='marker_image',
+            field=models.ImageField(blank=True, help_text='Immagine marker per detection (decide SE mostrare il character)', null=True, storage=home.storage.ContentAddressedStorage(), upload_to='markers/'),
+        ),
+        migrations.AlterField(
+            model_name='charconfiguration',
+            name='positioning_marker_image',
+            field=models.ImageField(blank=True, help_text='Immagine marker per positioning (decide DOVE posizionare il character - opzionale)', null=True, storage=home.storage.ContentAddressedStorage(), upload_to='markers/'),
+        ),
+        migrations.AddIndex(
+            model_name='markerfeatures',
+            index=models.Index(fields=['content_hash', 'nfeatures'], name='markerfeat_hash_nfeat_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0013_content_addressed_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charconfiguration',
+            name='image_variants',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='Varianti ridimensionate delle immagini (generate automaticamente, vedi home/derivatives.py)'),
+        ),
+    ]
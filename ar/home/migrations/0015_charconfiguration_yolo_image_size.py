@@ -0,0 +1,18 @@
+# Generated by Django 5.2.6 on 2026-10-18 11:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0014_charconfiguration_image_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='charconfiguration',
+            name='yolo_image_size',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(320, '320 (veloce, oggetti grandi)'), (480, '480'), (640, '640 (standard)'), (960, '960'), (1280, '1280 (lento, oggetti piccoli o lontani)')], help_text="Dimensione dell'input YOLO per questo personaggio. Vuoto = YOLO_IMAGE_SIZE (640). Solo con il backend pytorch: i modelli esportati hanno dimensione fissa", null=True),
+        ),
+    ]
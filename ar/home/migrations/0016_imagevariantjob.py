@@ -0,0 +1,30 @@
+# Generated by Django 5.2.6 on 2026-10-18 12:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('home', '0015_charconfiguration_yolo_image_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImageVariantJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field_name', models.CharField(choices=[('character_image', 'character_image'), ('marker_image', 'marker_image'), ('positioning_marker_image', 'positioning_marker_image')], max_length=40)),
+                ('status', models.CharField(choices=[('pending', 'In attesa'), ('running', 'In esecuzione'), ('done', 'Completato'), ('failed', 'Fallito')], db_index=True, default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('character', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variant_jobs', to='home.charconfiguration')),
+            ],
+            options={
+                'unique_together': {('character', 'field_name')},
+            },
+        ),
+    ]
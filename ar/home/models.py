@@ -1,11 +1,17 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.core.validators import MinValueValidator, MaxValueValidator
-from django.db.models.signals import pre_save
+from django.db.models import F
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-import cv2
-import numpy as np
-from PIL import Image
-import io
+
+from .features import detect_orb_features, pack_orb_features
+from .derivatives import IMAGE_VARIANTS
+from .geo import geo_cell_for
+from .storage import ContentAddressedStorage, content_hash_from_name
+
+# Immagini salvate per hash del contenuto (home/storage.py)
+content_storage = ContentAddressedStorage()
 
 # Create your models here.
 class CharConfiguration(models.Model):
@@ -29,8 +35,17 @@ class CharConfiguration(models.Model):
         validators=[MinValueValidator(1), MaxValueValidator(1000)],
         help_text="Distanza in metri per attivazione AR"
     )
+    geo_cell = models.CharField(
+        max_length=32,
+        blank=True,
+        default='',
+        db_index=True,
+        editable=False,
+        help_text="Cella della griglia spaziale (calcolata automaticamente)"
+    )
     character_image = models.ImageField(
         upload_to='characters/',
+        storage=content_storage,
         blank=True,
         null=True,
         help_text="Immagine del personaggio (PNG)"
@@ -70,12 +85,14 @@ class CharConfiguration(models.Model):
     )
     marker_image = models.ImageField(
         upload_to='markers/',
+        storage=content_storage,
         blank=True,
         null=True,
         help_text="Immagine marker per detection (decide SE mostrare il character)"
     )
     positioning_marker_image = models.ImageField(
         upload_to='markers/',
+        storage=content_storage,
         blank=True,
         null=True,
         help_text="Immagine marker per positioning (decide DOVE posizionare il character - opzionale)"
@@ -105,6 +122,24 @@ class CharConfiguration(models.Model):
         default=0,
         help_text="Numero di features ORB estratti dal positioning marker (calcolato automaticamente)"
     )
+    image_variants = models.JSONField(
+        default=dict,
+        blank=True,
+        editable=False,
+        help_text="Varianti ridimensionate delle immagini (generate automaticamente, vedi home/derivatives.py)"
+    )
+    MARKER_FEATURES_STATUS_CHOICES = [
+        ('pending', 'In attesa'),
+        ('done', 'Completato'),
+        ('failed', 'Fallito'),
+    ]
+    marker_features_status = models.CharField(
+        max_length=10,
+        choices=MARKER_FEATURES_STATUS_CHOICES,
+        default='done',
+        editable=False,
+        help_text="Stato dell'estrazione features dei marker (eseguita in background da process_marker_jobs)"
+    )
 
     # YOLO Object Detection
     use_yolo_detection = models.BooleanField(
@@ -122,73 +157,387 @@ class CharConfiguration(models.Model):
         validators=[MinValueValidator(0.1), MaxValueValidator(1.0)],
         help_text="Soglia di confidenza minima per detection YOLO (0.5 = 50%)"
     )
+    YOLO_IMAGE_SIZE_CHOICES = [
+        (320, '320 (veloce, oggetti grandi)'),
+        (480, '480'),
+        (640, '640 (standard)'),
+        (960, '960'),
+        (1280, '1280 (lento, oggetti piccoli o lontani)'),
+    ]
+    yolo_image_size = models.PositiveSmallIntegerField(
+        choices=YOLO_IMAGE_SIZE_CHOICES,
+        blank=True,
+        null=True,
+        help_text="Dimensione dell'input YOLO per questo personaggio. Vuoto = YOLO_IMAGE_SIZE (640). Solo con il backend pytorch: i modelli esportati hanno dimensione fissa"
+    )
 
     def __str__(self):
         return self.name
 
 
-def extract_orb_features(image_field, nfeatures=500):
+class CatalogVersion(models.Model):
     """
-    Estrae features ORB da un'immagine Django ImageField
-    Returns: numero di features estratti (int)
+    Contatore (riga singola) incrementato ad ogni modifica dei CharConfiguration:
+    invalida gli snapshot del catalogo (home/catalog.py) ed è la base dell'ETag
     """
+    version = models.PositiveBigIntegerField(default=0)
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+    @classmethod
+    def bump(cls):
+        if not cls.objects.filter(pk=1).update(version=F('version') + 1):
+            cls.objects.get_or_create(pk=1, defaults={'version': 1})
+
+    def __str__(self):
+        return f"Catalogo v{self.version}"
+
+
+class MarkerFeatures(models.Model):
+    """
+    Keypoints e descriptors ORB precalcolati per un marker (formato in home/features.py)
+    """
+    MARKER_TYPE_CHOICES = [
+        ('detection', 'Detection marker'),
+        ('positioning', 'Positioning marker'),
+    ]
+
+    character = models.ForeignKey(
+        CharConfiguration,
+        on_delete=models.CASCADE,
+        related_name='marker_features'
+    )
+    marker_type = models.CharField(max_length=20, choices=MARKER_TYPE_CHOICES)
+    nfeatures = models.IntegerField(help_text="Parametro nfeatures usato per l'estrazione ORB")
+    keypoint_count = models.IntegerField(default=0)
+    content_hash = models.CharField(
+        max_length=64,
+        blank=True,
+        default='',
+        help_text="SHA-256 dell'immagine marker da cui sono stati estratti i features"
+    )
+    data = models.BinaryField(help_text="Header + keypoints float32 + descriptors uint8")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('character', 'marker_type')]
+        indexes = [
+            # Cache dei risultati: stessa immagine + stesso nfeatures = stessi features
+            models.Index(fields=['content_hash', 'nfeatures'], name='markerfeat_hash_nfeat_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.character} - {self.marker_type} ({self.keypoint_count} features)"
+
+
+class MarkerFeatureJob(models.Model):
+    """
+    Estrazione ORB di un marker in coda, eseguita da manage.py process_marker_jobs.
+    Una riga per (character, marker_type): un nuovo upload la rimette in pending.
+    """
+    STATUS_CHOICES = [
+        ('pending', 'In attesa'),
+        ('running', 'In esecuzione'),
+        ('done', 'Completato'),
+        ('failed', 'Fallito'),
+    ]
+
+    character = models.ForeignKey(
+        CharConfiguration,
+        on_delete=models.CASCADE,
+        related_name='marker_jobs'
+    )
+    marker_type = models.CharField(max_length=20, choices=MarkerFeatures.MARKER_TYPE_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('character', 'marker_type')]
+
+    def __str__(self):
+        return f"{self.character} - {self.marker_type} ({self.status})"
+
+
+class ImageVariantJob(models.Model):
+    """
+    Generazione delle varianti di un campo immagine in coda (home/derivatives.py),
+    eseguita da manage.py process_marker_jobs. Una riga per (character, campo):
+    un nuovo upload la rimette in pending.
+    """
+    FIELD_CHOICES = [(field_name, field_name) for field_name in IMAGE_VARIANTS]
+
+    character = models.ForeignKey(
+        CharConfiguration,
+        on_delete=models.CASCADE,
+        related_name='variant_jobs'
+    )
+    field_name = models.CharField(max_length=40, choices=FIELD_CHOICES)
+    status = models.CharField(max_length=10, choices=MarkerFeatureJob.STATUS_CHOICES, default='pending', db_index=True)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = [('character', 'field_name')]
+
+    def __str__(self):
+        return f"{self.character} - {self.field_name} ({self.status})"
+
+
+# marker_type -> (campo immagine, campo conteggio features, nfeatures ORB)
+MARKER_TYPES = {
+    'detection': ('marker_image', 'detection_marker_features', 500),
+    'positioning': ('positioning_marker_image', 'positioning_marker_features', 2000),
+}
+
+
+def read_image_field(image_field):
+    """Byte dell'immagine di un ImageField, None se l'immagine manca"""
     if not image_field:
-        return 0
+        return None
 
+    image_field.open('rb')
     try:
-        # Leggi l'immagine dal field
-        image_field.open('rb')
-        image_data = image_field.read()
+        return image_field.read()
+    finally:
         image_field.close()
 
-        # Converti in numpy array
-        pil_image = Image.open(io.BytesIO(image_data))
-        img_array = np.array(pil_image.convert('RGB'))
 
-        # Converti in grayscale
-        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+def compute_marker_features(image_field, nfeatures=500):
+    """
+    Estrae keypoints e descriptors ORB da un'immagine Django ImageField
+    Returns: (points, descriptors, width, height) oppure None se l'immagine manca
+    """
+    image_data = read_image_field(image_field)
+    if image_data is None:
+        return None
+
+    return detect_orb_features(image_data, nfeatures)
 
-        # Estrai features ORB
-        orb = cv2.ORB_create(nfeatures)
-        keypoints, descriptors = orb.detectAndCompute(gray, None)
 
-        return len(keypoints) if keypoints else 0
+def extract_orb_features(image_field, nfeatures=500):
+    """
+    Estrae features ORB da un'immagine Django ImageField
+    Returns: numero di features estratti (int)
+    """
+    try:
+        features = compute_marker_features(image_field, nfeatures)
+        return len(features[0]) if features else 0
     except Exception as e:
         print(f"Error extracting ORB features: {e}")
         return 0
 
 
+def build_marker_features(character_id, marker_type, features, nfeatures, content_hash=''):
+    """
+    MarkerFeatures non salvato a partire dal risultato di detect_orb_features
+    """
+    points, descriptors, width, height = features
+    return MarkerFeatures(
+        character_id=character_id,
+        marker_type=marker_type,
+        nfeatures=nfeatures,
+        keypoint_count=len(points),
+        content_hash=content_hash,
+        data=pack_orb_features(points, descriptors, width, height),
+    )
+
+
+def store_marker_features(character, marker_type, features, nfeatures, content_hash=''):
+    """
+    Salva (o rimuove se features è None) il blob dei features di un marker
+    """
+    if features is None:
+        MarkerFeatures.objects.filter(character=character, marker_type=marker_type).delete()
+        return
+
+    marker_features = build_marker_features(character.pk, marker_type, features, nfeatures, content_hash)
+    MarkerFeatures.objects.update_or_create(
+        character=character,
+        marker_type=marker_type,
+        defaults={
+            'nfeatures': marker_features.nfeatures,
+            'keypoint_count': marker_features.keypoint_count,
+            'content_hash': marker_features.content_hash,
+            'data': marker_features.data,
+        }
+    )
+
+
+def find_cached_marker_features(content_hash, nfeatures):
+    """
+    Features già estratti da un'immagine con lo stesso hash e nfeatures
+    (upload duplicato o marker condiviso tra personaggi), None se assenti
+    """
+    if not content_hash:
+        return None
+    return MarkerFeatures.objects.filter(
+        content_hash=content_hash, nfeatures=nfeatures
+    ).only('keypoint_count', 'data').first()
+
+
+def copy_marker_features(character, marker_type, cached, nfeatures, content_hash):
+    """Salva per il personaggio una copia del blob trovato in cache"""
+    MarkerFeatures.objects.update_or_create(
+        character=character,
+        marker_type=marker_type,
+        defaults={
+            'nfeatures': nfeatures,
+            'keypoint_count': cached.keypoint_count,
+            'content_hash': content_hash,
+            'data': cached.data,
+        }
+    )
+
+
+@receiver(pre_save, sender=CharConfiguration)
+def update_geo_cell(sender, instance, **kwargs):
+    """
+    Aggiorna la cella spaziale usata dalle query "nearby"
+    """
+    instance.geo_cell = geo_cell_for(instance.target_latitude, instance.target_longitude)
+
+
+def enqueue_marker_jobs(character, marker_types):
+    """
+    Mette in coda l'estrazione features dei marker indicati
+    """
+    for marker_type in marker_types:
+        MarkerFeatureJob.objects.update_or_create(
+            character=character,
+            marker_type=marker_type,
+            defaults={'status': 'pending', 'error': ''}
+        )
+
+    _process_after_commit(character)
+
+
+def enqueue_variant_jobs(character, field_names):
+    """
+    Mette in coda la generazione delle varianti dei campi immagine indicati
+    """
+    for field_name in field_names:
+        ImageVariantJob.objects.update_or_create(
+            character=character,
+            field_name=field_name,
+            defaults={'status': 'pending', 'error': ''}
+        )
+
+    _process_after_commit(character)
+
+
+def _process_after_commit(character):
+    if not getattr(settings, 'MARKER_FEATURES_BACKGROUND', True):
+        # Modalità sincrona (sviluppo): esegui subito dopo il commit
+        from .jobs import process_character_jobs
+        transaction.on_commit(lambda: process_character_jobs(character.pk))
+
+
 @receiver(pre_save, sender=CharConfiguration)
 def calculate_marker_features(sender, instance, **kwargs):
     """
-    Calcola automaticamente i features dei marker prima del salvataggio
-    """
-    # Calcola features del detection marker
-    if instance.marker_image:
-        try:
-            # Verifica se l'immagine è cambiata
-            if instance.pk:
-                old_instance = CharConfiguration.objects.get(pk=instance.pk)
-                if old_instance.marker_image != instance.marker_image:
-                    instance.detection_marker_features = extract_orb_features(instance.marker_image, nfeatures=500)
-            else:
-                # Nuova istanza
-                instance.detection_marker_features = extract_orb_features(instance.marker_image, nfeatures=500)
-        except Exception as e:
-            print(f"Error calculating detection marker features: {e}")
-
-    # Calcola features del positioning marker
-    if instance.positioning_marker_image:
-        try:
-            # Verifica se l'immagine è cambiata
-            if instance.pk:
-                old_instance = CharConfiguration.objects.get(pk=instance.pk)
-                if old_instance.positioning_marker_image != instance.positioning_marker_image:
-                    instance.positioning_marker_features = extract_orb_features(instance.positioning_marker_image, nfeatures=2000)
-            else:
-                # Nuova istanza
-                instance.positioning_marker_features = extract_orb_features(instance.positioning_marker_image, nfeatures=2000)
-        except Exception as e:
-            print(f"Error calculating positioning marker features: {e}")
+    Individua i marker cambiati prima del salvataggio.
+    Se l'immagine (per hash) è già stata elaborata i features vengono riusati,
+    altrimenti in post_save viene accodato un MarkerFeatureJob.
+    """
+    old_images = None
+    if instance.pk:
+        old_images = CharConfiguration.objects.filter(pk=instance.pk).values(*IMAGE_VARIANTS).first()
+
+    # Immagini nuove, sostituite o rimosse: le varianti vanno rigenerate in post_save
+    instance._variant_changes = [
+        field_name for field_name in IMAGE_VARIANTS
+        if old_images is None or (old_images.get(field_name) or '') != (getattr(instance, field_name).name or '')
+    ]
+
+    changed, cleared = [], []
+    for marker_type, (image_field_name, _, _) in MARKER_TYPES.items():
+        image_name = getattr(instance, image_field_name).name or ''
+        old_image_name = (old_images or {}).get(image_field_name) or ''
+
+        if not image_name:
+            if old_image_name:
+                cleared.append(marker_type)
+            continue
+
+        # Verifica se l'immagine è cambiata
+        if old_images is not None and old_image_name == image_name:
+            continue
+        changed.append(marker_type)
+
+    # Immagini già elaborate (stesso hash): conteggi subito, nessuna estrazione
+    cached = {}
+    for marker_type in changed:
+        image_field_name, count_field_name, nfeatures = MARKER_TYPES[marker_type]
+        content_hash = content_hash_from_name(getattr(instance, image_field_name).name)
+        hit = find_cached_marker_features(content_hash, nfeatures)
+        if hit is not None:
+            cached[marker_type] = (hit, nfeatures, content_hash)
+            setattr(instance, count_field_name, hit.keypoint_count)
+
+    changed = [marker_type for marker_type in changed if marker_type not in cached]
+    if changed:
+        instance.marker_features_status = 'pending'
+    instance._marker_changes = (changed, cleared, cached)
+
+
+@receiver(post_save, sender=CharConfiguration)
+def save_marker_features(sender, instance, **kwargs):
+    """
+    Accoda l'estrazione dei marker cambiati e rimuove i features dei marker eliminati
+    """
+    changed, cleared, cached = getattr(instance, '_marker_changes', ([], [], {}))
+
+    for marker_type in cleared:
+        store_marker_features(instance, marker_type, None, 0)
+    for marker_type, (hit, nfeatures, content_hash) in cached.items():
+        copy_marker_features(instance, marker_type, hit, nfeatures, content_hash)
+    if cached:
+        # Un job ancora in coda per un'immagine precedente non serve più
+        MarkerFeatureJob.objects.filter(
+            character=instance, marker_type__in=list(cached), status='pending'
+        ).update(status='done', error='')
+    if changed:
+        enqueue_marker_jobs(instance, changed)
 
+    instance._marker_changes = ([], [], {})
 
+
+@receiver(post_save, sender=CharConfiguration)
+def update_image_variants(sender, instance, **kwargs):
+    """
+    Accoda la generazione delle varianti delle immagini cambiate.
+    Le varianti dell'immagine precedente vengono tolte subito (prima di
+    bump_catalog_version): finché il job non termina il client usa l'originale
+    """
+    field_names = getattr(instance, '_variant_changes', [])
+    if not field_names:
+        return
+
+    if any(field_name in (instance.image_variants or {}) for field_name in field_names):
+        instance.image_variants = {
+            field_name: names for field_name, names in instance.image_variants.items()
+            if field_name not in field_names
+        }
+        # update() e non save(): non deve riattivare i signal
+        CharConfiguration.objects.filter(pk=instance.pk).update(image_variants=instance.image_variants)
+
+    present = [field_name for field_name in field_names if getattr(instance, field_name)]
+    if present:
+        enqueue_variant_jobs(instance, present)
+    instance._variant_changes = []
+
+
+@receiver(post_save, sender=CharConfiguration)
+@receiver(post_delete, sender=CharConfiguration)
+def bump_catalog_version(sender, **kwargs):
+    """
+    Invalida gli snapshot del catalogo serializzato
+    """
+    CatalogVersion.bump()
@@ -0,0 +1,64 @@
+"""
+Router database: le letture del catalogo (snapshot delle view camera e di
+/api/characters/, filtro dei vicini, features dei marker, indice di
+/api/marker-match/) vanno sulla replica DATABASE_REPLICA_ALIAS, se configurata.
+Tutto il resto, scritture comprese (admin, scanner, job), usa il primario.
+
+Le letture da instradare sulla replica sono solo quelle dentro catalog_reads():
+admin e job rileggono quello che hanno appena scritto e non devono vedere il
+ritardo della replica. Versione del catalogo e dati arrivano dallo stesso database,
+quindi uno snapshot non associa mai dati vecchi a una versione nuova.
+Per lo stesso motivo, dopo una scrittura anche le letture dentro catalog_reads()
+restano sul primario fino alla richiesta successiva (per i job: nel thread).
+"""
+import contextvars
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import connections
+from django.dispatch import receiver
+
+_catalog_reads = contextvars.ContextVar('ar_catalog_reads', default=False)
+_wrote_primary = contextvars.ContextVar('ar_wrote_primary', default=False)
+
+
+@receiver(request_started)
+def reset_primary_reads(**kwargs):
+    """Ogni richiesta riparte leggendo il catalogo dalla replica"""
+    _wrote_primary.set(False)
+
+
+@contextmanager
+def catalog_reads():
+    """Le letture dei modelli di home nel blocco possono andare sulla replica"""
+    token = _catalog_reads.set(True)
+    try:
+        yield
+    finally:
+        _catalog_reads.reset(token)
+
+
+def replica_alias():
+    """Alias della replica, None se non configurata"""
+    alias = getattr(settings, 'DATABASE_REPLICA_ALIAS', 'replica')
+    return alias if alias in connections.settings else None
+
+
+class CatalogReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _catalog_reads.get() and not _wrote_primary.get() and model._meta.app_label == 'home':
+            return replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        _wrote_primary.set(True)
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Primario e replica contengono gli stessi dati
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # La replica riceve lo schema dalla replicazione
+        return db == 'default'
@@ -0,0 +1,51 @@
+"""
+Cache in memoria per lo stato legato alla sessione di un client (es. tracker YOLO).
+
+LRU con scadenza (ttl secondi dall'ultimo accesso), limitata a max_entries e
+sicura tra thread. È per processo: con più worker gunicorn una sessione che
+finisce su un altro worker riparte da zero, che è sempre corretto, solo più lento.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class SessionCache:
+    def __init__(self, max_entries=1000, ttl=30):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = float(ttl)
+        self._entries = OrderedDict()  # chiave -> (scadenza, valore)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < now:
+                del self._entries[key]
+                return None
+            self._entries[key] = (now + self.ttl, entry[1])
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            # Prima le scadute (in testa, le meno usate), poi le meno recenti oltre il limite
+            while self._entries:
+                oldest_key, (expires, _) = next(iter(self._entries.items()))
+                if expires >= now and len(self._entries) <= self.max_entries:
+                    break
+                del self._entries[oldest_key]
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return entry[1] if entry is not None else None
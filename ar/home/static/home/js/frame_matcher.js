@@ -0,0 +1,226 @@
+// Matcher ORB persistente per il loop di detection (usato da vision_worker.js).
+// ORB, BFMatcher e i Mat di input, grayscale, keypoints e descrittori sono allocati una
+// volta e riusati a ogni frame; i Mat dell'immagine vengono riallocati solo quando cambia
+// la risoluzione. Crearli a ogni frame frammenta l'heap WASM e su mobile causa pause per
+// la crescita dell'heap. Chiamare dispose() per liberare la memoria WASM.
+
+class FrameMatcher {
+    constructor(nfeatures = 1000) {
+        this.nfeatures = nfeatures;
+        this.orb = new cv.ORB(nfeatures);
+        this.crossCheckMatcher = new cv.BFMatcher(cv.NORM_HAMMING, true);
+        this.knnMatcher = new cv.BFMatcher(cv.NORM_HAMMING, false);
+
+        this.mask = new cv.Mat();
+        this.keypoints = new cv.KeyPointVector();
+        this.descriptors = new cv.Mat();
+        this.matches = new cv.DMatchVector();
+        this.knnMatches = new cv.DMatchVectorVector();
+
+        // Allocati da resize() alla prima immagine
+        this.width = 0;
+        this.height = 0;
+        this.input = null;
+        this.gray = null;
+
+        // Buffer JS riusati: coordinate dei keypoints e coppie (frame, marker) dei match
+        this.points = new Float32Array(nfeatures * 2);
+        this.pairs = new Int32Array(nfeatures * 2);
+        this.keypointCount = 0;
+
+        this.lastHeapBytes = FrameMatcher.heapBytes();
+    }
+
+    static heapBytes() {
+        const heap = cv.HEAPU8 || cv.HEAP8;
+        return heap ? heap.buffer.byteLength : 0;
+    }
+
+    setMaxFeatures(nfeatures) {
+        if (nfeatures === this.nfeatures) {
+            return;
+        }
+        if (typeof this.orb.setMaxFeatures === 'function') {
+            this.orb.setMaxFeatures(nfeatures);
+        } else {
+            this.orb.delete();
+            this.orb = new cv.ORB(nfeatures);
+        }
+        this.nfeatures = nfeatures;
+    }
+
+    resize(width, height) {
+        if (width === this.width && height === this.height) {
+            return;
+        }
+        if (this.input) {
+            this.input.delete();
+            this.gray.delete();
+        }
+        this.input = new cv.Mat(height, width, cv.CV_8UC4);
+        this.gray = new cv.Mat(height, width, cv.CV_8UC1);
+        this.width = width;
+        this.height = height;
+    }
+
+    // ORB sull'immagine RGBA: keypoints in this.points, descrittori in this.descriptors
+    detect(imageData) {
+        this.resize(imageData.width, imageData.height);
+        this.input.data.set(imageData.data);
+        cv.cvtColor(this.input, this.gray, cv.COLOR_RGBA2GRAY);
+        this.orb.detectAndCompute(this.gray, this.mask, this.keypoints, this.descriptors);
+
+        const count = this.keypoints.size();
+        if (this.points.length < count * 2) {
+            this.points = new Float32Array(count * 2);
+        }
+        for (let i = 0; i < count; i++) {
+            const pt = this.keypoints.get(i).pt;
+            this.points[2 * i] = pt.x;
+            this.points[2 * i + 1] = pt.y;
+        }
+        this.keypointCount = count;
+        return count;
+    }
+
+    // Match del frame corrente con un marker: coppie (keypoint frame, keypoint marker) in this.pairs
+    match(marker, { ratio = 0, maxDistance = 70 } = {}) {
+        if (this.keypointCount === 0 || marker.descriptors.rows === 0) {
+            return 0;
+        }
+        if (this.pairs.length < this.keypointCount * 2) {
+            this.pairs = new Int32Array(this.keypointCount * 2);
+        }
+
+        let count = 0;
+        if (ratio) {
+            this.knnMatcher.knnMatch(this.descriptors, marker.descriptors, this.knnMatches, 2);
+            for (let i = 0; i < this.knnMatches.size(); i++) {
+                const match = this.knnMatches.get(i);
+                let best = null;
+                if (match.size() >= 2) {
+                    const m1 = match.get(0);
+                    const m2 = match.get(1);
+                    if (m1.distance < ratio * m2.distance && m1.distance < maxDistance) {
+                        best = m1;
+                    }
+                } else if (match.size() === 1 && match.get(0).distance < maxDistance) {
+                    best = match.get(0);
+                }
+                match.delete();
+                if (best) {
+                    this.pairs[2 * count] = best.queryIdx;
+                    this.pairs[2 * count + 1] = best.trainIdx;
+                    count++;
+                }
+            }
+        } else {
+            this.crossCheckMatcher.match(this.descriptors, marker.descriptors, this.matches);
+            for (let i = 0; i < this.matches.size(); i++) {
+                const m = this.matches.get(i);
+                if (m.distance < maxDistance) {
+                    this.pairs[2 * count] = m.queryIdx;
+                    this.pairs[2 * count + 1] = m.trainIdx;
+                    count++;
+                }
+            }
+        }
+        return count;
+    }
+
+    // Coordinate nel frame dei keypoints con match (copia trasferibile al main thread)
+    matchedPoints(count) {
+        const points = new Float32Array(count * 2);
+        for (let i = 0; i < count; i++) {
+            const f = this.pairs[2 * i];
+            points[2 * i] = this.points[2 * f];
+            points[2 * i + 1] = this.points[2 * f + 1];
+        }
+        return points;
+    }
+
+    // Homography marker -> frame con RANSAC sui primi count match: posa del marker nel frame
+    homography(marker, count) {
+        // Unici Mat per frame: dimensione variabile con il numero di match, liberati subito
+        const src = new cv.Mat(count, 1, cv.CV_32FC2);
+        const dst = new cv.Mat(count, 1, cv.CV_32FC2);
+        const srcData = src.data32F;
+        const dstData = dst.data32F;
+        for (let i = 0; i < count; i++) {
+            const f = this.pairs[2 * i];
+            const pt = marker.keypoints.get(this.pairs[2 * i + 1]).pt;
+            srcData[2 * i] = pt.x;
+            srcData[2 * i + 1] = pt.y;
+            dstData[2 * i] = this.points[2 * f];
+            dstData[2 * i + 1] = this.points[2 * f + 1];
+        }
+
+        const inlierMask = new cv.Mat();
+        const H = cv.findHomography(src, dst, cv.RANSAC, 5.0, inlierMask);
+
+        let result;
+        if (H.empty()) {
+            result = { valid: false, reason: 'Homography failed', determinant: 0 };
+        } else {
+            // Il range del determinante è simmetrico (|det| e 1/|det|): stesso criterio dei loop originali frame -> marker
+            const det = cv.determinant(H);
+            const matrix = Array.from(H.data64F);
+            let inliers = 0;
+            for (let i = 0; i < inlierMask.rows; i++) {
+                inliers += inlierMask.data[i] ? 1 : 0;
+            }
+
+            if (Math.abs(det) < 0.01) {
+                result = { valid: false, reason: `Degenerate (det=${det.toFixed(3)})`, determinant: det };
+            } else if (Math.abs(det) > 100) {
+                result = { valid: false, reason: `Extreme transform (det=${det.toFixed(1)})`, determinant: det };
+            } else {
+                result = {
+                    valid: true,
+                    determinant: det,
+                    inliers: inliers,
+                    matrix: matrix,
+                    corners: projectCorners(matrix, marker.width, marker.height)
+                };
+            }
+        }
+
+        src.delete();
+        dst.delete();
+        inlierMask.delete();
+        H.delete();
+        return result;
+    }
+
+    // Dimensione dell'heap WASM e crescita dall'ultima chiamata (per frame)
+    heapUsage() {
+        const bytes = FrameMatcher.heapBytes();
+        const grown = bytes - this.lastHeapBytes;
+        this.lastHeapBytes = bytes;
+        return { bytes, grown };
+    }
+
+    dispose() {
+        for (const object of [
+            this.orb, this.crossCheckMatcher, this.knnMatcher, this.mask, this.keypoints,
+            this.descriptors, this.matches, this.knnMatches, this.input, this.gray
+        ]) {
+            if (object) {
+                object.delete();
+            }
+        }
+        this.input = null;
+        this.gray = null;
+        this.width = 0;
+        this.height = 0;
+    }
+}
+
+function projectCorners(h, width, height) {
+    const corners = [];
+    for (const [x, y] of [[0, 0], [width, 0], [width, height], [0, height]]) {
+        const w = h[6] * x + h[7] * y + h[8];
+        corners.push((h[0] * x + h[1] * y + h[2]) / w, (h[3] * x + h[4] * y + h[5]) / w);
+    }
+    return corners;
+}
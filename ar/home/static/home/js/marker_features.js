@@ -0,0 +1,65 @@
+// Features ORB precalcolati dal server (formato binario descritto in home/features.py).
+// Evita di scaricare l'immagine marker e rifare detectAndCompute in opencv.js all'avvio.
+
+const MARKER_FEATURES_HEADER_SIZE = 20;
+
+// Espone la stessa interfaccia di cv.KeyPointVector usata dai loop di matching
+// (size(), get(i).pt, delete()) senza allocare memoria WASM
+class MarkerKeypoints {
+    constructor(points) {
+        this.points = points;
+    }
+
+    size() {
+        return this.points.length / 2;
+    }
+
+    get(i) {
+        return { pt: { x: this.points[2 * i], y: this.points[2 * i + 1] } };
+    }
+
+    delete() {
+        this.points = new Float32Array(0);
+    }
+}
+
+function decodeMarkerFeatures(buffer) {
+    const view = new DataView(buffer);
+    const magic = String.fromCharCode(view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+    if (magic !== 'ORB1' || view.getUint16(4, true) !== 1) {
+        throw new Error('Formato marker features non supportato');
+    }
+
+    const descriptorSize = view.getUint16(6, true);
+    const count = view.getUint32(8, true);
+    const width = view.getUint32(12, true);
+    const height = view.getUint32(16, true);
+
+    const points = new Float32Array(buffer, MARKER_FEATURES_HEADER_SIZE, count * 2);
+    const descriptorBytes = new Uint8Array(buffer, MARKER_FEATURES_HEADER_SIZE + count * 8, count * descriptorSize);
+
+    const descriptors = new cv.Mat(count, descriptorSize, cv.CV_8U);
+    descriptors.data.set(descriptorBytes);
+
+    return {
+        keypoints: new MarkerKeypoints(points),
+        descriptors: descriptors,
+        width: width,
+        height: height,
+        featureCount: count
+    };
+}
+
+async function fetchMarkerFeatures(charId, markerType) {
+    const response = await fetch(`/api/marker-features/${charId}/${markerType}/`);
+    if (!response.ok) {
+        throw new Error(`Marker features non disponibili (HTTP ${response.status})`);
+    }
+    return decodeMarkerFeatures(await response.arrayBuffer());
+}
+
+// URL di una variante generata dal server (es. 'gray', 'webp_512'), altrimenti l'immagine originale
+function imageVariantUrl(char, field, variant) {
+    const variants = char[field + '_variants'] || {};
+    return variants[variant] || char[field];
+}
@@ -0,0 +1,169 @@
+// Client della pipeline di visione in Web Worker (vision_worker.js).
+// Un solo frame alla volta è in elaborazione: le richieste arrivate nel frattempo si
+// sostituiscono a vicenda e il frame viene catturato solo quando il worker è libero,
+// quindi si elabora sempre l'immagine più recente (latest-frame-wins).
+
+class VisionPipeline {
+    constructor({ workerUrl, opencvUrl, scripts = [], onResult = null, onError = null }) {
+        this.onResult = onResult;
+        this.onError = onError;
+        this.busy = false;
+        this.pending = null;
+        this.inFlight = null;
+        this.nextFrameId = 1;
+        this.nextRequestId = 1;
+        this.requests = new Map(); // requestId -> { resolve, reject }
+        this.useBitmap = false;
+        this.stats = { submitted: 0, processed: 0, dropped: 0, latency: 0, workerTime: 0, heapBytes: 0 };
+
+        // Canvas per catturare ImageData se il worker non ha OffscreenCanvas
+        this.canvas = null;
+        this.context = null;
+
+        this.worker = new Worker(workerUrl);
+        this.worker.onmessage = (event) => this.handleMessage(event.data);
+        this.ready = new Promise((resolve, reject) => {
+            this.resolveReady = resolve;
+            this.rejectReady = reject;
+            this.worker.onerror = (event) => {
+                reject(new Error(event.message || 'Vision worker error'));
+            };
+        });
+        this.worker.postMessage({ type: 'init', opencvUrl: opencvUrl, scripts: scripts });
+    }
+
+    // Carica nel worker i features di un marker (precalcolati dal server o estratti dall'immagine)
+    loadMarker(key, char, markerType, imageUrl, nfeatures) {
+        const requestId = this.nextRequestId++;
+        return new Promise((resolve, reject) => {
+            this.requests.set(requestId, { resolve, reject });
+            this.worker.postMessage({
+                type: 'marker',
+                requestId: requestId,
+                key: key,
+                charId: char.id,
+                markerType: markerType,
+                imageUrl: imageUrl,
+                nfeatures: nfeatures
+            });
+        });
+    }
+
+    // Richiede l'elaborazione del frame corrente di source (video o canvas) con le query indicate
+    submit(source, options) {
+        this.stats.submitted++;
+        if (this.busy) {
+            if (this.pending) {
+                this.stats.dropped++;
+            }
+            this.pending = { source, options };
+            return;
+        }
+        this.dispatch(source, options);
+    }
+
+    async dispatch(source, options) {
+        this.busy = true;
+        const frameId = this.nextFrameId++;
+        const message = {
+            type: 'frame',
+            frameId: frameId,
+            nfeatures: options.nfeatures,
+            queries: options.queries
+        };
+        let transfer;
+
+        try {
+            if (this.useBitmap) {
+                message.bitmap = await createImageBitmap(source);
+                transfer = [message.bitmap];
+            } else {
+                const width = source.videoWidth || source.width;
+                const height = source.videoHeight || source.height;
+                if (!this.canvas) {
+                    this.canvas = document.createElement('canvas');
+                    this.context = this.canvas.getContext('2d', { willReadFrequently: true });
+                }
+                if (this.canvas.width !== width || this.canvas.height !== height) {
+                    this.canvas.width = width;
+                    this.canvas.height = height;
+                }
+                this.context.drawImage(source, 0, 0, width, height);
+                message.imageData = this.context.getImageData(0, 0, width, height);
+                transfer = [message.imageData.data.buffer];
+            }
+        } catch (error) {
+            this.finishFrame();
+            this.reportError(error);
+            return;
+        }
+
+        // Dati del chiamante restituiti con il risultato (es. stato GPS al momento della cattura)
+        this.inFlight = { sentAt: performance.now(), context: options.context };
+        this.worker.postMessage(message, transfer);
+    }
+
+    finishFrame() {
+        this.busy = false;
+        if (this.pending) {
+            const { source, options } = this.pending;
+            this.pending = null;
+            this.dispatch(source, options);
+        }
+    }
+
+    handleMessage(message) {
+        if (message.type === 'ready') {
+            this.useBitmap = message.offscreen && typeof createImageBitmap === 'function';
+            this.resolveReady();
+        } else if (message.type === 'init-error') {
+            this.rejectReady(new Error(message.error));
+        } else if (message.type === 'marker') {
+            const request = this.requests.get(message.requestId);
+            this.requests.delete(message.requestId);
+            if (request) {
+                if (message.error) {
+                    request.reject(new Error(message.error));
+                } else {
+                    request.resolve(message.marker);
+                }
+            }
+        } else if (message.type === 'result') {
+            this.stats.processed++;
+            this.stats.latency = performance.now() - this.inFlight.sentAt;
+            this.stats.workerTime = message.elapsed;
+            this.stats.heapBytes = message.heap.bytes;
+            if (message.heap.grown > 0) {
+                // A regime l'heap WASM non deve crescere: ogni crescita è una pausa su mobile
+                console.log(`[vision] WASM heap grew by ${(message.heap.grown / 1048576).toFixed(1)} MB to ${(message.heap.bytes / 1048576).toFixed(1)} MB`);
+            }
+            message.context = this.inFlight.context;
+            this.finishFrame();
+            if (this.onResult) {
+                this.onResult(message);
+            }
+        } else if (message.type === 'error') {
+            this.finishFrame();
+            this.reportError(new Error(message.error));
+        }
+    }
+
+    reportError(error) {
+        if (this.onError) {
+            this.onError(error);
+        } else {
+            console.log('Vision pipeline error:', error);
+        }
+    }
+
+    // Libera la memoria WASM del worker (matcher e marker) e lo termina
+    dispose() {
+        this.pending = null;
+        // Il worker libera matcher e marker e poi si chiude
+        this.worker.postMessage({ type: 'dispose' });
+        for (const request of this.requests.values()) {
+            request.reject(new Error('Vision pipeline disposed'));
+        }
+        this.requests.clear();
+    }
+}
@@ -0,0 +1,202 @@
+// Pipeline di visione in Web Worker: ORB sul frame, matching con i marker e homography
+// fuori dal main thread. Il client è VisionPipeline (vision_pipeline.js).
+//
+// Messaggi ricevuti:
+//   init   { opencvUrl, scripts }                 -> ready { offscreen }
+//   marker { requestId, key, charId, markerType,  -> marker { requestId, marker | error }
+//            imageUrl, nfeatures }
+//   frame  { frameId, bitmap | imageData,         -> result { frameId, width, height,
+//            nfeatures, queries }                            keypointCount, results, elapsed, heap }
+//   dispose                                        libera la memoria WASM di matcher e marker
+//
+// Ogni query descrive il matching di un marker sul frame:
+//   { key, ratio, maxDistance, homography, minMatches, after: { key, minMatches } }
+// ratio: ratio test di Lowe su knnMatch (altrimenti BFMatcher con crossCheck)
+// homography: verifica RANSAC se i match sono almeno minMatches (default 10)
+// after: la query viene eseguita solo se il marker indicato ha abbastanza match accettati
+//
+// ORB e matching usano un FrameMatcher persistente (frame_matcher.js, tra gli script di init)
+
+const markers = new Map(); // key -> { keypoints, descriptors, width, height, featureCount }
+let matcher = null;
+let canvas = null;
+let context = null;
+
+function waitForOpenCv() {
+    return new Promise((resolve) => {
+        if (self.cv.Mat) {
+            resolve();
+        } else if (typeof self.cv.then === 'function') {
+            // Build MODULARIZE: cv è una promise del modulo (non usare await: il modulo è a sua volta thenable)
+            self.cv.then((module) => {
+                self.cv = module;
+                resolve();
+            });
+        } else {
+            self.cv.onRuntimeInitialized = resolve;
+        }
+    });
+}
+
+function getContext(width, height) {
+    if (!canvas) {
+        canvas = new OffscreenCanvas(width, height);
+        context = canvas.getContext('2d', { willReadFrequently: true });
+    }
+    if (canvas.width !== width || canvas.height !== height) {
+        canvas.width = width;
+        canvas.height = height;
+    }
+    return context;
+}
+
+function readImageData(message) {
+    if (message.imageData) {
+        return message.imageData;
+    }
+    const bitmap = message.bitmap;
+    const ctx = getContext(bitmap.width, bitmap.height);
+    ctx.drawImage(bitmap, 0, 0);
+    bitmap.close();
+    return ctx.getImageData(0, 0, canvas.width, canvas.height);
+}
+
+async function loadMarker(message) {
+    // Features precalcolati dal server, altrimenti ORB sull'immagine del marker
+    try {
+        return await fetchMarkerFeatures(message.charId, message.markerType);
+    } catch (error) {
+        console.log(`[vision] precomputed ${message.markerType} features unavailable for ${message.charId}:`, error.message);
+    }
+
+    const response = await fetch(message.imageUrl);
+    if (!response.ok) {
+        throw new Error(`Immagine marker non disponibile (HTTP ${response.status})`);
+    }
+    const imageData = readImageData({ bitmap: await createImageBitmap(await response.blob()) });
+
+    // Matcher temporaneo: il marker ha una risoluzione diversa dai frame
+    const markerMatcher = new FrameMatcher(message.nfeatures);
+    try {
+        const count = markerMatcher.detect(imageData);
+        return {
+            keypoints: new MarkerKeypoints(markerMatcher.points.slice(0, count * 2)),
+            descriptors: markerMatcher.descriptors.clone(),
+            width: imageData.width,
+            height: imageData.height,
+            featureCount: count
+        };
+    } finally {
+        markerMatcher.dispose();
+    }
+}
+
+function processFrame(message) {
+    const start = performance.now();
+    const imageData = readImageData(message);
+    const nfeatures = message.nfeatures || 1000;
+
+    if (!matcher) {
+        matcher = new FrameMatcher(nfeatures);
+    }
+    matcher.setMaxFeatures(nfeatures);
+    const keypointCount = matcher.detect(imageData);
+
+    const results = {};
+    const transfer = [];
+
+    for (const query of message.queries) {
+        const marker = markers.get(query.key);
+        if (!marker || keypointCount === 0) {
+            continue;
+        }
+        if (query.after) {
+            const previous = results[query.after.key];
+            if (!previous || previous.accepted < query.after.minMatches) {
+                continue;
+            }
+        }
+
+        const count = matcher.match(marker, query);
+        const points = matcher.matchedPoints(count);
+
+        let homography = null;
+        if (query.homography && count >= Math.max(query.minMatches || 10, 4)) {
+            homography = matcher.homography(marker, count);
+        }
+
+        results[query.key] = {
+            count: count,
+            // Match rifiutati dalla verifica geometrica non contano (vedi query.after)
+            accepted: homography && !homography.valid ? 0 : count,
+            points: points,
+            homography: homography
+        };
+        transfer.push(points.buffer);
+    }
+
+    postMessage({
+        type: 'result',
+        frameId: message.frameId,
+        width: imageData.width,
+        height: imageData.height,
+        keypointCount: keypointCount,
+        results: results,
+        elapsed: performance.now() - start,
+        heap: matcher.heapUsage()
+    }, transfer);
+}
+
+function dispose() {
+    if (matcher) {
+        matcher.dispose();
+        matcher = null;
+    }
+    for (const marker of markers.values()) {
+        marker.descriptors.delete();
+    }
+    markers.clear();
+}
+
+self.onmessage = async (event) => {
+    const message = event.data;
+    try {
+        if (message.type === 'init') {
+            try {
+                importScripts(message.opencvUrl, ...(message.scripts || []));
+                await waitForOpenCv();
+            } catch (error) {
+                // Il worker non è utilizzabile: la pagina deve saperlo (ready rifiutata)
+                postMessage({ type: 'init-error', error: error.message || String(error) });
+                return;
+            }
+            postMessage({ type: 'ready', offscreen: typeof OffscreenCanvas !== 'undefined' });
+        } else if (message.type === 'marker') {
+            try {
+                const marker = await loadMarker(message);
+                const previous = markers.get(message.key);
+                if (previous) {
+                    previous.descriptors.delete();
+                }
+                markers.set(message.key, marker);
+                postMessage({
+                    type: 'marker',
+                    requestId: message.requestId,
+                    marker: { featureCount: marker.featureCount, width: marker.width, height: marker.height }
+                });
+            } catch (error) {
+                postMessage({ type: 'marker', requestId: message.requestId, error: error.message });
+            }
+        } else if (message.type === 'frame') {
+            processFrame(message);
+        } else if (message.type === 'dispose') {
+            dispose();
+            self.close();
+        }
+    } catch (error) {
+        if (message.bitmap) {
+            message.bitmap.close();
+        }
+        postMessage({ type: 'error', frameId: message.frameId, error: error.message || String(error) });
+    }
+};
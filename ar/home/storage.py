@@ -0,0 +1,123 @@
+"""
+Storage content-addressed per le immagini di personaggi e marker.
+
+Il file viene salvato come ``<upload_to>/<sha[:2]>/<sha256>.<ext>``: lo stesso
+contenuto caricato più volte (scanner, admin, personaggi che condividono un
+marker) occupa un solo file e mantiene lo stesso nome, quindi il pre_save non
+lo vede come cambiato e i features ORB già estratti per quell'hash vengono
+riusati (vedi find_cached_marker_features in models.py).
+
+I file possono essere condivisi tra più personaggi: non vanno cancellati
+quando un personaggio cambia immagine.
+"""
+import gzip
+import hashlib
+import os
+import re
+
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+try:
+    import brotli
+except ImportError:  # opzionale: senza il pacchetto Brotli si generano solo i .gz
+    brotli = None
+
+_HASHED_NAME_RE = re.compile(r'(?:^|/)([0-9a-f]{64})\.[^/.]+$')
+
+
+def hash_file_content(content):
+    """SHA-256 del contenuto di un File Django (riporta il file all'inizio)"""
+    sha = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks():
+        sha.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return sha.hexdigest()
+
+
+def content_hash_from_name(name):
+    """Hash SHA-256 contenuto nel nome di un file content-addressed, None per i nomi storici"""
+    match = _HASHED_NAME_RE.search(name or '')
+    return match.group(1) if match else None
+
+
+def hashed_name(name, content_hash):
+    directory, filename = os.path.split(name)
+    ext = os.path.splitext(filename)[1].lower()
+    return os.path.join(directory, content_hash[:2], content_hash + ext).replace('\\', '/')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage che nomina i file con l'hash del contenuto e non riscrive i duplicati"""
+
+    def __init__(self, *args, **kwargs):
+        # Stesso nome = stesso contenuto: sovrascrivere in caso di upload concorrenti è innocuo
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(*args, **kwargs)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        # Gli upload in streaming (home/uploads.py) arrivano con l'hash già calcolato
+        content_hash = getattr(content, 'content_hash', None) or hash_file_content(content)
+        name = hashed_name(name, content_hash)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    def get_available_name(self, name, max_length=None):
+        return name
+
+
+# Estensioni statiche che vale la pena comprimere (le immagini sono già compresse)
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.html', '.svg', '.json', '.wasm', '.map', '.txt')
+MIN_COMPRESS_SIZE = 1024
+
+
+class PrecompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage (nomi con hash del contenuto, cacheabili per sempre)
+    che durante collectstatic scrive anche le versioni .gz e .br dei file testuali,
+    servite direttamente dal web server (vedi deploy_instructions.md)
+    """
+
+    def post_process(self, paths, dry_run=False, **options):
+        hashed_names = set()
+        for name, hashed_name, processed in super().post_process(paths, dry_run, **options):
+            if hashed_name and not isinstance(processed, Exception):
+                hashed_names.add(hashed_name)
+            yield name, hashed_name, processed
+
+        if dry_run:
+            return
+        for hashed_name in sorted(hashed_names):
+            if hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                self._write_compressed(hashed_name)
+
+    def _write_compressed(self, name):
+        with self.open(name) as f:
+            content = f.read()
+        if len(content) < MIN_COMPRESS_SIZE:
+            return
+
+        # mtime=0: stesso input, stesso .gz (build riproducibili)
+        self._save_compressed(name + '.gz', gzip.compress(content, compresslevel=9, mtime=0), len(content))
+        if brotli is not None:
+            self._save_compressed(name + '.br', brotli.compress(content, quality=11), len(content))
+
+    def _save_compressed(self, name, compressed, original_size):
+        if len(compressed) >= original_size:
+            return
+        if self.exists(name):
+            self.delete(name)
+        self._save(name, ContentFile(compressed))
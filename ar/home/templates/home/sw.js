@@ -0,0 +1,139 @@
+// Service worker AR: opencv.js e static file in cache, pagine e dati dei marker
+// disponibili anche con rete assente o debole (generato da home.views.service_worker)
+
+const CACHE_VERSION = '{{ cache_version }}';
+const STATIC_CACHE = `ar-static-${CACHE_VERSION}`;
+const PAGES_CACHE = 'ar-pages';
+const DATA_CACHE = 'ar-data';
+
+const PRECACHE_URLS = {{ precache_urls|safe }};
+const PAGE_URLS = {{ page_urls|safe }};
+const STATIC_URL = '{{ static_url }}';
+const MEDIA_URL = '{{ media_url }}';
+// In sviluppo gli static file non hanno hash nel nome: vanno riletti dalla rete
+const STATIC_IMMUTABLE = {{ static_immutable|yesno:"true,false" }};
+
+function precacheRequest(url) {
+    const sameOrigin = new URL(url, self.location.origin).origin === self.location.origin;
+    return new Request(url, { mode: sameOrigin ? 'same-origin' : 'no-cors' });
+}
+
+self.addEventListener('install', (event) => {
+    event.waitUntil((async () => {
+        const staticCache = await caches.open(STATIC_CACHE);
+        const pagesCache = await caches.open(PAGES_CACHE);
+
+        // Un URL non raggiungibile non deve bloccare l'installazione
+        await Promise.all([
+            ...PRECACHE_URLS.map(async (url) => {
+                try {
+                    const response = await fetch(precacheRequest(url));
+                    if (response.ok || response.type === 'opaque') {
+                        await staticCache.put(url, response);
+                    }
+                } catch (error) {
+                    console.log(`[sw] precache failed: ${url}`, error);
+                }
+            }),
+            ...PAGE_URLS.map(async (url) => {
+                try {
+                    const response = await fetch(url, { credentials: 'same-origin' });
+                    if (response.ok) {
+                        await pagesCache.put(url, response);
+                    }
+                } catch (error) {
+                    console.log(`[sw] page precache failed: ${url}`, error);
+                }
+            }),
+        ]);
+        await self.skipWaiting();
+    })());
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil((async () => {
+        const names = await caches.keys();
+        await Promise.all(
+            names
+                .filter((name) => name.startsWith('ar-static-') && name !== STATIC_CACHE)
+                .map((name) => caches.delete(name))
+        );
+        await self.clients.claim();
+    })());
+});
+
+async function cacheFirst(request, cacheName) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    if (response.ok || response.type === 'opaque') {
+        cache.put(request, response.clone());
+    }
+    return response;
+}
+
+async function networkFirst(request, cacheName) {
+    const cache = await caches.open(cacheName);
+    try {
+        const response = await fetch(request);
+        if (response.ok) {
+            cache.put(request, response.clone());
+        }
+        return response;
+    } catch (error) {
+        const cached = await cache.match(request, { ignoreSearch: request.mode === 'navigate' });
+        if (cached) {
+            return cached;
+        }
+        throw error;
+    }
+}
+
+async function staleWhileRevalidate(event, cacheName) {
+    const cache = await caches.open(cacheName);
+    const cached = await cache.match(event.request);
+    const refresh = fetch(event.request).then((response) => {
+        if (response.ok) {
+            cache.put(event.request, response.clone());
+        }
+        return response;
+    });
+
+    if (cached) {
+        event.waitUntil(refresh.catch(() => {}));
+        return cached;
+    }
+    return refresh;
+}
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    // POST (yolo-detect, marker-match, save-marker-scan) sempre in rete
+    if (request.method !== 'GET') {
+        return;
+    }
+
+    const url = new URL(request.url);
+
+    if (PRECACHE_URLS.includes(request.url) || PRECACHE_URLS.includes(url.pathname)) {
+        event.respondWith(cacheFirst(request, STATIC_CACHE));
+        return;
+    }
+    if (url.origin !== self.location.origin) {
+        return;
+    }
+
+    if (url.pathname.startsWith(STATIC_URL)) {
+        event.respondWith(STATIC_IMMUTABLE ? cacheFirst(request, STATIC_CACHE) : networkFirst(request, STATIC_CACHE));
+    } else if (url.pathname.startsWith(MEDIA_URL)) {
+        // Immagini con hash del contenuto nel nome: non cambiano mai
+        event.respondWith(cacheFirst(request, DATA_CACHE));
+    } else if (url.pathname.startsWith('/api/marker-features/')) {
+        event.respondWith(staleWhileRevalidate(event, DATA_CACHE));
+    } else if (url.pathname.startsWith('/api/characters/') || request.mode === 'navigate') {
+        event.respondWith(networkFirst(request, request.mode === 'navigate' ? PAGES_CACHE : DATA_CACHE));
+    }
+});
@@ -0,0 +1,25 @@
+from functools import lru_cache
+
+from django import template
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+
+register = template.Library()
+
+
+def opencv_js_static_path():
+    return f'home/vendor/opencv/opencv-{settings.OPENCV_JS_VERSION}.js'
+
+
+@lru_cache(maxsize=None)
+def _opencv_js_vendored():
+    return finders.find(opencv_js_static_path()) is not None
+
+
+@register.simple_tag
+def opencv_js_url():
+    """URL di opencv.js: static file con hash se presente (vendor_opencv_js), altrimenti la CDN"""
+    if _opencv_js_vendored():
+        return static(opencv_js_static_path())
+    return settings.OPENCV_JS_CDN_URL
@@ -1,3 +1,1250 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gc
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from concurrent.futures import Future
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connections
+from django.http import HttpResponse
+from django.test import TestCase, SimpleTestCase, RequestFactory, override_settings
+from django.utils import timezone
+
+from . import catalog, inference, jobs, marker_index, metrics
+from .backends import ExportedYoloModel
+from .detection import (
+    DetectionRequestError, cached_detect, decode_frame, detect_characters, detect_characters_async, read_detection_params, read_detection_request,
+    read_detection_roi, read_image_size, to_frame_coordinates, track_or_detect, track_or_detect_characters,
+)
+from .features import (
+    MARKER_FEATURES_MAGIC, detect_orb_features, pack_orb_features, unpack_orb_features
+)
+from .frame_cache import FrameResultCache, frame_hash
+from .geo import geo_cell_for, filter_nearby, parse_nearby_params
+from .inference import BatchInferenceScheduler
+from .marker_index import MarkerEntry, MarkerIndex
+from .middleware import MetricsMiddleware
+from .routers import CatalogReplicaRouter, catalog_reads
+from .session_cache import SessionCache
+from .storage import ContentAddressedStorage, content_hash_from_name, hash_file_content
+from .models import CharConfiguration, ImageVariantJob, MarkerFeatureJob, MarkerFeatures
+
+TEST_MEDIA_ROOT = tempfile.mkdtemp(prefix='ar-tests-')
+
+
+def tearDownModule():
+    shutil.rmtree(TEST_MEDIA_ROOT, ignore_errors=True)
+
+
+def image_bytes(width=160, height=120, seed=0, ext='.png'):
+    """Immagine sintetica con abbastanza dettagli per ORB"""
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 255, (height // 8, width // 8, 3), dtype=np.uint8)
+    img = cv2.resize(img, (width, height), interpolation=cv2.INTER_NEAREST)
+    return cv2.imencode(ext, img)[1].tobytes()
+
+
+@override_settings(MEDIA_ROOT=TEST_MEDIA_ROOT, MARKER_FEATURES_BACKGROUND=True)
+class CharacterTestCase(TestCase):
+    """Personaggi con immagini in una MEDIA_ROOT temporanea e snapshot del catalogo azzerati"""
+
+    def setUp(self):
+        # Gli snapshot sono per versione e la versione riparte da zero in ogni test
+        cache.clear()
+        catalog._local_snapshots.clear()
+
+    def make_character(self, name='Test', lat=45.0, lon=9.0, activation_distance=50, marker=None, **fields):
+        char = CharConfiguration(
+            name=name, target_latitude=lat, target_longitude=lon,
+            activation_distance=activation_distance, **fields
+        )
+        char.character_image.save(f'{name}.png', ContentFile(image_bytes(seed=1)), save=False)
+        if marker is not None:
+            char.marker_image.save(f'{name}-marker.png', ContentFile(marker), save=False)
+        char.save()
+        return char
+
+
+class GeoCellTests(CharacterTestCase):
+    def test_geo_cell_set_on_create_and_move(self):
+        char = self.make_character(lat=45.0, lon=9.0)
+        self.assertEqual(char.geo_cell, geo_cell_for(45.0, 9.0))
+
+        char.target_latitude, char.target_longitude = 41.9, 12.5
+        char.save()
+        char.refresh_from_db()
+        self.assertEqual(char.geo_cell, geo_cell_for(41.9, 12.5))
+
+    def test_filter_nearby(self):
+        near = self.make_character(name='near', lat=45.0, lon=9.0, activation_distance=50)
+        self.make_character(name='far', lat=45.1, lon=9.0, activation_distance=50)
+        self.make_character(name='rome', lat=41.9, lon=12.5, activation_distance=50)
+
+        # ~30 m dal primo personaggio
+        found = filter_nearby(CharConfiguration.objects.all(), 45.0003, 9.0, radius=0)
+        self.assertEqual([char.pk for char in found], [near.pk])
+        self.assertEqual(filter_nearby(CharConfiguration.objects.all(), 44.0, 9.0, radius=100), [])
+
+    def test_nearby_across_cell_border(self):
+        # Personaggio e utente in celle diverse, a pochi metri di distanza
+        char = self.make_character(lat=45.00999, lon=9.0, activation_distance=50)
+        self.assertNotEqual(geo_cell_for(45.00999, 9.0), geo_cell_for(45.01001, 9.0))
+        found = filter_nearby(CharConfiguration.objects.all(), 45.01001, 9.0)
+        self.assertEqual([c.pk for c in found], [char.pk])
+
+    def test_characters_api_nearby(self):
+        near = self.make_character(name='near', lat=45.0, lon=9.0)
+        self.make_character(name='far', lat=46.0, lon=9.0)
+
+        response = self.client.get('/api/characters/', {'lat': 45.0, 'lon': 9.0})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([c['id'] for c in response.json()['characters']], [near.pk])
+
+        response = self.client.get('/api/characters/', {'lat': 45.0})
+        self.assertEqual(response.status_code, 400)
+
+
+class NearbyParamsTests(SimpleTestCase):
+    def test_parse(self):
+        self.assertIsNone(parse_nearby_params({}))
+        self.assertEqual(parse_nearby_params({'lat': '45', 'lon': '9', 'radius': '10'}), (45.0, 9.0, 10.0))
+        for params in ({'lat': '45'}, {'lat': '95', 'lon': '9'}, {'lat': 'x', 'lon': '9'},
+                       {'lat': '45', 'lon': '9', 'radius': '-1'}):
+            with self.assertRaises(ValueError):
+                parse_nearby_params(params)
+
+
+class OrbFeaturesBlobTests(SimpleTestCase):
+    def test_roundtrip(self):
+        rng = np.random.default_rng(0)
+        points = rng.uniform(0, 640, (37, 2)).astype(np.float32)
+        descriptors = rng.integers(0, 256, (37, 32), dtype=np.uint8)
+
+        blob = pack_orb_features(points, descriptors, 640, 480)
+        self.assertTrue(blob.startswith(MARKER_FEATURES_MAGIC))
+        out_points, out_descriptors, width, height = unpack_orb_features(blob)
+        np.testing.assert_array_equal(out_points, points)
+        np.testing.assert_array_equal(out_descriptors, descriptors)
+        self.assertEqual((width, height), (640, 480))
+
+    def test_empty(self):
+        blob = pack_orb_features(np.empty((0, 2)), np.empty((0, 32)), 10, 20)
+        points, descriptors, width, height = unpack_orb_features(blob)
+        self.assertEqual(points.shape, (0, 2))
+        self.assertEqual(descriptors.shape, (0, 32))
+        self.assertEqual((width, height), (10, 20))
+
+    def test_rejects_unknown_blob(self):
+        blob = pack_orb_features(np.zeros((1, 2)), np.zeros((1, 32)), 1, 1)
+        with self.assertRaises(ValueError):
+            unpack_orb_features(b'XXXX' + blob[4:])
+        with self.assertRaises(ValueError):
+            # Versione successiva non supportata
+            unpack_orb_features(blob[:4] + b'\x02\x00' + blob[6:])
+
+    def test_rejects_inconsistent_blob(self):
+        blob = pack_orb_features(np.zeros((4, 2)), np.zeros((4, 32)), 1, 1)
+        # Descriptors da 16 byte con payload coerente con l'header
+        short_descriptors = struct.pack('<4sHHIII', MARKER_FEATURES_MAGIC, 1, 16, 4, 1, 1) + bytes(4 * (8 + 16))
+        for bad in (blob[:10], blob[:-1], blob + b'\x00', short_descriptors):
+            with self.assertRaises(ValueError):
+                unpack_orb_features(bad)
+
+    def test_marker_match_rejects_bad_blob(self):
+        blob = struct.pack('<4sHHIII', MARKER_FEATURES_MAGIC, 1, 16, 300, 1, 1) + bytes(300 * (8 + 16))
+        for bad in (blob, blob[:-5]):
+            response = self.client.post('/api/marker-match/', bad, content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue(response.json()['error'].startswith('Invalid features blob'))
+
+    def test_detect_and_pack(self):
+        points, descriptors, width, height = detect_orb_features(image_bytes(320, 240), nfeatures=100)
+        self.assertEqual((width, height), (320, 240))
+        self.assertGreater(len(points), 0)
+        self.assertEqual(descriptors.shape, (len(points), 32))
+
+        out_points, out_descriptors, _, _ = unpack_orb_features(
+            pack_orb_features(points, descriptors, width, height)
+        )
+        np.testing.assert_array_equal(out_points, points)
+        np.testing.assert_array_equal(out_descriptors, descriptors)
+
+
+class DetectionRequestTests(SimpleTestCase):
+    """Validazione di /api/yolo-detect/: tutti i casi falliscono prima del modello"""
+
+    def post_json(self, body, **extra):
+        return self.client.post('/api/yolo-detect/', body, content_type='application/json', **extra)
+
+    def assertRejected(self, response, error):
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], error)
+
+    def test_method_not_allowed(self):
+        self.assertEqual(self.client.get('/api/yolo-detect/').status_code, 405)
+
+    def test_invalid_json(self):
+        self.assertRejected(self.post_json('{not json'), 'Invalid JSON body')
+        for body in ('[1, 2]', '"x"', 'null', '3'):
+            self.assertRejected(self.post_json(body), 'JSON body must be an object')
+
+    def test_missing_image(self):
+        self.assertRejected(self.post_json('{}'), 'Missing image data')
+        self.assertRejected(self.post_json(json.dumps({'image': ''})), 'Missing image data')
+
+    def test_invalid_params(self):
+        image = 'data:image/png;base64,' + base64.b64encode(image_bytes()).decode()
+        self.assertRejected(
+            self.post_json(json.dumps({'image': image, 'confidence_threshold': 'high'})),
+            'Invalid confidence_threshold'
+        )
+        self.assertRejected(
+            self.client.post('/api/yolo-detect/?image_size=100', image_bytes(), content_type='image/png'),
+            'image_size must be a multiple of 32 between 128 and 1280'
+        )
+
+    def test_undecodable_image(self):
+        self.assertRejected(
+            self.client.post('/api/yolo-detect/', b'not an image', content_type='image/jpeg'),
+            'Failed to decode image'
+        )
+
+    def test_request_formats(self):
+        factory = RequestFactory()
+        data = image_bytes()
+
+        request = factory.post(
+            '/api/yolo-detect/?object_class=cup', data, content_type='image/png',
+            HTTP_X_CONFIDENCE_THRESHOLD='0.7'
+        )
+        image_buffer, params = read_detection_request(request)
+        self.assertEqual(image_buffer, data)
+        self.assertEqual(read_detection_params(request, params), ('cup', 0.7))
+
+        request = factory.post('/api/yolo-detect/', {
+            'image': ContentFile(data, name='frame.png'), 'object_class': 'bottle'
+        })
+        image_buffer, params = read_detection_request(request)
+        self.assertEqual(image_buffer, data)
+        self.assertEqual(read_detection_params(request, params)[0], 'bottle')
+
+        request = factory.post('/api/yolo-detect/', b'[]', content_type='application/json')
+        with self.assertRaises(DetectionRequestError):
+            read_detection_request(request)
+
+
+class CharactersETagTests(CharacterTestCase):
+    def test_etag_and_not_modified(self):
+        self.make_character()
+
+        response = self.client.get('/api/characters/')
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(etag)
+
+        response = self.client.get('/api/characters/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(response.content, b'')
+
+        response = self.client.get('/api/characters/', HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag_changes_on_save(self):
+        char = self.make_character()
+        etag = self.client.get('/api/characters/')['ETag']
+
+        char.name = 'Renamed'
+        char.save()
+        response = self.client.get('/api/characters/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['characters'][0]['name'], 'Renamed')
+
+
+class MarkerJobTests(CharacterTestCase):
+    def job_for(self, char):
+        return MarkerFeatureJob.objects.get(character=char, marker_type='detection')
+
+    def test_upload_enqueues_pending_job(self):
+        char = self.make_character(marker=image_bytes(320, 240, seed=2))
+        self.assertEqual(char.marker_features_status, 'pending')
+        job = self.job_for(char)
+        self.assertEqual((job.status, job.attempts), ('pending', 0))
+
+    def test_claim_and_run(self):
+        char = self.make_character(marker=image_bytes(320, 240, seed=2))
+
+        claimed = jobs.claim_jobs(10)
+        self.assertEqual([job.character_id for job in claimed], [char.pk])
+        job = self.job_for(char)
+        self.assertEqual((job.status, job.attempts), ('running', 1))
+        # Un job già reclamato non viene reclamato di nuovo
+        self.assertEqual(jobs.claim_jobs(10), [])
+
+        self.assertEqual(jobs.run_jobs(claimed), (1, 0))
+        self.assertEqual(self.job_for(char).status, 'done')
+        char.refresh_from_db()
+        self.assertEqual(char.marker_features_status, 'done')
+        features = MarkerFeatures.objects.get(character=char, marker_type='detection')
+        self.assertGreater(features.keypoint_count, 0)
+        self.assertEqual(char.detection_marker_features, features.keypoint_count)
+
+    def test_same_image_reuses_features(self):
+        marker = image_bytes(320, 240, seed=2)
+        first = self.make_character(name='first', marker=marker)
+        jobs.run_jobs(jobs.claim_jobs(10))
+
+        second = self.make_character(name='second', marker=marker)
+        self.assertEqual(second.marker_features_status, 'done')
+        self.assertFalse(MarkerFeatureJob.objects.filter(character=second, status='pending').exists())
+        self.assertEqual(
+            MarkerFeatures.objects.get(character=second, marker_type='detection').data,
+            MarkerFeatures.objects.get(character=first, marker_type='detection').data,
+        )
+
+    def test_failed_job(self):
+        char = self.make_character(marker=image_bytes(320, 240, seed=2))
+        job, = jobs.claim_jobs(10)
+        jobs.fail_job(job, ValueError('broken'))
+
+        job = self.job_for(char)
+        self.assertEqual((job.status, job.error), ('failed', 'broken'))
+        char.refresh_from_db()
+        self.assertEqual(char.marker_features_status, 'failed')
+
+    def test_reupload_requeues(self):
+        char = self.make_character(marker=image_bytes(320, 240, seed=2))
+        jobs.run_jobs(jobs.claim_jobs(10))
+
+        char.marker_image.save('new-marker.png', ContentFile(image_bytes(320, 240, seed=3)), save=False)
+        char.save()
+        self.assertEqual(self.job_for(char).status, 'pending')
+        char.refresh_from_db()
+        self.assertEqual(char.marker_features_status, 'pending')
+
+    def test_reupload_while_running_drops_stale_result(self):
+        char = self.make_character(marker=image_bytes(320, 240, seed=2))
+        running = jobs.claim_jobs(10)
+
+        char.marker_image.save('new-marker.png', ContentFile(image_bytes(320, 240, seed=3)), save=False)
+        char.save()
+        self.assertEqual(jobs.run_jobs(running), (0, 0))
+        self.assertFalse(MarkerFeatures.objects.filter(character=char).exists())
+        self.assertEqual(self.job_for(char).status, 'pending')
+        char.refresh_from_db()
+        self.assertEqual(char.marker_features_status, 'pending')
+
+        self.assertEqual(jobs.run_jobs(jobs.claim_jobs(10)), (1, 0))
+        features = MarkerFeatures.objects.get(character=char, marker_type='detection')
+        self.assertEqual(features.content_hash, content_hash_from_name(char.marker_image.name))
+
+    @override_settings(MARKER_JOB_STALE_SECONDS=600)
+    def test_requeue_stale_jobs(self):
+        char = self.make_character(marker=image_bytes(320, 240, seed=2))
+        jobs.claim_jobs(10)
+        self.assertEqual(jobs.requeue_stale_jobs(), 0)
+
+        MarkerFeatureJob.objects.filter(character=char).update(
+            updated_at=timezone.now() - timedelta(seconds=601)
+        )
+        self.assertEqual(jobs.requeue_stale_jobs(), 1)
+        job = self.job_for(char)
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+
+
+class DetectionRoiTests(SimpleTestCase):
+    # Frame 2560x1920 con un rettangolo bianco di 80x40 centrato in (1440, 1020)
+    TARGET = (1440, 1020, 80, 40)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        frame = np.zeros((1920, 2560, 3), dtype=np.uint8)
+        x, y, w, h = cls.TARGET
+        frame[y - h // 2:y + h // 2, x - w // 2:x + w // 2] = 255
+        cls.jpeg = cv2.imencode('.jpg', frame)[1].tobytes()
+
+    def locate_target(self, img, transform):
+        """Bbox del rettangolo nel frame decodificato, riportato alle coordinate del frame inviato"""
+        ys, xs = np.nonzero(img[:, :, 0] > 128)
+        x0, x1, y0, y1 = xs.min(), xs.max() + 1, ys.min(), ys.max() + 1
+        detection = {'bbox': {'x': (x0 + x1) / 2, 'y': (y0 + y1) / 2, 'w': x1 - x0, 'h': y1 - y0}}
+        return to_frame_coordinates([detection], transform)[0]['bbox']
+
+    def assertTarget(self, bbox, tolerance):
+        for actual, expected in zip((bbox['x'], bbox['y'], bbox['w'], bbox['h']), self.TARGET):
+            self.assertAlmostEqual(actual, expected, delta=tolerance)
+
+    def test_reduced_decode(self):
+        img, transform = decode_frame(self.jpeg, target_size=640)
+        self.assertEqual(img.shape[:2], (480, 640))
+        self.assertEqual(transform, (4, 0, 0))
+        self.assertTarget(self.locate_target(img, transform), 4)
+
+        img, transform = decode_frame(self.jpeg)
+        self.assertEqual(img.shape[:2], (1920, 2560))
+        self.assertEqual(transform, (1, 0, 0))
+
+    def test_roi_crop(self):
+        img, transform = decode_frame(self.jpeg, target_size=640, roi=(1280, 960, 640, 480))
+        self.assertEqual(img.shape[:2], (480, 640))
+        self.assertEqual(transform, (1, 960, 720))
+        self.assertTarget(self.locate_target(img, transform), 1)
+
+    def test_roi_crop_reduced(self):
+        img, transform = decode_frame(self.jpeg, target_size=640, roi=(1280, 960, 1600, 1200))
+        self.assertEqual(img.shape[:2], (600, 800))
+        self.assertEqual(transform, (2, 240, 180))
+        self.assertTarget(self.locate_target(img, transform), 2)
+
+    def test_roi_clipped_to_frame(self):
+        img, transform = decode_frame(self.jpeg, roi=(2500, 1900, 400, 400))
+        self.assertEqual(img.shape[:2], (220, 260))
+        self.assertEqual(transform, (1, 2300, 1700))
+
+        with self.assertRaises(DetectionRequestError):
+            decode_frame(self.jpeg, roi=(5000, 5000, 100, 100))
+
+    def test_identity_transform(self):
+        detections = [{'bbox': {'x': 1, 'y': 2, 'w': 3, 'h': 4}}]
+        self.assertIs(to_frame_coordinates(detections, (1, 0, 0)), detections)
+
+    def test_read_roi(self):
+        factory = RequestFactory()
+        request = factory.get('/')
+        self.assertIsNone(read_detection_roi(request, {}))
+        self.assertEqual(read_detection_roi(request, {'roi': '10,20,30,40'}), (10, 20, 30, 40))
+        self.assertEqual(read_detection_roi(request, {'roi': [10, 20, 30, 40]}), (10, 20, 30, 40))
+        self.assertEqual(
+            read_detection_roi(request, {'roi': {'x': 10, 'y': 20, 'w': 30, 'h': 40}}), (10, 20, 30, 40)
+        )
+        self.assertEqual(read_detection_roi(factory.get('/?roi=1,2,3,4'), {}), (1, 2, 3, 4))
+        for roi in ('1,2,3', '1,2,0,4', 'a,b,c,d', {'x': 1}):
+            with self.assertRaises(DetectionRequestError):
+                read_detection_roi(request, {'roi': roi})
+
+    @override_settings(YOLO_IMAGE_SIZE=640)
+    def test_read_image_size(self):
+        request = RequestFactory().get('/')
+        self.assertEqual(read_image_size(request, {}), 640)
+        self.assertEqual(read_image_size(request, {}, default=320), 320)
+        self.assertEqual(read_image_size(request, {'image_size': '416'}), 416)
+        for image_size in ('abc', '100', '2048', '650'):
+            with self.assertRaises(DetectionRequestError):
+                read_image_size(request, {'image_size': image_size})
+
+
+class FrameCacheTests(SimpleTestCase):
+    KEY = ('person', 0.5, 640, None, (240, 320, 3))
+
+    def setUp(self):
+        rng = np.random.default_rng(4)
+        self.frame = cv2.resize(
+            rng.integers(0, 255, (24, 32, 3), dtype=np.uint8), (320, 240), interpolation=cv2.INTER_LINEAR
+        )
+        # Stesso frame con rumore del sensore: stesso hash o quasi
+        noise = rng.integers(-2, 3, self.frame.shape)
+        self.noisy = np.clip(self.frame.astype(int) + noise, 0, 255).astype(np.uint8)
+        self.other = np.ascontiguousarray(self.frame[:, ::-1])
+
+    def test_frame_hash(self):
+        self.assertEqual(frame_hash(self.frame), frame_hash(self.frame.copy()))
+        self.assertLessEqual((frame_hash(self.frame) ^ frame_hash(self.noisy)).bit_count(), 4)
+        self.assertGreater((frame_hash(self.frame) ^ frame_hash(self.other)).bit_count(), 4)
+
+    def test_hit_and_miss(self):
+        cache = FrameResultCache(ttl=60, max_distance=4)
+        img_hash, result = cache.lookup('s1', self.KEY, self.frame)
+        self.assertIsNone(result)
+        cache.store('s1', self.KEY, img_hash, ['frame'])
+
+        self.assertEqual(cache.lookup('s1', self.KEY, self.noisy)[1], ['frame'])
+        # Frame diverso, altri parametri o altra sessione: nessun risultato
+        self.assertIsNone(cache.lookup('s1', self.KEY, self.other)[1])
+        self.assertIsNone(cache.lookup('s1', ('cup',) + self.KEY[1:], self.frame)[1])
+        self.assertIsNone(cache.lookup('s2', self.KEY, self.frame)[1])
+
+    def test_expiry(self):
+        cache = FrameResultCache(ttl=0.05)
+        img_hash, _ = cache.lookup('s1', self.KEY, self.frame)
+        cache.store('s1', self.KEY, img_hash, ['frame'])
+        self.assertEqual(cache.lookup('s1', self.KEY, self.frame)[1], ['frame'])
+        time.sleep(0.1)
+        self.assertIsNone(cache.lookup('s1', self.KEY, self.frame)[1])
+
+    def test_cached_detect(self):
+        cache = (FrameResultCache(ttl=60), 's1', self.KEY)
+        with mock.patch('home.detection.detect_objects', return_value=['detected']) as detect:
+            self.assertEqual(cached_detect(self.frame, 'person', 0.5, 640, cache), (['detected'], 'detect'))
+            self.assertEqual(cached_detect(self.noisy, 'person', 0.5, 640, cache), (['detected'], 'cache'))
+            self.assertEqual(cached_detect(self.other, 'person', 0.5, 640, cache), (['detected'], 'detect'))
+            # Senza cache l'inferenza viene sempre eseguita
+            self.assertEqual(cached_detect(self.frame, 'person', 0.5, 640), (['detected'], 'detect'))
+        self.assertEqual(detect.call_count, 3)
+
+
+def marker_entry(character_id, seed, marker_type='detection', features_id=None):
+    points, descriptors, width, height = detect_orb_features(image_bytes(320, 240, seed=seed), nfeatures=300)
+    return MarkerEntry(
+        None, (character_id, marker_type), features_id or seed, None, points, descriptors, width, height
+    )
+
+
+class MarkerIndexTests(SimpleTestCase):
+    def setUp(self):
+        self.index = MarkerIndex()
+        self.markers = {character_id: marker_entry(character_id, seed=10 + character_id) for character_id in range(1, 6)}
+        self.index.add(list(self.markers.values()))
+
+    def best(self, descriptors, **filters):
+        results = self.index.search(descriptors, **filters)
+        return results[0][0].key if results else None
+
+    def test_finds_known_marker(self):
+        for character_id, entry in self.markers.items():
+            self.assertEqual(self.best(entry.descriptors), (character_id, 'detection'))
+
+    def test_filters(self):
+        descriptors = self.markers[1].descriptors
+        self.assertEqual(self.index.search(descriptors, marker_type='positioning'), [])
+        self.assertEqual(self.index.search(descriptors, character_ids=set()), [])
+        self.assertNotIn(1, [entry.key[0] for entry, _ in self.index.search(descriptors, character_ids={2, 3})])
+        self.assertEqual(self.best(descriptors, marker_type='detection', character_ids={1, 2}), (1, 'detection'))
+
+    def test_removed_marker_excluded(self):
+        self.index.remove([(1, 'detection')])
+        self.assertNotIn(1, [entry.key[0] for entry, _ in self.index.search(self.markers[1].descriptors)])
+        self.assertEqual(self.best(self.markers[2].descriptors), (2, 'detection'))
+
+    def test_replaced_marker_stale_descriptors_excluded(self):
+        # Nuova immagine per il personaggio 1: i descriptors vecchi restano nel segmento ma non votano
+        self.index.add([marker_entry(1, seed=99, features_id=100)])
+        self.assertEqual(len(self.index.segments), 2)
+        for entry, _ in self.index.search(self.markers[1].descriptors):
+            self.assertNotEqual(entry.features_id, self.markers[1].features_id)
+        self.assertEqual(self.best(marker_entry(1, seed=99).descriptors), (1, 'detection'))
+
+    def test_compaction(self):
+        self.index.remove([(2, 'detection')])
+        # Un segmento per aggiunta finché non superano MAX_SEGMENTS
+        for character_id in range(6, 6 + marker_index.MAX_SEGMENTS):
+            self.index.add([marker_entry(character_id, seed=10 + character_id)])
+        self.assertEqual(len(self.index.segments), 1)
+        self.assertEqual(len(self.index._live), len(self.index))
+        self.assertTrue(self.index._live.all())
+        self.assertEqual(self.best(self.markers[1].descriptors), (1, 'detection'))
+        self.assertNotIn(2, [entry.key[0] for entry, _ in self.index.search(self.markers[2].descriptors)])
+        self.assertEqual(self.best(marker_entry(7, seed=17).descriptors), (7, 'detection'))
+
+
+class MarkerMatchViewTests(CharacterTestCase):
+    def setUp(self):
+        super().setUp()
+        marker_index._index = None
+        marker_index._last_refresh = 0.0
+
+    def test_match_and_delete(self):
+        marker = image_bytes(320, 240, seed=5)
+        char = self.make_character(marker=marker)
+        self.make_character(name='other', marker=image_bytes(320, 240, seed=6))
+        jobs.run_jobs(jobs.claim_jobs(10))
+
+        response = self.client.post('/api/marker-match/', marker, content_type='image/png')
+        self.assertEqual(response.status_code, 200)
+        candidates = response.json()['candidates']
+        self.assertEqual(candidates[0]['character_id'], char.pk)
+        self.assertGreater(candidates[0]['inliers'], 0)
+
+        char.delete()
+        marker_index._last_refresh = 0.0
+        response = self.client.post('/api/marker-match/', marker, content_type='image/png')
+        self.assertNotIn(char.pk, [candidate['character_id'] for candidate in response.json()['candidates']])
+
+
+class SyntheticYoloModel(ExportedYoloModel):
+    """Modello esportato finto: _forward restituisce un output (batch, 4 + classi, ancore) prefissato"""
+
+    def __init__(self, output, imgsz=640):
+        super().__init__({0: 'person', 1: 'cup', 2: 'bottle'}, imgsz)
+        self.output = output
+        self.batches = []
+
+    def _forward(self, batch):
+        self.batches.append(batch)
+        return np.repeat(self.output[None], len(batch), axis=0)
+
+
+def patch_yolo(test, model):
+    """
+    model al posto del modello YOLO, con uno scheduler che lo esegue subito
+    Returns: lista delle inferenze eseguite (soglia, classi)
+    """
+    calls = []
+
+    def infer(img, conf, classes=None, imgsz=None):
+        calls.append((conf, classes))
+        return model(img, conf=conf, classes=classes)[0]
+
+    def submit(img, conf, classes=None, imgsz=None):
+        future = Future()
+        future.set_result(infer(img, conf, classes, imgsz))
+        return future
+
+    scheduler = mock.Mock(infer=infer, submit=submit)
+    for target, value in (
+        ('home.detection.get_yolo_model', model),
+        ('home.views.get_yolo_model', model),
+        ('home.detection.get_inference_scheduler', scheduler),
+    ):
+        patcher = mock.patch(target, return_value=value)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return calls
+
+
+class ExportedYoloModelTests(SimpleTestCase):
+    # Frame 320x240 con imgsz 640: gain 2, padding verticale di 80 px
+    FRAME = np.zeros((240, 320, 3), dtype=np.uint8)
+
+    def anchors(self, *rows):
+        """Righe (x, y, w, h in coordinate letterbox, classe, score) -> output (4 + classi, ancore)"""
+        output = np.zeros((7, len(rows)), dtype=np.float32)
+        for i, (x, y, w, h, cls, score) in enumerate(rows):
+            output[:4, i] = (x, y, w, h)
+            output[4 + cls, i] = score
+        return output
+
+    def run_model(self, output, **kwargs):
+        model = SyntheticYoloModel(output)
+        result, = model(self.FRAME, **kwargs)
+        boxes = result.boxes
+        order = np.argsort(-boxes.conf)
+        return model, [
+            (int(boxes.cls[i]), round(float(boxes.conf[i]), 2), [round(float(v), 1) for v in boxes.xywh[i]])
+            for i in order
+        ]
+
+    def test_forward_is_abstract(self):
+        with self.assertRaises(TypeError):
+            ExportedYoloModel({0: 'person'})
+
+    def test_letterbox_input(self):
+        model, _ = self.run_model(self.anchors())
+        batch, = model.batches
+        self.assertEqual(batch.shape, (1, 3, 640, 640))
+        # Bande di padding grigio sopra e sotto, frame nero al centro
+        self.assertAlmostEqual(float(batch[0, 0, 0, 0]), 114 / 255, places=5)
+        self.assertAlmostEqual(float(batch[0, 0, 639, 0]), 114 / 255, places=5)
+        self.assertEqual(float(batch[0, 0, 320, 320]), 0.0)
+
+    def test_postprocess(self):
+        output = self.anchors(
+            (200, 200, 80, 40, 0, 0.9),   # (100, 60, 40, 20) nel frame
+            (202, 201, 80, 40, 0, 0.8),   # sovrapposto, stessa classe: eliminato dalla NMS
+            (200, 200, 80, 40, 1, 0.85),  # stesso box, altra classe: resta (NMS per classe)
+            (500, 380, 120, 80, 2, 0.3),  # sotto soglia
+            (620, 100, 80, 80, 0, 0.7),   # esce dal frame: ritagliato a (290..320, 0..30)
+        )
+        _, detections = self.run_model(output, conf=0.5)
+        self.assertEqual(detections, [
+            (0, 0.9, [100.0, 60.0, 40.0, 20.0]),
+            (1, 0.85, [100.0, 60.0, 40.0, 20.0]),
+            (0, 0.7, [305.0, 15.0, 30.0, 30.0]),
+        ])
+
+    def test_class_filter(self):
+        output = self.anchors((200, 200, 80, 40, 1, 0.85), (620, 100, 80, 80, 0, 0.7))
+        _, detections = self.run_model(output, conf=0.5, classes=[0])
+        self.assertEqual(detections, [(0, 0.7, [305.0, 15.0, 30.0, 30.0])])
+
+        _, detections = self.run_model(self.anchors((200, 200, 80, 40, 1, 0.85)), conf=0.5, classes=[0])
+        self.assertEqual(detections, [])
+
+
+class DetectCharactersTests(SimpleTestCase):
+    FRAME = np.zeros((240, 320, 3), dtype=np.uint8)
+    CHARACTERS = [
+        {'id': 1, 'name': 'Tazza', 'yolo_object_class': 'cup', 'yolo_confidence_threshold': 0.3},
+        {'id': 2, 'name': 'Persona', 'yolo_object_class': 'person', 'yolo_confidence_threshold': 0.8},
+        {'id': 3, 'name': 'Ignoto', 'yolo_object_class': 'giraffe', 'yolo_confidence_threshold': 0.5},
+    ]
+
+    def setUp(self):
+        # Coordinate letterbox (imgsz 640): classi 0 person, 1 cup, 2 bottle
+        output = np.zeros((7, 4), dtype=np.float32)
+        output[:, 0] = (100, 200, 40, 40, 0, 0.4, 0)    # cup sopra la soglia bassa
+        output[:, 1] = (300, 200, 40, 40, 0.5, 0, 0)    # person sotto la propria soglia
+        output[:, 2] = (500, 200, 40, 40, 0.9, 0, 0)    # person sopra la propria soglia
+        output[:, 3] = (300, 400, 40, 40, 0, 0, 0.95)   # bottle: nessun personaggio
+        self.calls = patch_yolo(self, SyntheticYoloModel(output))
+
+    def check(self, results):
+        summary = {
+            char_id: [(d['class'], round(d['confidence'], 2)) for d in detections]
+            for char_id, detections in results.items()
+        }
+        # La soglia bassa della tazza non fa passare la persona a 0.5
+        self.assertEqual(summary, {1: [('cup', 0.4)], 2: [('person', 0.9)], 3: []})
+        # Un solo forward pass sull'unione delle classi, con la soglia più bassa
+        self.assertEqual(self.calls, [(0.3, [0, 1])])
+
+    def test_thresholds_per_character(self):
+        self.check(detect_characters(self.FRAME, self.CHARACTERS))
+
+    def test_thresholds_per_character_async(self):
+        with mock.patch('home.detection.get_inference_executor', return_value=None):
+            self.check(asyncio.run(detect_characters_async(self.FRAME, self.CHARACTERS)))
+
+
+class TrackingTests(SimpleTestCase):
+    # Due oggetti della stessa classe in un frame 320x240, centri a (90, 120) e (230, 120)
+    DETECTIONS = [
+        {'class': 'cup', 'confidence': 0.9, 'bbox': {'x': 90.0, 'y': 120.0, 'w': 48.0, 'h': 48.0}},
+        {'class': 'cup', 'confidence': 0.8, 'bbox': {'x': 230.0, 'y': 120.0, 'w': 48.0, 'h': 48.0}},
+    ]
+
+    def setUp(self):
+        self.trackers = SessionCache(max_entries=100, ttl=30)
+        patcher = mock.patch('home.detection.get_tracker_cache', return_value=self.trackers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def frame(self, shift=0):
+        """Sfondo uniforme con due oggetti testurizzati, spostati di shift px in orizzontale"""
+        img = np.full((240, 320, 3), 114, dtype=np.uint8)
+        for seed, x in ((1, 90), (2, 230)):
+            patch = np.random.default_rng(seed).integers(0, 255, (6, 6, 3), dtype=np.uint8)
+            patch = cv2.resize(patch, (48, 48), interpolation=cv2.INTER_NEAREST)
+            img[96:144, x - 24 + shift:x + 24 + shift] = patch
+        return img
+
+    def run_frames(self, shifts, **kwargs):
+        results = []
+        with mock.patch('home.detection.detect_objects', **kwargs) as detect:
+            for shift in shifts:
+                results.append(track_or_detect(self.frame(shift), 'cup', 0.5, 's1'))
+        return results, detect.call_count
+
+    def test_every_box_of_the_class_is_tracked(self):
+        results, calls = self.run_frames([0, 3, 6], return_value=self.DETECTIONS)
+        self.assertEqual([mode for _, mode in results], ['detect', 'track', 'track'])
+        self.assertEqual(calls, 1)
+        detections, _ = results[-1]
+        self.assertEqual(len(detections), 2)
+        for detection, x in zip(detections, (96, 236)):
+            self.assertTrue(detection['tracked'])
+            self.assertAlmostEqual(detection['bbox']['x'], x, delta=1)
+            self.assertAlmostEqual(detection['bbox']['y'], 120, delta=1)
+
+    @override_settings(YOLO_TRACK_REDETECT_FRAMES=2)
+    def test_redetect_interval(self):
+        results, calls = self.run_frames([0, 1, 2, 3, 4], return_value=self.DETECTIONS)
+        self.assertEqual([mode for _, mode in results], ['detect', 'track', 'track', 'detect', 'track'])
+        self.assertEqual(calls, 2)
+
+    def test_lost_track_falls_back_to_detect(self):
+        with mock.patch('home.detection.detect_objects', side_effect=[self.DETECTIONS, []]) as detect:
+            self.assertEqual(track_or_detect(self.frame(), 'cup', 0.5, 's1')[1], 'detect')
+            # Gli oggetti spariscono: il tracker è perso e YOLO viene rieseguito
+            blank = np.full((240, 320, 3), 114, dtype=np.uint8)
+            self.assertEqual(track_or_detect(blank, 'cup', 0.5, 's1'), ([], 'detect'))
+        self.assertEqual(detect.call_count, 2)
+        self.assertIsNone(self.trackers.get('s1:cup'))
+
+    def test_session_cache_expiry_and_eviction(self):
+        sessions = SessionCache(max_entries=2, ttl=0.05)
+        sessions.set('a', 1)
+        time.sleep(0.1)
+        self.assertIsNone(sessions.get('a'))
+
+        sessions = SessionCache(max_entries=2, ttl=30)
+        sessions.set('a', 1)
+        sessions.set('b', 2)
+        sessions.get('a')
+        sessions.set('c', 3)
+        # Oltre il limite esce la sessione usata meno di recente
+        self.assertEqual((sessions.get('a'), sessions.get('b'), sessions.get('c')), (1, None, 3))
+
+    def test_characters_of_the_same_class_in_one_request(self):
+        # Stessi oggetti in coordinate letterbox (imgsz 640: gain 2, padding verticale 80)
+        output = np.zeros((7, 2), dtype=np.float32)
+        output[:, 0] = (180, 320, 96, 96, 0, 0.9, 0)
+        output[:, 1] = (460, 320, 96, 96, 0, 0.8, 0)
+        model = SyntheticYoloModel(output)
+        scheduler = mock.Mock()
+        scheduler.infer.side_effect = lambda img, conf, classes=None, imgsz=None: model(img, conf=conf, classes=classes)[0]
+        characters = [
+            {'id': 1, 'name': 'A', 'yolo_object_class': 'cup', 'yolo_confidence_threshold': 0.5},
+            {'id': 2, 'name': 'B', 'yolo_object_class': 'cup', 'yolo_confidence_threshold': 0.5},
+        ]
+
+        with mock.patch('home.detection.get_yolo_model', return_value=model), \
+                mock.patch('home.detection.get_inference_scheduler', return_value=scheduler):
+            results, mode = track_or_detect_characters(self.frame(), characters, 's1')
+            self.assertEqual(mode, 'detect')
+            self.assertEqual([len(results[1]), len(results[2])], [2, 2])
+
+            results, mode = track_or_detect_characters(self.frame(4), characters, 's1')
+        self.assertEqual(mode, 'track')
+        self.assertEqual(len(model.batches), 1)
+        for char_id in (1, 2):
+            xs = sorted(detection['bbox']['x'] for detection in results[char_id])
+            self.assertAlmostEqual(xs[0], 94, delta=1)
+            self.assertAlmostEqual(xs[1], 234, delta=1)
+
+
+class BlockingModel:
+    """Modello finto: registra le chiamate e resta fermo sulla prima finché gate non viene aperto"""
+
+    def __init__(self, error=None):
+        self.calls = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.error = error
+
+    def __call__(self, images, conf, classes=None, verbose=False, **options):
+        self.calls.append((list(images), conf, classes, options.get('imgsz')))
+        if len(self.calls) == 1:
+            self.started.set()
+            self.gate.wait(5)
+        elif self.error is not None:
+            raise self.error
+        return [f'result-{image}' for image in images]
+
+
+class BatchInferenceSchedulerTests(SimpleTestCase):
+    def start(self, model, max_batch_size=3, max_wait=0.2):
+        """Scheduler con il primo forward pass in corso: le richieste successive restano in coda"""
+        scheduler = BatchInferenceScheduler(lambda: model, max_batch_size=max_batch_size, max_wait=max_wait)
+        first = scheduler.submit('first', 0.5)
+        self.assertTrue(model.started.wait(5))
+        return scheduler, first
+
+    def test_concurrent_submits_coalesced_up_to_max_batch_size(self):
+        model = BlockingModel()
+        scheduler, first = self.start(model)
+        futures = [scheduler.submit(i, 0.3 + i / 10, classes=[i]) for i in range(5)]
+        model.gate.set()
+
+        self.assertEqual(first.result(5), 'result-first')
+        # Ogni chiamante riceve il risultato del proprio frame
+        self.assertEqual([future.result(5) for future in futures], [f'result-{i}' for i in range(5)])
+        self.assertEqual([images for images, _, _, _ in model.calls], [['first'], [0, 1, 2], [3, 4]])
+        # Soglia più bassa e unione delle classi del batch
+        self.assertEqual(model.calls[1][1:3], (0.3, [0, 1, 2]))
+
+    def test_image_sizes_in_separate_forward_passes(self):
+        model = BlockingModel()
+        scheduler, first = self.start(model, max_batch_size=4)
+        futures = [scheduler.submit(i, 0.5, imgsz=imgsz) for i, imgsz in enumerate((320, 640, 320))]
+        model.gate.set()
+
+        self.assertEqual([future.result(5) for future in futures], ['result-0', 'result-1', 'result-2'])
+        self.assertEqual(
+            sorted((images, imgsz) for images, _, _, imgsz in model.calls[1:]), [([0, 2], 320), ([1], 640)]
+        )
+
+    def test_max_wait_flush(self):
+        model = BlockingModel()
+        model.gate.set()
+        scheduler = BatchInferenceScheduler(lambda: model, max_batch_size=8, max_wait=0.05)
+        started = time.monotonic()
+        # Nessun altro frame arriva: il batch parziale parte dopo max_wait
+        self.assertEqual(scheduler.infer('only', 0.5, timeout=5), 'result-only')
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual([images for images, _, _, _ in model.calls], [['only']])
+
+    def test_model_error_propagated_to_every_waiter(self):
+        model = BlockingModel(error=ValueError('forward failed'))
+        scheduler, first = self.start(model)
+        futures = [scheduler.submit(i, 0.5) for i in range(3)]
+        model.gate.set()
+
+        self.assertEqual(first.result(5), 'result-first')
+        for future in futures:
+            with self.assertRaisesMessage(ValueError, 'forward failed'):
+                future.result(5)
+        self.assertEqual(len(model.calls), 2)
+
+    def test_missing_model(self):
+        scheduler = BatchInferenceScheduler(lambda: None, max_wait=0)
+        with self.assertRaisesMessage(RuntimeError, 'YOLO model not available'):
+            scheduler.infer('frame', 0.5, timeout=5)
+
+
+class ModelPreloadTests(SimpleTestCase):
+    def setUp(self):
+        self.calls = []
+        self.model = lambda image, **kwargs: self.calls.append(image.shape)
+        patcher = mock.patch.object(inference, '_yolo_model', self.model)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(gc.unfreeze)
+
+    def test_master_preload_runs_no_inference(self):
+        self.assertTrue(inference.preload_yolo_model())
+        self.assertEqual(self.calls, [])
+
+    @override_settings(YOLO_BACKEND='onnx')
+    def test_exported_backend_not_loaded_in_master(self):
+        with mock.patch.object(inference, '_yolo_model', None), \
+                mock.patch.object(inference, '_load_yolo_model') as load:
+            self.assertFalse(inference.preload_yolo_model())
+        load.assert_not_called()
+
+    @override_settings(YOLO_WARMUP_RUNS=2, YOLO_WARMUP_IMAGE_SIZE=320)
+    def test_worker_warm_up(self):
+        self.assertTrue(inference.warm_up_yolo_model())
+        self.assertEqual(self.calls, [(320, 320, 3), (320, 320, 3)])
+
+
+class ImageVariantJobTests(CharacterTestCase):
+    def test_save_enqueues_variants(self):
+        char = self.make_character(marker=image_bytes(320, 240, seed=2))
+        char.refresh_from_db()
+        self.assertEqual(char.image_variants, {})
+        self.assertEqual(
+            sorted(ImageVariantJob.objects.filter(character=char, status='pending').values_list('field_name', flat=True)),
+            ['character_image', 'marker_image']
+        )
+
+        claimed = jobs.claim_variant_jobs(10)
+        self.assertEqual(len(claimed), 2)
+        self.assertEqual(jobs.run_variant_jobs(claimed), (2, 0))
+        char.refresh_from_db()
+        self.assertEqual(sorted(char.image_variants), ['character_image', 'marker_image'])
+        for name in char.image_variants['character_image'].values():
+            self.assertTrue(default_storage.exists(name))
+        self.assertFalse(ImageVariantJob.objects.exclude(status='done').exists())
+
+        payload = self.client.get('/api/characters/').json()['characters'][0]
+        self.assertIn('webp_256', payload['character_image_variants'])
+
+    def test_reupload_drops_stale_variants(self):
+        char = self.make_character()
+        jobs.run_variant_jobs(jobs.claim_variant_jobs(10))
+        char.refresh_from_db()
+        self.assertIn('character_image', char.image_variants)
+
+        self.assertEqual(jobs.claim_variant_jobs(10), [])
+
+        # Nuova immagine: le varianti vecchie spariscono subito, il job torna pending
+        char.character_image.save('new.png', ContentFile(image_bytes(seed=7)), save=False)
+        char.save()
+        char.refresh_from_db()
+        self.assertEqual(char.image_variants, {})
+        job = ImageVariantJob.objects.get(character=char, field_name='character_image')
+        self.assertEqual(job.status, 'pending')
+
+        # Un worker reclama il job, poi l'immagine cambia ancora prima che finisca
+        running, = jobs.claim_variant_jobs(10)
+        char.character_image.save('newer.png', ContentFile(image_bytes(seed=8)), save=False)
+        char.save()
+        self.assertEqual(jobs.run_variant_jobs([running]), (0, 0))
+        char.refresh_from_db()
+        self.assertEqual(char.image_variants, {})
+        self.assertEqual(ImageVariantJob.objects.get(pk=job.pk).status, 'pending')
+
+        jobs.run_variant_jobs(jobs.claim_variant_jobs(10))
+        char.refresh_from_db()
+        content_hash = content_hash_from_name(char.character_image.name)
+        self.assertTrue(char.image_variants['character_image']['webp_256'].endswith(f'{content_hash}-webp_256-256.webp'))
+
+    @override_settings(MARKER_FEATURES_BACKGROUND=False)
+    def test_synchronous_mode(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            char = self.make_character(marker=image_bytes(320, 240, seed=2))
+        char.refresh_from_db()
+        self.assertEqual(sorted(char.image_variants), ['character_image', 'marker_image'])
+        self.assertEqual(char.marker_features_status, 'done')
+
+
+class CatalogReplicaRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = CatalogReplicaRouter()
+        # Alias della replica configurato (le query non partono: si interroga solo il router)
+        patcher = mock.patch.dict(connections.settings, {'replica': connections.settings['default']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        request_started.send(sender=None)
+
+    def test_catalog_reads_use_replica(self):
+        self.assertIsNone(self.router.db_for_read(CharConfiguration))
+        with catalog_reads():
+            self.assertEqual(self.router.db_for_read(CharConfiguration), 'replica')
+            self.assertEqual(self.router.db_for_read(MarkerFeatures), 'replica')
+            # Solo i modelli di home
+            self.assertIsNone(self.router.db_for_read(User))
+        self.assertIsNone(self.router.db_for_read(CharConfiguration))
+        self.assertEqual(self.router.db_for_write(CharConfiguration), 'default')
+
+    def test_primary_after_write(self):
+        self.router.db_for_write(CharConfiguration)
+        with catalog_reads():
+            self.assertIsNone(self.router.db_for_read(CharConfiguration))
+
+        # Nuova richiesta: di nuovo sulla replica
+        request_started.send(sender=None)
+        with catalog_reads():
+            self.assertEqual(self.router.db_for_read(CharConfiguration), 'replica')
+
+    @override_settings(DATABASE_REPLICA_ALIAS='missing')
+    def test_without_replica(self):
+        with catalog_reads():
+            self.assertIsNone(self.router.db_for_read(CharConfiguration))
+
+
+class MetricsTests(SimpleTestCase):
+    DEAD_PID = 2 ** 30  # oltre pid_max: nessun processo
+
+    def setUp(self):
+        self.metrics_dir = tempfile.mkdtemp(dir=TEST_MEDIA_ROOT)
+        settings_override = override_settings(METRICS_DIR=self.metrics_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write_process(self, pid, tracked, queue_depth):
+        with open(os.path.join(self.metrics_dir, f'{pid}.json'), 'w') as f:
+            json.dump({
+                'pid': pid,
+                'counters': [['ar_yolo_track_total', [['result', 'fake']], tracked]],
+                'gauges': [['ar_yolo_queue_depth', [['worker', 'fake']], queue_depth]],
+                'histograms': [['ar_yolo_batch_size', [['worker', 'fake']], [1, 0, 2, 0, 0, 0, 0], 5.0]],
+            }, f)
+
+    def assertSeries(self, text, series, value):
+        self.assertIn(f'{series} {value}\n', text)
+
+    def test_process_files_summed(self):
+        self.write_process(os.getppid(), 3, 2)
+        self.write_process(self.DEAD_PID, 4, 5)
+        text = self.client.get('/metrics').content.decode()
+        self.assertSeries(text, 'ar_yolo_track_total{result="fake"}', 7)
+        # Gauge solo dei processi vivi
+        self.assertSeries(text, 'ar_yolo_queue_depth{worker="fake"}', 2)
+        self.assertSeries(text, 'ar_yolo_batch_size_bucket{worker="fake",le="2.0"}', 2)
+        self.assertSeries(text, 'ar_yolo_batch_size_bucket{worker="fake",le="4.0"}', 6)
+        self.assertSeries(text, 'ar_yolo_batch_size_sum{worker="fake"}', 10.0)
+
+    def test_dead_process_files_removed(self):
+        self.write_process(os.getppid(), 3, 2)
+        self.write_process(self.DEAD_PID, 4, 5)
+        metrics.mark_process_dead(self.DEAD_PID)
+        self.write_process(self.DEAD_PID + 1, 1, 5)
+        metrics.mark_process_dead(self.DEAD_PID + 1)
+
+        # Il file di questo processo può comparire con il flush periodico
+        files = set(os.listdir(self.metrics_dir)) - {f'{os.getpid()}.json', f'{os.getpid()}.json.tmp'}
+        self.assertEqual(files, {f'{os.getppid()}.json', metrics.DEAD_PROCESSES_FILE})
+        text = metrics.render_metrics()
+        # I contatori dei processi terminati restano nel totale
+        self.assertSeries(text, 'ar_yolo_track_total{result="fake"}', 8)
+        self.assertSeries(text, 'ar_yolo_queue_depth{worker="fake"}', 2)
+        self.assertSeries(text, 'ar_yolo_batch_size_count{worker="fake"}', 9)
+
+    def test_server_timing_header(self):
+        def view(request):
+            with metrics.stage('decode'):
+                time.sleep(0.002)
+            with metrics.stage('inference'):
+                pass
+            return HttpResponse('ok')
+
+        response = MetricsMiddleware(view)(RequestFactory().get('/'))
+        self.assertRegex(
+            response['Server-Timing'], r'^decode;dur=\d+\.\d, inference;dur=\d+\.\d, total;dur=\d+\.\d$'
+        )
+        decode = float(re.search(r'decode;dur=([\d.]+)', response['Server-Timing']).group(1))
+        self.assertGreaterEqual(decode, 2.0)
+
+    @override_settings(SERVER_TIMING=False)
+    def test_server_timing_disabled(self):
+        response = MetricsMiddleware(lambda request: HttpResponse('ok'))(RequestFactory().get('/'))
+        self.assertNotIn('Server-Timing', response)
+
+
+class MarkerUploadTests(CharacterTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(User.objects.create_user('staff', password='x', is_staff=True))
+        # La richiesta non decodifica le immagini: i rifiuti arrivano dall'header
+        for target in ('cv2.imdecode', 'PIL.Image.open'):
+            patcher = mock.patch(target, side_effect=AssertionError(f'{target} chiamato'))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def post_scan(self, detection, positioning=None):
+        return self.client.post('/api/save-marker-scan/', {
+            'character_name': 'Scan',
+            'latitude': '45.0',
+            'longitude': '9.0',
+            'detection_marker': detection,
+            'positioning_marker': positioning or SimpleUploadedFile('p.png', image_bytes(seed=6), 'image/png'),
+        })
+
+    def assertRejected(self, detection, message):
+        response = self.post_scan(detection)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(f'detection_marker: {message}', response.json()['error'])
+        self.assertFalse(CharConfiguration.objects.exists())
+
+    def test_oversized_dimensions_rejected(self):
+        # Header PNG di 5000x5000 seguito da dati qualsiasi: basta l'header per rifiutarlo
+        header = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', 5000, 5000)
+        upload = SimpleUploadedFile('big.png', header + b'\0' * 4096, 'image/png')
+        self.assertRejected(upload, 'Immagine troppo grande (5000x5000')
+
+    @override_settings(MARKER_UPLOAD_MAX_BYTES=1024)
+    def test_oversized_file_rejected(self):
+        upload = SimpleUploadedFile('big.png', image_bytes(640, 480, seed=5), 'image/png')
+        self.assertRejected(upload, 'File immagine troppo grande')
+
+    def test_truncated_jpeg_rejected(self):
+        # Interrotto prima del marker SOF: dimensioni mai lette
+        data = image_bytes(ext='.jpg')
+        upload = SimpleUploadedFile('cut.jpg', data[:data.find(b'\xff\xc0')], 'image/jpeg')
+        self.assertRejected(upload, 'Immagine troncata')
+
+    def test_non_image_rejected(self):
+        self.assertRejected(
+            SimpleUploadedFile('fake.png', b'not an image' * 100, 'image/png'), 'Formato immagine non supportato'
+        )
+        self.assertRejected(
+            SimpleUploadedFile('notes.txt', image_bytes(), 'text/plain'), 'Formato immagine non supportato'
+        )
+
+    def test_valid_upload_content_addressed(self):
+        data = image_bytes(seed=5)
+        response = self.post_scan(SimpleUploadedFile('marker.png', data, 'image/png'))
+        self.assertEqual(response.status_code, 200)
+
+        char = CharConfiguration.objects.get(pk=response.json()['character_id'])
+        sha = hashlib.sha256(data).hexdigest()
+        self.assertEqual(char.marker_image.name, f'markers/{sha[:2]}/{sha}.png')
+        with char.marker_image.open('rb') as f:
+            self.assertEqual(f.read(), data)
+
+
+class ContentAddressedStorageTests(SimpleTestCase):
+    def setUp(self):
+        self.storage = ContentAddressedStorage(location=tempfile.mkdtemp(dir=TEST_MEDIA_ROOT))
+
+    def stored_files(self):
+        return sorted(
+            os.path.relpath(os.path.join(root, name), self.storage.location)
+            for root, _, names in os.walk(self.storage.location) for name in names
+        )
+
+    def test_name_from_content_hash(self):
+        data = image_bytes(seed=8)
+        sha = hashlib.sha256(data).hexdigest()
+        content = ContentFile(data)
+        self.assertEqual(hash_file_content(content), sha)
+        # Il file torna all'inizio dopo l'hash
+        self.assertEqual(content.read(), data)
+
+        name = self.storage.save('markers/detection_marker_1.PNG', ContentFile(data))
+        self.assertEqual(name, f'markers/{sha[:2]}/{sha}.png')
+        self.assertEqual(content_hash_from_name(name), sha)
+        self.assertIsNone(content_hash_from_name('markers/detection_marker_1.png'))
+
+    def test_duplicates_stored_once(self):
+        data = image_bytes(seed=8)
+        first = self.storage.save('markers/a.png', ContentFile(data))
+        second = self.storage.save('characters/b.png', ContentFile(data))
+        self.assertEqual(first, self.storage.save('markers/c.png', ContentFile(data)))
+        other = self.storage.save('markers/d.png', ContentFile(image_bytes(seed=9)))
+
+        self.assertNotEqual(first, other)
+        self.assertEqual(self.stored_files(), sorted([first, second, other]))
+        with self.storage.open(first) as f:
+            self.assertEqual(f.read(), data)
+
+    def test_precomputed_hash(self):
+        # Gli upload in streaming portano l'hash calcolato durante la ricezione
+        content = ContentFile(image_bytes(seed=8))
+        content.content_hash = 'ab' * 32
+        self.assertEqual(self.storage.save('markers/a.png', content), f'markers/ab/{"ab" * 32}.png')
+
+
+class SharedMarkerTests(CharacterTestCase):
+    def test_characters_share_marker_file(self):
+        marker = image_bytes(320, 240, seed=2)
+        first = self.make_character(name='first', marker=marker)
+        second = self.make_character(name='second', marker=marker)
+        self.assertEqual(first.marker_image.name, second.marker_image.name)
+
+        # Nuova immagine per il primo: il file condiviso resta per il secondo
+        first.marker_image.save('new.png', ContentFile(image_bytes(320, 240, seed=3)), save=False)
+        first.save()
+        self.assertNotEqual(first.marker_image.name, second.marker_image.name)
+        self.assertTrue(second.marker_image.storage.exists(second.marker_image.name))
+
+
+class DetectCharactersViewTests(CharacterTestCase):
+    def setUp(self):
+        super().setUp()
+        # Coordinate letterbox (imgsz 640) di un frame 320x240: gain 2, padding verticale 80
+        output = np.zeros((7, 3), dtype=np.float32)
+        output[:, 0] = (100, 200, 40, 40, 0, 0.4, 0)   # cup
+        output[:, 1] = (300, 200, 40, 40, 0.6, 0, 0)   # person
+        output[:, 2] = (500, 200, 40, 40, 0.9, 0, 0)   # person
+        self.calls = patch_yolo(self, SyntheticYoloModel(output))
+        self.frame = cv2.imencode('.png', np.zeros((240, 320, 3), dtype=np.uint8))[1].tobytes()
+
+        yolo = {'use_yolo_detection': True}
+        self.cup = self.make_character('Tazza', yolo_object_class='cup', yolo_confidence_threshold=0.3, **yolo)
+        self.person = self.make_character('Persona', yolo_object_class='person', yolo_confidence_threshold=0.8, **yolo)
+        self.far = self.make_character('Lontano', lat=46.0, yolo_object_class='person', **yolo)
+        self.no_yolo = self.make_character('Marker', yolo_object_class='person')
+
+    def post(self, query):
+        return self.client.post(f'/api/yolo-detect/characters/?{query}', self.frame, content_type='image/png')
+
+    def test_detections_per_character(self):
+        response = self.post(f'characters={self.cup.pk},{self.person.pk}')
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        entries = {entry['id']: entry for entry in data['characters']}
+        self.assertEqual(set(entries), {self.cup.pk, self.person.pk})
+
+        cup = entries[self.cup.pk]
+        self.assertEqual((cup['name'], cup['object_class'], cup['count']), ('Tazza', 'cup', 1))
+        # Coordinate del frame inviato
+        self.assertEqual({k: round(v) for k, v in cup['detections'][0]['bbox'].items()}, {'x': 50, 'y': 60, 'w': 20, 'h': 20})
+        # Ogni personaggio con la propria soglia
+        self.assertEqual([round(d['confidence'], 2) for d in entries[self.person.pk]['detections']], [0.9])
+        self.assertEqual((data['count'], data['mode']), (2, 'detect'))
+        # Un solo forward pass per tutti
+        self.assertEqual(self.calls, [(0.3, [0, 1])])
+
+    def test_characters_by_location(self):
+        data = self.post('lat=45.0&lon=9.0&radius=100').json()
+        # Solo i personaggi YOLO vicini
+        self.assertEqual({entry['id'] for entry in data['characters']}, {self.cup.pk, self.person.pk})
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.post('').status_code, 400)
+        self.assertEqual(self.post('characters=a,b').status_code, 400)
+        self.assertEqual(self.client.get(f'/api/yolo-detect/characters/?characters={self.cup.pk}').status_code, 405)
+        # Nessun personaggio YOLO tra quelli richiesti: nessuna inferenza
+        self.assertEqual(self.post(f'characters={self.no_yolo.pk}').json(), {'success': True, 'characters': [], 'count': 0})
+        self.assertEqual(self.calls, [])
@@ -0,0 +1,166 @@
+"""
+Modalità detect-then-track di /api/yolo-detect/.
+
+Dopo una detection, ogni bbox della classe (fino a MAX_TRACKED_BOXES) viene
+seguito nei frame successivi della stessa sessione con optical flow
+Lucas-Kanade sulla sola regione intorno all'oggetto (schema MedianFlow:
+spostamento e scala dalla mediana dei punti che superano il controllo
+forward-backward). YOLO viene rieseguito ogni YOLO_TRACK_REDETECT_FRAMES
+frame, o prima se uno degli oggetti perde affidabilità.
+Un frame seguito costa pochi millisecondi di CPU invece di un forward pass.
+"""
+import threading
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .session_cache import SessionCache
+
+# Regione analizzata: bbox allargato di questa frazione per lato (massimo spostamento seguibile)
+SEARCH_MARGIN = 0.5
+MIN_TRACK_POINTS = 6
+MAX_TRACK_POINTS = 60
+MAX_FORWARD_BACKWARD_ERROR = 1.0
+# Oggetti della stessa classe seguiti per sessione (i più affidabili)
+MAX_TRACKED_BOXES = 8
+LK_PARAMS = {
+    'winSize': (15, 15),
+    'maxLevel': 2,
+    'criteria': (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+}
+
+
+class BoxTracker:
+    """
+    Segue il bbox (centro, larghezza, altezza in pixel del frame) di una detection.
+    Conserva solo la regione grayscale intorno all'oggetto, non il frame intero
+    """
+
+    def __init__(self, img, detection):
+        self.detection = detection
+        self.frame_shape = img.shape[:2]
+        self.frames = 0
+        self._seed(img)
+
+    def _region(self):
+        bbox = self.detection['bbox']
+        height, width = self.frame_shape
+        half_w = bbox['w'] * (0.5 + SEARCH_MARGIN)
+        half_h = bbox['h'] * (0.5 + SEARCH_MARGIN)
+        x0 = max(int(bbox['x'] - half_w), 0)
+        y0 = max(int(bbox['y'] - half_h), 0)
+        x1 = min(int(bbox['x'] + half_w) + 1, width)
+        y1 = min(int(bbox['y'] + half_h) + 1, height)
+        return x0, y0, x1, y1
+
+    def _crop(self, img, region):
+        x0, y0, x1, y1 = region
+        return cv2.cvtColor(img[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY)
+
+    def _seed(self, img):
+        """Punti da seguire dentro il bbox, nella regione corrente"""
+        self.region = self._region()
+        self.gray = self._crop(img, self.region)
+        self.points = None
+
+        x0, y0, x1, y1 = self.region
+        if x1 - x0 < 8 or y1 - y0 < 8:
+            return
+
+        bbox = self.detection['bbox']
+        mask = np.zeros(self.gray.shape, dtype=np.uint8)
+        left, top = int(bbox['x'] - bbox['w'] / 2) - x0, int(bbox['y'] - bbox['h'] / 2) - y0
+        mask[max(top, 0):max(top + int(bbox['h']), 0), max(left, 0):max(left + int(bbox['w']), 0)] = 255
+
+        points = cv2.goodFeaturesToTrack(
+            self.gray, maxCorners=MAX_TRACK_POINTS, qualityLevel=0.01, minDistance=4, mask=mask
+        )
+        if points is not None and len(points) >= MIN_TRACK_POINTS:
+            self.points = points.astype(np.float32)
+
+    def update(self, img):
+        """
+        Segue l'oggetto nel nuovo frame
+        Returns: detection aggiornata (con 'tracked' e 'track_confidence') oppure None se perso
+        """
+        if self.points is None or img.shape[:2] != self.frame_shape:
+            return None
+
+        gray = self._crop(img, self.region)
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(self.gray, gray, self.points, None, **LK_PARAMS)
+        backward, status_back, _ = cv2.calcOpticalFlowPyrLK(gray, self.gray, forward, None, **LK_PARAMS)
+
+        error = np.linalg.norm((self.points - backward).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (status_back.ravel() == 1) & (error < MAX_FORWARD_BACKWARD_ERROR)
+        confidence = float(good.mean())
+        min_confidence = getattr(settings, 'YOLO_TRACK_MIN_CONFIDENCE', 0.5)
+        if good.sum() < MIN_TRACK_POINTS or confidence < min_confidence:
+            return None
+
+        old = self.points.reshape(-1, 2)[good]
+        new = forward.reshape(-1, 2)[good]
+        dx, dy = np.median(new - old, axis=0)
+
+        # Scala: mediana dei rapporti tra le distanze reciproche dei punti
+        pairs = np.triu_indices(len(old), k=1)
+        old_dist = np.linalg.norm(old[pairs[0]] - old[pairs[1]], axis=1)
+        new_dist = np.linalg.norm(new[pairs[0]] - new[pairs[1]], axis=1)
+        valid = old_dist > 1.0
+        scale = float(np.median(new_dist[valid] / old_dist[valid])) if valid.any() else 1.0
+
+        bbox = self.detection['bbox']
+        height, width = self.frame_shape
+        x, y = bbox['x'] + float(dx), bbox['y'] + float(dy)
+        if not (0 <= x < width and 0 <= y < height):
+            return None
+
+        self.detection = {
+            **self.detection,
+            'bbox': {'x': x, 'y': y, 'w': bbox['w'] * scale, 'h': bbox['h'] * scale},
+            'tracked': True,
+            'track_confidence': confidence,
+        }
+        self.frames += 1
+        self._seed(img)
+        return self.detection
+
+
+class ClassTracks:
+    """Tracker delle detections di una classe nella sessione, una per oggetto"""
+
+    def __init__(self, img, detections):
+        best = sorted(detections, key=lambda d: d['confidence'], reverse=True)[:MAX_TRACKED_BOXES]
+        self.trackers = [BoxTracker(img, detection) for detection in best]
+        self.frames = 0
+
+    def update(self, img):
+        """
+        Segue tutti gli oggetti nel nuovo frame
+        Returns: detections aggiornate oppure None se anche uno solo è perso (serve YOLO)
+        """
+        detections = []
+        for tracker in self.trackers:
+            detection = tracker.update(img)
+            if detection is None:
+                return None
+            detections.append(detection)
+        self.frames += 1
+        return detections
+
+
+_trackers = None
+_trackers_lock = threading.Lock()
+
+
+def get_tracker_cache():
+    """Tracker per sessione del processo (YOLO_TRACK_MAX_SESSIONS, YOLO_TRACK_SESSION_TTL)"""
+    global _trackers
+    if _trackers is None:
+        with _trackers_lock:
+            if _trackers is None:
+                _trackers = SessionCache(
+                    max_entries=getattr(settings, 'YOLO_TRACK_MAX_SESSIONS', 1000),
+                    ttl=getattr(settings, 'YOLO_TRACK_SESSION_TTL', 30),
+                )
+    return _trackers
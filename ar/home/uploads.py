@@ -0,0 +1,218 @@
+"""
+Ricezione in streaming delle immagini marker caricate dallo scanner.
+
+MarkerImageUploadHandler scrive ogni immagine su file temporaneo man mano che
+arriva (la richiesta non viene mai tenuta in memoria per intero), calcola lo
+SHA-256 durante la ricezione per la ContentAddressedStorage e controlla formato
+e dimensioni dall'header: un'immagine troppo grande o non supportata viene
+scartata appena letto l'header, e il resto dello stream viene letto e buttato
+senza scriverlo né decodificarlo.
+Con lo stesso filesystem, il salvataggio nello storage è un rename del file
+temporaneo.
+"""
+import hashlib
+import struct
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile, StopFutureHandlers
+
+ALLOWED_FORMATS = {'jpeg', 'png', 'webp'}
+ALLOWED_CONTENT_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
+
+# Oltre questa soglia senza header leggibile il file viene rifiutato
+MAX_HEADER_BYTES = 256 * 1024
+
+# Marker SOF dei JPEG (contengono le dimensioni); esclusi DHT (C4), JPG (C8) e DAC (CC)
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class MarkerUploadError(ValueError):
+    """Immagine marker non valida (risposta 400)"""
+
+
+def _jpeg_size(data):
+    offset = 2
+    while True:
+        # Marker: uno o più 0xFF seguiti dal tipo
+        while offset < len(data) and data[offset] == 0xFF:
+            offset += 1
+        if offset >= len(data):
+            return None
+        marker = data[offset]
+        offset += 1
+        if marker == 0xD8 or marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            raise MarkerUploadError('JPEG senza dimensioni')
+        if offset + 2 > len(data):
+            return None
+        length = struct.unpack_from('>H', data, offset)[0]
+        if marker in _JPEG_SOF_MARKERS:
+            if offset + 7 > len(data):
+                return None
+            height, width = struct.unpack_from('>HH', data, offset + 3)
+            return width, height
+        offset += length
+
+
+def _webp_size(data):
+    if len(data) < 30:
+        return None
+    chunk = bytes(data[12:16])
+    if chunk == b'VP8X':
+        width = int.from_bytes(data[24:27], 'little') + 1
+        height = int.from_bytes(data[27:30], 'little') + 1
+        return width, height
+    if chunk == b'VP8 ':
+        if bytes(data[23:26]) != b'\x9d\x01\x2a':
+            raise MarkerUploadError('WebP non valido')
+        width, height = struct.unpack_from('<HH', data, 26)
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L':
+        if data[20] != 0x2F:
+            raise MarkerUploadError('WebP non valido')
+        bits = int.from_bytes(data[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    raise MarkerUploadError('WebP non valido')
+
+
+def read_image_header(data):
+    """
+    Formato e dimensioni dai primi byte di un'immagine, senza decodificarla
+    Returns: (formato, larghezza, altezza) oppure None se servono altri byte
+    Raises: MarkerUploadError per formati non supportati
+    """
+    if len(data) < 12:
+        return None
+
+    if data[:3] == b'\xff\xd8\xff':
+        image_format, size = 'jpeg', _jpeg_size(data)
+    elif data[:8] == b'\x89PNG\r\n\x1a\n':
+        if len(data) < 24:
+            return None
+        if bytes(data[12:16]) != b'IHDR':
+            raise MarkerUploadError('PNG non valido')
+        image_format, size = 'png', struct.unpack_from('>II', data, 16)
+    elif data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        image_format, size = 'webp', _webp_size(data)
+    else:
+        raise MarkerUploadError('Formato immagine non supportato')
+
+    if size is None:
+        return None
+    return image_format, size[0], size[1]
+
+
+def check_image_header(data):
+    """
+    Valida formato e dimensioni (MARKER_UPLOAD_MAX_DIMENSION) dall'header
+    Returns: (formato, larghezza, altezza) oppure None se servono altri byte
+    Raises: MarkerUploadError
+    """
+    header = read_image_header(data)
+    if header is None:
+        if len(data) > MAX_HEADER_BYTES:
+            raise MarkerUploadError('Header immagine non leggibile')
+        return None
+
+    image_format, width, height = header
+    max_dimension = getattr(settings, 'MARKER_UPLOAD_MAX_DIMENSION', 4096)
+    if image_format not in ALLOWED_FORMATS:
+        raise MarkerUploadError('Formato immagine non supportato')
+    if not width or not height:
+        raise MarkerUploadError('Dimensioni immagine non valide')
+    if width > max_dimension or height > max_dimension:
+        raise MarkerUploadError(f'Immagine troppo grande ({width}x{height}, massimo {max_dimension}px per lato)')
+    return header
+
+
+def check_image_bytes(data):
+    """Validazione di un'immagine già in memoria (formato JSON base64 dello scanner)"""
+    if len(data) > getattr(settings, 'MARKER_UPLOAD_MAX_BYTES', 8 * 1024 * 1024):
+        raise MarkerUploadError('File immagine troppo grande')
+    header = check_image_header(data)
+    if header is None:
+        raise MarkerUploadError('Immagine troncata')
+    return header
+
+
+class MarkerImageUploadHandler(FileUploadHandler):
+    """
+    Upload handler per i campi immagine di save_marker_scan. Gli errori di validazione
+    scartano il file (SkipFile) e finiscono in self.errors, indicizzati per campo
+    """
+
+    def __init__(self, request=None, field_names=('detection_marker', 'positioning_marker')):
+        super().__init__(request)
+        self.field_names = set(field_names)
+        self.max_bytes = getattr(settings, 'MARKER_UPLOAD_MAX_BYTES', 8 * 1024 * 1024)
+        self.errors = {}
+        self.active = False
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        self.active = field_name in self.field_names
+        if not self.active:
+            return
+
+        if content_type not in ALLOWED_CONTENT_TYPES:
+            self.reject('Formato immagine non supportato')
+        if content_length is not None and content_length > self.max_bytes:
+            self.reject('File immagine troppo grande')
+
+        self.file = TemporaryUploadedFile(file_name, content_type, 0, charset, content_type_extra)
+        self.sha = hashlib.sha256()
+        self.header = bytearray()
+        self.image_info = None
+        self.size = 0
+        # Nessun altro handler deve tenere una copia del file
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+
+        self.size += len(raw_data)
+        if self.size > self.max_bytes:
+            self.reject('File immagine troppo grande')
+
+        if self.image_info is None:
+            self.header += raw_data
+            try:
+                self.image_info = check_image_header(self.header)
+            except MarkerUploadError as e:
+                self.reject(str(e))
+            if self.image_info is not None:
+                self.header = None
+
+        self.sha.update(raw_data)
+        self.file.write(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+
+        upload = self.file
+        # Il parser chiude il file degli handler se un file successivo viene scartato
+        del self.file
+        if self.image_info is None:
+            upload.close()
+            self.errors[self.field_name] = 'Immagine troncata'
+            return None
+
+        upload.seek(0)
+        upload.size = file_size
+        upload.content_hash = self.sha.hexdigest()
+        upload.image_format, upload.image_width, upload.image_height = self.image_info
+        return upload
+
+    def reject(self, message):
+        self.errors[self.field_name] = message
+        self.active = False
+        if hasattr(self, 'file'):
+            self.file.close()
+            del self.file
+        raise SkipFile(message)
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
@@ -9,7 +10,21 @@ urlpatterns = [
     path('simple-gps/', views.camera_simple_gps_view, name='camera_simple_gps'),
     path('yolo/', views.camera_yolo_view, name='camera_yolo'),
     path('api/characters/', views.get_character_data, name='character_data'),
-    path('api/yolo-detect/', views.yolo_detect_object, name='yolo_detect'),
+    path('api/marker-features/<int:char_id>/<str:marker_type>/', views.get_marker_features, name='marker_features'),
+    path('api/marker-match/', views.marker_match, name='marker_match'),
+    path(
+        'api/yolo-detect/',
+        views.yolo_detect_object_async if settings.YOLO_ASYNC_DETECTION else views.yolo_detect_object,
+        name='yolo_detect'
+    ),
+    path(
+        'api/yolo-detect/characters/',
+        views.yolo_detect_characters_async if settings.YOLO_ASYNC_DETECTION else views.yolo_detect_characters,
+        name='yolo_detect_characters'
+    ),
+    path('api/health/', views.health_check, name='health'),
+    path('metrics', views.metrics, name='metrics'),
+    path('sw.js', views.service_worker, name='service_worker'),
     path('marker-scanner/', views.marker_scanner_view, name='marker_scanner'),
     path('api/save-marker-scan/', views.save_marker_scan, name='save_marker_scan'),
     path('marker-test/', views.marker_test_view, name='marker_test'),
@@ -1,148 +1,186 @@
 from django.shortcuts import render, redirect
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
+from django.utils.http import http_date
+from django.utils.cache import get_conditional_response
 from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
 from django.core.files.base import ContentFile
-from .models import CharConfiguration
+from django.http.multipartparser import MultiPartParserError
+from django.conf import settings
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.crypto import constant_time_compare
+from .models import CharConfiguration, MarkerFeatures
+from .catalog import catalog_for_request, yolo_characters
+from .routers import catalog_reads
+from .features import MARKER_FEATURES_MAGIC, detect_orb_features, unpack_orb_features
+from .geo import parse_nearby_params, filter_nearby
+from .marker_index import match_frame
+from .metrics import PROMETHEUS_CONTENT_TYPE, mark_failure, render_metrics, stage
+from .templatetags.home_assets import opencv_js_url
+from .uploads import MarkerImageUploadHandler, MarkerUploadError, check_image_bytes
+from .inference import get_yolo_model, get_inference_executor, model_status
+from .detection import (
+    DetectionRequestError, read_detection_request, read_detection_params, read_tracking_session,
+    get_detection_param, decode_frame, track_or_detect, track_or_detect_async,
+    read_image_size, read_detection_roi, to_frame_coordinates, frame_cache_for, cached_detect, cached_detect_async,
+    read_character_selection, batch_image_size, detect_characters, detect_characters_async,
+    track_or_detect_characters, track_or_detect_characters_async
+)
+from asgiref.sync import sync_to_async
+import asyncio
+import hashlib
 import json
 import base64
-import cv2
-import numpy as np
 from PIL import Image
 import io
 
-# YOLO model - caricato una sola volta all'avvio
-_yolo_model = None
-
-def get_yolo_model():
-    """Lazy loading del modello YOLO"""
-    global _yolo_model
-    if _yolo_model is None:
-        try:
-            # Workaround for PyTorch 2.10+ weights_only default change
-            # ultralytics uses torch.load internally, we need to allow legacy loading
-            import torch
-            original_load = torch.load
-            torch.load = lambda *args, **kwargs: original_load(*args, **{**kwargs, 'weights_only': False})
-
-            from ultralytics import YOLO
-            _yolo_model = YOLO('yolov8n.pt')  # YOLOv8 nano (più leggero)
-
-            # Restore original torch.load
-            torch.load = original_load
-
-            print("YOLO model loaded successfully")
-        except Exception as e:
-            print(f"Error loading YOLO model: {e}")
-            _yolo_model = False  # Segna come fallito per non ritentare
-    return _yolo_model if _yolo_model is not False else None
-
 # Create your views here.
 
 def camera_view(request):
     """
     View per la fotocamera AR con bussola e GPS
     """
-    # Ottieni tutte le configurazioni dei personaggi
-    characters = CharConfiguration.objects.all()
-
-    # Serializza i dati per embedding diretto nell'HTML
-    character_data = []
-    for char in characters:
-        data = {
-            'id': char.id,
-            'name': char.name,
-            'target_latitude': char.target_latitude,
-            'target_longitude': char.target_longitude,
-            'activation_distance': char.activation_distance,
-            'character_image': char.character_image.url if char.character_image else None,
-            'altitude': char.altitude,
-            'height_offset': char.height_offset,
-            'base_size': char.base_size,
-            'facing_direction': char.facing_direction,
-            'display_mode': char.display_mode,
-            'use_marker': char.use_marker,
-            'marker_image': char.marker_image.url if char.marker_image else None,
-            'positioning_marker_image': char.positioning_marker_image.url if char.positioning_marker_image else None,
-            'marker_offset_x': char.marker_offset_x,
-            'marker_offset_y': char.marker_offset_y,
-            'marker_offset_z': char.marker_offset_z,
-            'detection_marker_features': char.detection_marker_features,
-            'positioning_marker_features': char.positioning_marker_features,
-        }
-        character_data.append(data)
+    # Tutte le configurazioni dei personaggi, serializzate per embedding diretto nell'HTML
+    characters_json, character_count, _ = catalog_for_request(request, 'full')
 
     context = {
-        'characters': characters,
-        'characters_json': json.dumps(character_data),  # Embedded JSON
+        'character_count': character_count,
+        'characters_json': characters_json,  # Embedded JSON
     }
 
-    return render(request, 'home/camera.html', context)
+    with stage('render'):
+        return render(request, 'home/camera.html', context)
 
 def camera_simple_view(request):
     """
     View per la fotocamera AR semplificata (solo marker-based positioning)
     """
-    # Ottieni solo i personaggi con positioning_marker_image
-    characters = CharConfiguration.objects.filter(positioning_marker_image__isnull=False).exclude(positioning_marker_image='')
-
-    # Serializza i dati per embedding diretto nell'HTML
-    character_data = []
-    for char in characters:
-        data = {
-            'id': char.id,
-            'name': char.name,
-            'character_image': char.character_image.url if char.character_image else None,
-            'positioning_marker_image': char.positioning_marker_image.url,
-            'base_size': char.base_size,
-            'marker_offset_x': char.marker_offset_x,
-            'marker_offset_y': char.marker_offset_y,
-        }
-        character_data.append(data)
+    # Solo i personaggi con positioning_marker_image
+    characters_json, character_count, _ = catalog_for_request(request, 'simple')
 
     context = {
-        'characters': characters,
-        'characters_json': json.dumps(character_data),
+        'character_count': character_count,
+        'characters_json': characters_json,
     }
 
-    return render(request, 'home/camera_simple.html', context)
+    with stage('render'):
+        return render(request, 'home/camera_simple.html', context)
 
 def get_character_data(request):
     """
     API endpoint per ottenere i dati dei personaggi in formato JSON
+    Parametri opzionali: ?lat=&lon=&radius= per ricevere solo i personaggi vicini.
+    Risponde 304 se l'If-None-Match corrisponde alla versione corrente del catalogo
     """
     if request.method == 'GET':
-        characters = CharConfiguration.objects.all()
-        character_data = []
-
-        for char in characters:
-            data = {
-                'id': char.id,
-                'name': char.name,
-                'target_latitude': char.target_latitude,
-                'target_longitude': char.target_longitude,
-                'activation_distance': char.activation_distance,
-                'character_image': char.character_image.url if char.character_image else None,
-                'altitude': char.altitude,
-                'height_offset': char.height_offset,
-                'base_size': char.base_size,
-                'facing_direction': char.facing_direction,
-                'display_mode': char.display_mode,
-                'use_marker': char.use_marker,
-                'marker_image': char.marker_image.url if char.marker_image else None,
-                'positioning_marker_image': char.positioning_marker_image.url if char.positioning_marker_image else None,
-                'marker_offset_x': char.marker_offset_x,
-                'marker_offset_y': char.marker_offset_y,
-                'marker_offset_z': char.marker_offset_z,
-                'detection_marker_features': char.detection_marker_features,
-                'positioning_marker_features': char.positioning_marker_features,
-            }
-            character_data.append(data)
-
-        return JsonResponse({'characters': character_data})
+        try:
+            characters_json, _, etag = catalog_for_request(request, 'full', strict=True)
+        except ValueError as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            # Il 304 ripete il validatore (RFC 9110)
+            not_modified['ETag'] = etag
+            not_modified['Cache-Control'] = 'no-cache'
+            return not_modified
+
+        response = HttpResponse(
+            '{"characters": %s}' % characters_json,
+            content_type='application/json'
+        )
+        response['ETag'] = etag
+        response['Cache-Control'] = 'no-cache'
+        return response
 
     return JsonResponse({'error': 'Method not allowed'}, status=405)
 
+def get_marker_features(request, char_id, marker_type):
+    """
+    API endpoint che restituisce keypoints e descriptors ORB precalcolati di un marker
+    nel formato binario descritto in home/features.py (evita l'estrazione ORB sul client)
+    """
+    if request.method != 'GET':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    with catalog_reads():
+        features = MarkerFeatures.objects.filter(
+            character_id=char_id, marker_type=marker_type
+        ).only('data', 'updated_at').first()
+
+    if features is None:
+        return JsonResponse({'error': 'Marker features not found'}, status=404)
+
+    response = HttpResponse(bytes(features.data), content_type='application/octet-stream')
+    response['Last-Modified'] = http_date(features.updated_at.timestamp())
+    return response
+
+@csrf_exempt
+def marker_match(request):
+    """
+    API endpoint che riconosce il marker inquadrato usando l'indice ANN lato server.
+    Il corpo può essere un frame ridotto (image/jpeg, multipart o JSON base64, come
+    /api/yolo-detect/) oppure keypoints + descriptors già estratti nel formato
+    binario ORB1 di home/features.py (application/octet-stream).
+    Parametri opzionali: marker_type (detection | positioning), limit, lat/lon/radius.
+    La homography restituita trasforma coordinate del marker in coordinate del frame
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    try:
+        buffer, params = read_detection_request(request)
+
+        if bytes(buffer[:4]) == MARKER_FEATURES_MAGIC:
+            try:
+                points, descriptors, width, height = unpack_orb_features(buffer)
+            except ValueError as e:
+                raise DetectionRequestError(f'Invalid features blob: {e}')
+        else:
+            try:
+                points, descriptors, width, height = detect_orb_features(
+                    buffer, getattr(settings, 'MARKER_MATCH_FRAME_FEATURES', 1000)
+                )
+            except Exception:
+                raise DetectionRequestError('Failed to decode image')
+
+        marker_type = get_detection_param(request, params, 'marker_type')
+        if marker_type not in (None, 'detection', 'positioning'):
+            raise DetectionRequestError('Invalid marker_type')
+        try:
+            limit = min(max(int(get_detection_param(request, params, 'limit', 3)), 1), 10)
+            nearby = parse_nearby_params(request.GET)
+        except (TypeError, ValueError):
+            raise DetectionRequestError('Invalid parameters')
+
+        # Con la posizione si considerano solo i marker dei personaggi vicini
+        character_ids = None
+        if nearby is not None:
+            candidates = CharConfiguration.objects.only(
+                'id', 'target_latitude', 'target_longitude', 'activation_distance'
+            )
+            with catalog_reads():
+                character_ids = {char.id for char in filter_nearby(candidates, *nearby)}
+
+        with stage('match'):
+            matches = match_frame(points, descriptors, marker_type, character_ids, limit)
+
+        return JsonResponse({
+            'success': True,
+            'frame': {'width': width, 'height': height, 'keypoints': len(points)},
+            'candidates': matches,
+        })
+
+    except DetectionRequestError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        import traceback
+        print(f"Marker match error: {e}")
+        print(traceback.format_exc())
+        mark_failure(request, e)
+        return JsonResponse({'error': str(e)}, status=500)
+
 @staff_member_required
 def marker_scanner_view(request):
     """
@@ -150,6 +188,41 @@ def marker_scanner_view(request):
     """
     return render(request, 'home/marker_scanner.html')
 
+def _optional_float(value):
+    return None if value in (None, '') else float(value)
+
+def read_marker_scan(request):
+    """
+    Campi e immagini inviati dallo scanner.
+    Multipart: file nei campi detection_marker e positioning_marker, ricevuti in streaming
+    su file temporaneo e validati dall'header (home/uploads.py).
+    JSON con data URL base64: formato storico, validato dopo il decode.
+    Returns: (data, detection_file, positioning_file)
+    Raises: ValueError, MultiPartParserError
+    """
+    if request.content_type == 'multipart/form-data':
+        # Va impostato prima di leggere request.POST / request.FILES
+        handler = MarkerImageUploadHandler(request)
+        request.upload_handlers = [handler]
+        data = request.POST
+        if handler.errors:
+            raise MarkerUploadError('; '.join(f'{field}: {error}' for field, error in handler.errors.items()))
+        return data, request.FILES.get('detection_marker'), request.FILES.get('positioning_marker')
+
+    data = json.loads(request.body)
+    files = []
+    for field in ('detection_marker', 'positioning_marker'):
+        marker_data = data.get(field)
+        if not marker_data:
+            files.append(None)
+            continue
+        imgstr = marker_data.split(';base64,')[-1]
+        image_data = base64.b64decode(imgstr)
+        image_file = ContentFile(image_data)
+        image_file.image_format = check_image_bytes(image_data)[0]
+        files.append(image_file)
+    return data, files[0], files[1]
+
 @staff_member_required
 @csrf_exempt
 def save_marker_scan(request):
@@ -158,17 +231,17 @@ def save_marker_scan(request):
     """
     if request.method == 'POST':
         try:
-            data = json.loads(request.body)
-
-            character_name = data.get('character_name')
-            detection_marker_data = data.get('detection_marker')
-            positioning_marker_data = data.get('positioning_marker')
-            latitude = data.get('latitude')
-            longitude = data.get('longitude')
-            altitude = data.get('altitude')
-            facing_direction = data.get('facing_direction', 0)
-
-            if not all([character_name, detection_marker_data, positioning_marker_data]):
+            try:
+                data, detection_file, positioning_file = read_marker_scan(request)
+                character_name = data.get('character_name')
+                latitude = _optional_float(data.get('latitude'))
+                longitude = _optional_float(data.get('longitude'))
+                altitude = _optional_float(data.get('altitude'))
+                facing_direction = _optional_float(data.get('facing_direction')) or 0
+            except (ValueError, MultiPartParserError) as e:
+                return JsonResponse({'error': str(e)}, status=400)
+
+            if not all([character_name, detection_file, positioning_file]):
                 return JsonResponse({'error': 'Missing required fields'}, status=400)
 
             # Create new character configuration
@@ -182,33 +255,17 @@ def save_marker_scan(request):
                 use_marker=True
             )
 
-            # Save detection marker image
-            if detection_marker_data:
-                format, imgstr = detection_marker_data.split(';base64,')
-                ext = format.split('/')[-1]
-                detection_file = ContentFile(
-                    base64.b64decode(imgstr),
-                    name=f'detection_marker_{char_config.id}.{ext}'
-                )
-                char_config.marker_image.save(
-                    f'detection_marker_{char_config.id}.{ext}',
-                    detection_file,
-                    save=False
-                )
-
-            # Save positioning marker image
-            if positioning_marker_data:
-                format, imgstr = positioning_marker_data.split(';base64,')
-                ext = format.split('/')[-1]
-                positioning_file = ContentFile(
-                    base64.b64decode(imgstr),
-                    name=f'positioning_marker_{char_config.id}.{ext}'
-                )
-                char_config.positioning_marker_image.save(
-                    f'positioning_marker_{char_config.id}.{ext}',
-                    positioning_file,
-                    save=False
-                )
+            # Save marker images (upload in streaming: spostati nello storage senza copie in memoria)
+            char_config.marker_image.save(
+                f'detection_marker_{char_config.id}.{detection_file.image_format}',
+                detection_file,
+                save=False
+            )
+            char_config.positioning_marker_image.save(
+                f'positioning_marker_{char_config.id}.{positioning_file.image_format}',
+                positioning_file,
+                save=False
+            )
 
             char_config.save()
 
@@ -219,10 +276,61 @@ def save_marker_scan(request):
             })
 
         except Exception as e:
+            mark_failure(request, e)
             return JsonResponse({'error': str(e)}, status=500)
 
     return JsonResponse({'error': 'Method not allowed'}, status=405)
 
+def service_worker(request):
+    """
+    Service worker servito dalla radice (scope '/'), con la lista degli static file
+    con hash da mettere in cache: cambia a ogni collectstatic che modifica un asset
+    """
+    precache_urls = [opencv_js_url()] + [
+        static(f'home/js/{name}.js') for name in ('marker_features', 'frame_matcher', 'vision_pipeline', 'vision_worker')
+    ]
+    page_urls = [reverse(name) for name in ('home:camera', 'home:camera_simple', 'home:camera_simple_gps', 'home:camera_yolo')]
+    cache_version = hashlib.md5(
+        json.dumps(precache_urls).encode(), usedforsecurity=False
+    ).hexdigest()[:12]
+
+    response = render(request, 'home/sw.js', {
+        'cache_version': cache_version,
+        'precache_urls': json.dumps(precache_urls),
+        'page_urls': json.dumps(page_urls),
+        'static_url': static(''),
+        'media_url': settings.MEDIA_URL,
+        'static_immutable': not settings.DEBUG,
+    }, content_type='application/javascript')
+    # Il browser deve sempre verificare se il service worker è cambiato
+    response['Cache-Control'] = 'no-cache'
+    response['Service-Worker-Allowed'] = '/'
+    return response
+
+def health_check(request):
+    """
+    Health check per load balancer / systemd: con YOLO_PRELOAD risponde 503
+    finché il modello non è caricato
+    """
+    yolo = model_status()
+    ready = yolo['status'] == 'ready' or not settings.YOLO_PRELOAD
+
+    return JsonResponse({
+        'status': 'ok' if ready else 'starting',
+        'yolo': yolo,
+    }, status=200 if ready else 503)
+
+def metrics(request):
+    """
+    Metriche in formato testo Prometheus: richieste, errori e latenze per view,
+    tempi per fase, stato del modello YOLO e coda di inferenza (vedi home/metrics.py)
+    """
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token and not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return JsonResponse({'error': 'Unauthorized'}, status=401)
+
+    return HttpResponse(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
 def marker_test_view(request):
     """
     Tool per testare la qualità dei marker
@@ -233,138 +341,256 @@ def camera_simple_gps_view(request):
     """
     View per la fotocamera AR semplificata con GPS filtering e single marker positioning
     """
-    # Ottieni solo i personaggi con positioning_marker_image
-    characters = CharConfiguration.objects.filter(positioning_marker_image__isnull=False).exclude(positioning_marker_image='')
-
-    # Serializza i dati per embedding diretto nell'HTML
-    character_data = []
-    for char in characters:
-        data = {
-            'id': char.id,
-            'name': char.name,
-            'target_latitude': char.target_latitude,
-            'target_longitude': char.target_longitude,
-            'activation_distance': char.activation_distance,
-            'character_image': char.character_image.url if char.character_image else None,
-            'positioning_marker_image': char.positioning_marker_image.url,
-            'positioning_marker_features': char.positioning_marker_features,
-            'base_size': char.base_size,
-            'marker_offset_x': char.marker_offset_x,
-            'marker_offset_y': char.marker_offset_y,
-        }
-        character_data.append(data)
+    # Solo i personaggi con positioning_marker_image
+    characters_json, character_count, _ = catalog_for_request(request, 'simple_gps')
 
     context = {
-        'characters': characters,
-        'characters_json': json.dumps(character_data),
+        'character_count': character_count,
+        'characters_json': characters_json,
     }
 
-    return render(request, 'home/camera_simple_gps.html', context)
+    with stage('render'):
+        return render(request, 'home/camera_simple_gps.html', context)
 
 def camera_yolo_view(request):
     """
     View per la fotocamera AR con YOLO object detection
     """
-    # Ottieni solo i personaggi con YOLO abilitato
-    characters = CharConfiguration.objects.filter(use_yolo_detection=True).exclude(yolo_object_class='')
-
-    # Serializza i dati per embedding diretto nell'HTML
-    character_data = []
-    for char in characters:
-        data = {
-            'id': char.id,
-            'name': char.name,
-            'target_latitude': char.target_latitude,
-            'target_longitude': char.target_longitude,
-            'activation_distance': char.activation_distance,
-            'character_image': char.character_image.url if char.character_image else None,
-            'use_yolo_detection': char.use_yolo_detection,
-            'yolo_object_class': char.yolo_object_class,
-            'yolo_confidence_threshold': char.yolo_confidence_threshold,
-            'base_size': char.base_size,
-            'marker_offset_x': char.marker_offset_x,
-            'marker_offset_y': char.marker_offset_y,
-        }
-        character_data.append(data)
+    # Solo i personaggi con YOLO abilitato
+    characters_json, character_count, _ = catalog_for_request(request, 'yolo')
 
     context = {
-        'characters': characters,
-        'characters_json': json.dumps(character_data),
+        'character_count': character_count,
+        'characters_json': characters_json,
     }
 
-    return render(request, 'home/camera_yolo.html', context)
+    with stage('render'):
+        return render(request, 'home/camera_yolo.html', context)
 
 @csrf_exempt
 def yolo_detect_object(request):
     """
     API endpoint per YOLO object detection
-    Riceve un frame video e rileva oggetti specifici
+    Riceve un frame video e rileva oggetti specifici.
+    Il frame può essere inviato come corpo image/jpeg (parametri in query string o header),
+    multipart (campo "image") o JSON base64 (vedi home/detection.py).
+    Con session=<id> l'oggetto viene seguito tra i frame e YOLO rieseguito solo
+    periodicamente (mode nella risposta: 'detect' o 'track').
+    image_size sceglie l'input del modello, roi=x,y,w,h limita l'inferenza a una
+    regione del frame (ignorato con session: il tracker analizza già solo l'oggetto).
+    Un frame quasi identico a uno recente della stessa sessione riceve il risultato
+    in cache invece di una nuova inferenza (mode 'cache', vedi home/frame_cache.py)
     """
     if request.method != 'POST':
         return JsonResponse({'error': 'Method not allowed'}, status=405)
 
     try:
-        data = json.loads(request.body)
-        image_b64 = data.get('image')
-        object_class = data.get('object_class', 'bottle')
-        confidence_threshold = float(data.get('confidence_threshold', 0.5))
+        with stage('request'):
+            image_buffer, params = read_detection_request(request)
+            object_class, confidence_threshold = read_detection_params(request, params)
+            session = read_tracking_session(request, params)
+            image_size = read_image_size(request, params)
+            roi = None if session else read_detection_roi(request, params)
+        with stage('decode'):
+            img, transform = decode_frame(image_buffer, image_size, roi)
+
+        # Carica modello YOLO
+        with stage('model'):
+            model = get_yolo_model()
+        if model is None:
+            mark_failure(request, 'model_not_available')
+            return JsonResponse({'error': 'YOLO model not available'}, status=500)
+
+        cache = frame_cache_for(request, session, (object_class, confidence_threshold, image_size, roi, img.shape))
+        if session:
+            detections, mode = track_or_detect(img, object_class, confidence_threshold, session, image_size, cache)
+        else:
+            detections, mode = cached_detect(img, object_class, confidence_threshold, image_size, cache)
 
-        if not image_b64:
-            return JsonResponse({'error': 'Missing image data'}, status=400)
+        with stage('serialize'):
+            detections = to_frame_coordinates(detections, transform)
+            return JsonResponse({
+                'success': True,
+                'detections': detections,
+                'count': len(detections),
+                'mode': mode
+            })
 
-        # Decodifica immagine base64
-        if ',' in image_b64:
-            image_b64 = image_b64.split(',')[1]
+    except DetectionRequestError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        import traceback
+        print(f"YOLO detection error: {e}")
+        print(traceback.format_exc())
+        mark_failure(request, e)
+        return JsonResponse({'error': str(e)}, status=500)
 
-        img_data = base64.b64decode(image_b64)
-        nparr = np.frombuffer(img_data, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+@csrf_exempt
+async def yolo_detect_object_async(request):
+    """
+    Versione async di yolo_detect_object per il deploy ASGI (YOLO_ASYNC_DETECTION = True).
+    Decode e caricamento del modello girano nell'executor limitato, l'inferenza attende
+    il micro-batch senza occupare thread: un processo regge molte richieste in volo
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
 
-        if img is None:
-            return JsonResponse({'error': 'Failed to decode image'}, status=400)
+    try:
+        with stage('request'):
+            image_buffer, params = read_detection_request(request)
+            object_class, confidence_threshold = read_detection_params(request, params)
+            session = read_tracking_session(request, params)
+            image_size = read_image_size(request, params)
+            roi = None if session else read_detection_roi(request, params)
+
+        loop = asyncio.get_running_loop()
+        executor = get_inference_executor()
+        with stage('decode'):
+            img, transform = await loop.run_in_executor(executor, decode_frame, image_buffer, image_size, roi)
 
         # Carica modello YOLO
-        model = get_yolo_model()
+        with stage('model'):
+            model = await loop.run_in_executor(executor, get_yolo_model)
         if model is None:
+            mark_failure(request, 'model_not_available')
             return JsonResponse({'error': 'YOLO model not available'}, status=500)
 
-        # Esegui detection
-        results = model(img, conf=confidence_threshold, verbose=False)
-
-        # Estrai detections per la classe richiesta
-        detections = []
-        if len(results) > 0:
-            result = results[0]
-            boxes = result.boxes
-
-            for box in boxes:
-                cls_id = int(box.cls[0])
-                class_name = result.names[cls_id]
-
-                if class_name == object_class:
-                    # Coordinate bounding box (xywh = center format)
-                    x, y, w, h = box.xywh[0].tolist()
-                    confidence = float(box.conf[0])
-
-                    detections.append({
-                        'class': class_name,
-                        'confidence': confidence,
-                        'bbox': {
-                            'x': x,
-                            'y': y,
-                            'w': w,
-                            'h': h
-                        }
-                    })
+        cache = frame_cache_for(request, session, (object_class, confidence_threshold, image_size, roi, img.shape))
+        if session:
+            detections, mode = await track_or_detect_async(
+                img, object_class, confidence_threshold, session, image_size, cache
+            )
+        else:
+            detections, mode = await cached_detect_async(img, object_class, confidence_threshold, image_size, cache)
+
+        with stage('serialize'):
+            detections = to_frame_coordinates(detections, transform)
+            return JsonResponse({
+                'success': True,
+                'detections': detections,
+                'count': len(detections),
+                'mode': mode
+            })
+
+    except DetectionRequestError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        import traceback
+        print(f"YOLO detection error: {e}")
+        print(traceback.format_exc())
+        mark_failure(request, e)
+        return JsonResponse({'error': str(e)}, status=500)
 
+def _character_detections_response(characters, results, transform, mode='detect'):
+    with stage('serialize'):
+        entries = []
+        for char in characters:
+            detections = to_frame_coordinates(results.get(char['id'], []), transform)
+            entries.append({
+                'id': char['id'],
+                'name': char['name'],
+                'object_class': char['yolo_object_class'],
+                'detections': detections,
+                'count': len(detections)
+            })
         return JsonResponse({
             'success': True,
-            'detections': detections,
-            'count': len(detections)
+            'characters': entries,
+            'count': sum(entry['count'] for entry in entries),
+            'mode': mode
         })
 
+@csrf_exempt
+def yolo_detect_characters(request):
+    """
+    API endpoint per la detection di più personaggi YOLO con un solo frame.
+    I personaggi si indicano con characters=1,2,3 e/o lat=&lon=&radius= (quelli vicini);
+    classe e soglia vengono dalla configurazione di ciascuno, con un solo forward pass
+    sull'unione delle classi. image_size di default è il più grande dei personaggi,
+    roi e session come /api/yolo-detect/: con session tutti gli oggetti delle classi
+    richieste vengono seguiti tra i frame, una richiesta per frame per tutti i personaggi
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    try:
+        with stage('request'):
+            image_buffer, params = read_detection_request(request)
+            character_ids, nearby = read_character_selection(request, params)
+            session = read_tracking_session(request, params)
+            roi = None if session else read_detection_roi(request, params)
+
+        characters = yolo_characters(character_ids, nearby)
+        if not characters:
+            return JsonResponse({'success': True, 'characters': [], 'count': 0})
+        image_size = batch_image_size(request, params, characters)
+
+        with stage('decode'):
+            img, transform = decode_frame(image_buffer, image_size, roi)
+
+        # Carica modello YOLO
+        with stage('model'):
+            model = get_yolo_model()
+        if model is None:
+            mark_failure(request, 'model_not_available')
+            return JsonResponse({'error': 'YOLO model not available'}, status=500)
+
+        if session:
+            results, mode = track_or_detect_characters(img, characters, session, image_size)
+        else:
+            results, mode = detect_characters(img, characters, image_size), 'detect'
+        return _character_detections_response(characters, results, transform, mode)
+
+    except DetectionRequestError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    except Exception as e:
+        import traceback
+        print(f"YOLO detection error: {e}")
+        print(traceback.format_exc())
+        mark_failure(request, e)
+        return JsonResponse({'error': str(e)}, status=500)
+
+@csrf_exempt
+async def yolo_detect_characters_async(request):
+    """Versione async di yolo_detect_characters (YOLO_ASYNC_DETECTION = True)"""
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+
+    try:
+        with stage('request'):
+            image_buffer, params = read_detection_request(request)
+            character_ids, nearby = read_character_selection(request, params)
+            session = read_tracking_session(request, params)
+            roi = None if session else read_detection_roi(request, params)
+
+        characters = await sync_to_async(yolo_characters)(character_ids, nearby)
+        if not characters:
+            return JsonResponse({'success': True, 'characters': [], 'count': 0})
+        image_size = batch_image_size(request, params, characters)
+
+        loop = asyncio.get_running_loop()
+        executor = get_inference_executor()
+        with stage('decode'):
+            img, transform = await loop.run_in_executor(executor, decode_frame, image_buffer, image_size, roi)
+
+        # Carica modello YOLO
+        with stage('model'):
+            model = await loop.run_in_executor(executor, get_yolo_model)
+        if model is None:
+            mark_failure(request, 'model_not_available')
+            return JsonResponse({'error': 'YOLO model not available'}, status=500)
+
+        if session:
+            results, mode = await track_or_detect_characters_async(img, characters, session, image_size)
+        else:
+            results, mode = await detect_characters_async(img, characters, image_size), 'detect'
+        return _character_detections_response(characters, results, transform, mode)
+
+    except DetectionRequestError as e:
+        return JsonResponse({'error': str(e)}, status=400)
     except Exception as e:
         import traceback
         print(f"YOLO detection error: {e}")
         print(traceback.format_exc())
+        mark_failure(request, e)
         return JsonResponse({'error': str(e)}, status=500)